@@ -1,4 +1,5 @@
 import benchmarking
+import gem5_api
 import tempfile 
 import subprocess 
 import os 
@@ -6,6 +7,12 @@ import glob
 import numpy as np
 from tqdm import tqdm
 from collections import defaultdict
+import multiprocessing
+import time
+import pytest
+import requests
+import io
+import threading
 
 count_to_10_cpp = """
 #include <iostream>
@@ -83,6 +90,16 @@ int main() {
 #         return get_accuracy(p.stdout, ground_truth_output)
 
 
+def write_mult_by_2_testcases(testcases_dir, problem_id):
+    """testcases for mult_in_by_2_cpp, where only the first (and shortest) one has a wrong expected output"""
+    os.makedirs(os.path.join(testcases_dir, problem_id))
+    for tc_no, (x, y) in enumerate([(1, 3), (22, 44), (333, 666), (4444, 8888)]):
+        with open(os.path.join(testcases_dir, problem_id, f"input.{tc_no}.txt"), "w") as fh: 
+            fh.write(str(x))
+        with open(os.path.join(testcases_dir, problem_id, f"output.{tc_no}.txt"), "w") as fh: 
+            fh.write(str(y))
+
+
 class TestBenchmarking: 
     def test_compile(self): 
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -96,6 +113,28 @@ class TestBenchmarking:
             assert os.path.exists(output_path)
             assert os.path.getsize(output_path) > 0
             
+    def test_compile_cache(self): 
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = benchmarking.init_compile_cache(os.path.join(tmpdir, "cache"))
+            try: 
+                code_path = os.path.join(tmpdir, "basic.cpp")
+                with open(code_path, "w") as f:
+                    f.write(count_to_10_cpp)
+                output_path_0 = benchmarking.compile_cpp_code(code_path, output_path=os.path.join(tmpdir, "basic_0.out"))
+                output_path_1 = benchmarking.compile_cpp_code(code_path, output_path=os.path.join(tmpdir, "basic_1.out"))
+                output_path_2 = benchmarking.compile_cpp_code(code_path, output_path=os.path.join(tmpdir, "basic_2.out"), cflags="--std=c++17 -O2")
+                assert cache.stats()["hits"] == 1
+                assert cache.stats()["misses"] == 2
+                for output_path in [output_path_0, output_path_1, output_path_2]:
+                    p = subprocess.run([output_path], capture_output=True, text=True)
+                    assert p.returncode == 0
+                    assert p.stdout.strip() == "\n".join([str(i) for i in range(10)])
+                cache.max_size_bytes = 0
+                cache.evict()
+                assert cache.stats()["size_bytes"] == 0
+            finally: 
+                benchmarking.COMPILE_CACHE = None
+            
     def test_exec_bin(self): 
         with tempfile.TemporaryDirectory() as tmpdir:
             code_path = os.path.join(tmpdir, "basic.cpp")
@@ -153,6 +192,80 @@ class TestBenchmarking:
         n_testcases = len(glob.glob(os.path.join("/home/pie-perf/data/codenet/merged_test_cases/", example_1_problem_id, "input.*.txt")))
         assert len(accs) == n_testcases
         
+    def test_compile_and_check_outputs_early_exit(self): 
+        with tempfile.TemporaryDirectory() as tempdir: 
+            code_path = os.path.join(tempdir, "basic.cpp")
+            with open(code_path, "w") as fh: 
+                fh.write(mult_in_by_2_cpp)
+            # the shortest testcase fails, which already rules out a mean accuracy of 0.9
+            write_mult_by_2_testcases(tempdir, "p0")
+            for n_workers in [1, 4]: 
+                bin_path, accs = benchmarking.compile_and_check_outputs(code_path=code_path, problem_id="p0", testcases_dir=tempdir, n_workers=n_workers)
+                assert accs == {"0": 0, "1": 1, "2": 1, "3": 1}
+                assert benchmarking.mean_accuracy(accs) == 0.75
+            bin_path, accs = benchmarking.compile_and_check_outputs(code_path=code_path, problem_id="p0", testcases_dir=tempdir, early_exit_acc_threshold=0.9)
+        # the skipped testcases are not counted as failures
+        assert accs == {"0": 0, "1": None, "2": None, "3": None}
+        assert benchmarking.mean_accuracy(accs) == 0.0
+        
+    def test_native_runtimes_are_recorded_per_binary(self): 
+        with tempfile.TemporaryDirectory() as tempdir: 
+            code_path = os.path.join(tempdir, "basic.cpp")
+            with open(code_path, "w") as fh: 
+                fh.write(mult_in_by_2_cpp)
+            write_mult_by_2_testcases(tempdir, "p0")
+            store = benchmarking.init_gem5_result_store(os.path.join(tempdir, "gem5_results.sqlite3"))
+            try: 
+                # concurrent runs are not timed
+                bin_path, accs, tc2native_time = benchmarking.compile_and_check_outputs(code_path=code_path, problem_id="p0", testcases_dir=tempdir, 
+                                                                                        n_workers=4, return_native_times=True)
+                assert tc2native_time == {}
+                assert store.get_runtimes("p0", "native") == {}
+                # the wrong answer is not timed
+                bin_path, accs, tc2native_time = benchmarking.compile_and_check_outputs(code_path=code_path, problem_id="p0", testcases_dir=tempdir, 
+                                                                                        return_native_times=True)
+                assert sorted(tc2native_time.keys()) == [1, 2, 3]
+                assert sorted(store.get_runtimes("p0", "native").keys()) == [1, 2, 3]
+                assert store.slowdown_factor() is None
+                # the gem5 runs of another binary on the same testcases are not paired with these native runs
+                store.record_runtimes("p0", "gem5", {1: 1000.0, 2: 1000.0}, bin_sha256="other")
+                assert store.slowdown_factor() is None
+                bin_sha256 = benchmarking.file_sha256(bin_path)
+                store.record_runtimes("p0", "gem5", {tc_no: 100 * tc2native_time[tc_no] for tc_no in [1, 2]}, bin_sha256=bin_sha256)
+                assert np.isclose(store.slowdown_factor(), 100.0)
+            finally: 
+                benchmarking.GEM5_RESULT_STORE = None
+        
+    def test_parse_stats_txt(self):
+        stats_txt = "\n".join([
+            "---------- Begin Simulation Statistics ----------", 
+            "sim_seconds                                  0.001004                       # Number of seconds simulated (Second)", 
+            "sim_ticks                                 1004121118                       # Number of ticks simulated (Tick)", 
+            "sim_freq                               1000000000000                       # Number of ticks per simulated second ((Tick/Second))", 
+            "system.cpu.ipc                               0.653210                       # IPC: instructions per cycle ((Count/Cycle))", 
+            "system.cpu.cpi                                    nan                       # CPI: cycles per instruction ((Cycle/Count))", 
+            "system.cpu.dist::0-1                             5     10.00%     10.00% # Distribution", 
+            "", 
+            "---------- End Simulation Statistics   ----------"])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            stats_path = os.path.join(tmpdir, "stats.txt")
+            with open(stats_path, "w") as f:
+                f.write(stats_txt)
+            stats = benchmarking.parse_stats_txt(stats_path)
+            assert stats["sim_ticks"] == 1004121118
+            assert stats["system.cpu.ipc"] == 0.65321
+            assert stats["system.cpu.cpi"] is None
+            assert stats["system.cpu.dist::0-1"] == [5, 10.0, 10.0]
+            assert stats["sim_seconds_precise"] == 0.001004121118
+            
+            stats = benchmarking.parse_stats_txt(stats_path, keys=["system.cpu.ipc"])
+            assert set(stats.keys()) == {"sim_ticks", "sim_freq", "system.cpu.ipc", "sim_seconds_precise"}
+            
+            columns = benchmarking.parse_stats_txt(stats_path, keys=["system.cpu.dist::0-1"], columnar=True)
+            dist = columns[columns["key"] == "system.cpu.dist::0-1"]
+            assert list(dist["index"]) == [0, 1, 2]
+            assert list(dist["value"]) == [5.0, 10.0, 10.0]
+
     def test_exec_gem5(self):
         sim_seconds = []
         sim_seconds_precise = []
@@ -213,6 +326,36 @@ class TestBenchmarking:
         assert sim_seconds_1[0] == sim_seconds_1[1] == 0.001039205596
     
 
+    def test_run_gem5_result_store(self): 
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = benchmarking.init_gem5_result_store(os.path.join(tmpdir, "gem5_results.sqlite3"))
+            try: 
+                code_path = os.path.join(tmpdir, "code.cpp")
+                with open(code_path, "w") as f:
+                    f.write(example_1_code)
+                bin_path = benchmarking.compile_cpp_code(code_path)
+                tc_2_results_list = []
+                for _ in range(2): 
+                    tc_2_results_list.append(benchmarking.run_gem5(
+                        gem5_dir="/home/gem5/build/X86/", 
+                        gem5_script_path="/home/gem5-skylake-config/gem5-configs/run-se.py", 
+                        cpu_type="Verbatim",
+                        bin_path=bin_path, 
+                        problem_id=example_1_problem_id, 
+                        testcases_dir="/home/pie-perf/data/codenet/merged_test_cases/", 
+                        testcases=[0,1], 
+                        timeout=30, 
+                        cpu_number=0
+                    ))
+                assert store.stats()["misses"] == 2
+                assert store.stats()["hits"] == 2
+                for tc_no in [0, 1]:
+                    assert tc_2_results_list[0][tc_no]["time"] == tc_2_results_list[1][tc_no]["time"]
+                assert tc_2_results_list[1][0]["time"] == 0.001035073468
+                assert tc_2_results_list[1][1]["time"] == 0.001039205596
+            finally: 
+                benchmarking.GEM5_RESULT_STORE = None
+
     def test_run_hyperfine(self):
         tc2times = defaultdict(list)
         for _ in range(2):
@@ -242,6 +385,49 @@ class TestBenchmarking:
             print(f"std/mean = {np.std(mean_times) / np.mean(mean_times)} for tc {tc} with mean times {mean_times} ")
         assert len(tc2times) == 10
         
+    def test_run_hyperfine_compile_once(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            code_path = os.path.join(tmpdir, "code.cpp")
+            with open(code_path, "w") as f:
+                f.write(example_1_code)
+            code2results, output = benchmarking.run_hyperfine(
+                code_paths=[code_path],
+                problem_ids=[example_1_problem_id],
+                path_to_testcases="/home/pie-perf/data/codenet/merged_test_cases/",
+                json_out_path=os.path.join(tmpdir, "results.json"),
+                test_cases_list=[[i for i in range(10)]], 
+                min_runs_per_test_case=10, 
+                max_runs_per_test_case=500, 
+                strict_runs_per_test_case=False,
+                warmup_runs_per_test_case=5,
+                cpu_number=0,
+                do_sanity_check=True, 
+                compile_once=True)
+            # only the original code is compiled, no redirected copies per test case
+            assert len(glob.glob(os.path.join(tmpdir, "*.out"))) == 1
+        assert len(code2results[code_path]) == 10
+        for tc, results in code2results[code_path].items():
+            assert results is not None
+            assert len(results["times"]) >= 10
+
+    def test_run_hyperfine_compile_once_compile_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_mult_by_2_testcases(tmpdir, "p0")
+            code_path = os.path.join(tmpdir, "code.cpp")
+            with open(code_path, "w") as f:
+                f.write("int main() { return x; }")
+            kwargs = dict(code_paths=[code_path], problem_ids=["p0"], path_to_testcases=tmpdir,
+                          json_out_path=os.path.join(tmpdir, "results.json"), compile_once=True)
+            # the compile error is not raised, the testcases of the code get no results
+            code2results, _ = benchmarking.run_hyperfine(**kwargs)
+            assert code2results[code_path] == {0: None, 1: None, 2: None, 3: None}
+            # a code whose binary failed to compile earlier is not compiled again
+            with open(code_path, "w") as f:
+                f.write(mult_in_by_2_cpp)
+            code2results, _ = benchmarking.run_hyperfine(bin_paths=[None], **kwargs)
+            assert code2results[code_path] == {0: None, 1: None, 2: None, 3: None}
+            assert len(glob.glob(os.path.join(tmpdir, "*.out"))) == 0
+
     def test_run_hyperfine_strict(self):
         tc2times = defaultdict(list)
         for _ in range(2):
@@ -280,4 +466,273 @@ class TestBenchmarking:
             
     
     
-        
\ No newline at end of file
+        
+
+
+def hold_lease_with_subprocess(cpu_allocator, pid_queue):
+    cpu_allocator.acquire()
+    # stands in for a gem5 or hyperfine run that outlives a killed worker
+    child = subprocess.Popen(["sleep", "60"])
+    pid_queue.put(child.pid)
+    child.wait()
+
+
+def is_running(pid):
+    try: 
+        with open(f"/proc/{pid}/stat") as f:
+            # zombies are not running anymore, they are only waiting to be reaped by init
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+class TestCpuAllocator: 
+    def make_allocator(self, manager, cpu_list):
+        cpu_queue = manager.Queue()
+        for cpu_number in cpu_list:
+            cpu_queue.put(cpu_number)
+        return gem5_api.CpuAllocator(manager, cpu_queue, cpu_list, poll_interval=0.1)
+    
+    def test_lease_released_on_exception_and_early_return(self):
+        with multiprocessing.Manager() as manager:
+            cpu_allocator = self.make_allocator(manager, [0])
+            try: 
+                with cpu_allocator.lease() as cpu_number:
+                    assert cpu_allocator.status()["held"].keys() == {cpu_number}
+                    raise RuntimeError("simulation failed")
+            except RuntimeError:
+                pass
+            assert cpu_allocator.status()["free"] == [0]
+            
+            def returns_early():
+                with cpu_allocator.lease() as cpu_number:
+                    return cpu_number
+            assert returns_early() == 0
+            assert cpu_allocator.status()["free"] == [0]
+            assert len(cpu_allocator.status()["held"]) == 0
+    
+    def test_lease_of_dead_process_is_reclaimed(self):
+        with multiprocessing.Manager() as manager:
+            cpu_allocator = self.make_allocator(manager, [0])
+            # the child exits while holding the lease, like a terminated pool worker
+            process = multiprocessing.Process(target=cpu_allocator.acquire)
+            process.start()
+            process.join()
+            assert cpu_allocator.leases[0]["pid"] == process.pid
+            # acquire blocks until the lease of the dead process is reclaimed
+            cpu_number, lease_id = cpu_allocator.acquire()
+            assert cpu_number == 0
+            assert cpu_allocator.leases[0]["lease_id"] == lease_id
+            cpu_allocator.release(cpu_number, lease_id)
+            assert cpu_allocator.status()["free"] == [0]
+    
+    def test_subprocesses_of_dead_lease_holder_are_killed(self):
+        with multiprocessing.Manager() as manager:
+            cpu_allocator = self.make_allocator(manager, [0])
+            # a multiprocessing.Queue can be left locked by a writer that is killed right after the put
+            pid_queue = manager.Queue()
+            # SIGTERM (Pool.terminate) is handled by the worker, SIGKILL (e.g. the oom killer) is not
+            for kill in [lambda process: process.terminate(), lambda process: process.kill()]:
+                process = multiprocessing.Process(target=hold_lease_with_subprocess, args=(cpu_allocator, pid_queue))
+                process.start()
+                child_pid = pid_queue.get(timeout=10)
+                kill(process)
+                process.join()
+                cpu_number, lease_id = cpu_allocator.acquire()
+                for _ in range(50):
+                    if not is_running(child_pid):
+                        break
+                    time.sleep(0.1)
+                assert not is_running(child_pid)
+                cpu_allocator.release(cpu_number, lease_id)
+    
+    def test_release_of_reclaimed_lease_is_noop(self):
+        with multiprocessing.Manager() as manager:
+            cpu_allocator = self.make_allocator(manager, [0, 1])
+            cpu_allocator.lease_timeout = 0
+            cpu_number, stale_lease_id = cpu_allocator.acquire()
+            time.sleep(0.01)
+            cpu_allocator.reap_expired()
+            cpu_allocator.lease_timeout = None
+            # the cpu is handed out again before the stale lease is released
+            cpu_numbers = sorted(cpu_allocator.acquire() for _ in range(2))
+            cpu_allocator.release(cpu_number, stale_lease_id)
+            assert len(cpu_allocator.status()["held"]) == 2
+            assert cpu_allocator.cpu_queue.qsize() == 0
+            for cpu_number, lease_id in cpu_numbers:
+                cpu_allocator.release(cpu_number, lease_id)
+            assert cpu_allocator.status()["free"] == [0, 1]
+            assert cpu_allocator.cpu_queue.qsize() == 2
+
+
+class FakeBackend: 
+    """stands in for a PieEnvironment in a PieCluster, returning the code as the result"""
+    def __init__(self, name, fail_after=None, end_after=None, hang=False):
+        self.base_url = name
+        self.fail_after = fail_after
+        self.end_after = end_after
+        self.hang = hang
+        self.healthy = True
+        self.n_chunks = 0
+        self.release = threading.Event()
+    
+    def test_connection(self):
+        return self.healthy
+    
+    def iter_multiple_single_submissions(self, code_list, testcases_list, problem_id_list, timing_env, override_flags_list=None, stat_keys=None):
+        self.n_chunks += 1
+        for chunk_idx, code in enumerate(code_list):
+            if self.hang and chunk_idx == 1:
+                self.release.wait()
+            if chunk_idx == self.fail_after:
+                self.healthy = False
+                raise requests.ConnectionError(f"{self.base_url} went down")
+            if chunk_idx == self.end_after:
+                return
+            yield chunk_idx, code
+
+
+class TestPieCluster: 
+    def run(self, cluster, n_submissions):
+        indices = []
+        results = {}
+        for submission_idx, result in cluster.iter_multiple_single_submissions([f"code {i}" for i in range(n_submissions)], [[0]] * n_submissions, 
+                                                                               ["p0"] * n_submissions, "gem5"):
+            indices.append(submission_idx)
+            results[submission_idx] = result
+        # every submission exactly once, with its own result
+        assert sorted(indices) == list(range(n_submissions))
+        assert results == {i: f"code {i}" for i in range(n_submissions)}
+    
+    def test_backend_failing_mid_chunk(self):
+        simulator = pytest.importorskip("gem5.simulator")
+        failing, healthy = FakeBackend("failing", fail_after=2), FakeBackend("healthy")
+        cluster = simulator.PieCluster([failing, healthy], chunk_size=4)
+        self.run(cluster, 20)
+        assert cluster.failed_envs == {0}
+        # still down at the next batch
+        self.run(cluster, 8)
+        assert failing.n_chunks == 1
+        # back up, so it gets chunks again
+        failing.healthy = True
+        failing.fail_after = None
+        self.run(cluster, 20)
+        assert cluster.failed_envs == set()
+        assert failing.n_chunks > 1
+    
+    def test_backend_ending_stream_early(self):
+        simulator = pytest.importorskip("gem5.simulator")
+        cluster = simulator.PieCluster([FakeBackend("truncating", end_after=1), FakeBackend("healthy")], chunk_size=3)
+        self.run(cluster, 12)
+        assert cluster.failed_envs == {0}
+        with pytest.raises(RuntimeError):
+            self.run(simulator.PieCluster([FakeBackend("truncating", end_after=1)], chunk_size=3), 6)
+    
+    def test_backend_missing_chunk_deadline(self):
+        simulator = pytest.importorskip("gem5.simulator")
+        hanging = FakeBackend("hanging", hang=True)
+        cluster = simulator.PieCluster([hanging, FakeBackend("healthy")], chunk_size=3, chunk_timeout=1.0)
+        try: 
+            self.run(cluster, 12)
+            assert cluster.failed_envs == {0}
+        finally: 
+            # lets the thread of the abandoned chunk finish, it drops its late results
+            hanging.release.set()
+
+
+class TestGem5Timeouts: 
+    def test_plan_gem5_timeouts_waits_for_calibration(self, monkeypatch):
+        for key, value in {"preskip_gem5_timeouts": True, "scale_gem5_timeouts": True, "timeout_seconds_gem5": 100, 
+                           "gem5_timeout_margin": 3, "min_scaled_gem5_timeout": 10, "gem5_slowdown_factor": None}.items():
+            monkeypatch.setitem(gem5_api.app.config, key, value)
+        monkeypatch.setattr(benchmarking, "GEM5_RESULT_STORE", None)
+        # the default factor would skip the first testcase and cut the timeout of the second one
+        assert gem5_api.plan_gem5_timeouts({0: 1.0, 1: 0.001}) is None
+        monkeypatch.setitem(gem5_api.app.config, "gem5_slowdown_factor", 1000.0)
+        assert gem5_api.plan_gem5_timeouts({0: 1.0, 1: 0.001}) == {0: None, 1: 10}
+
+
+class TestWireFormat: 
+    def to_requests_response(self, flask_response):
+        response = requests.Response()
+        response.status_code = flask_response.status_code
+        response.headers.update(flask_response.headers)
+        response.raw = io.BytesIO(flask_response.get_data())
+        return response
+    
+    def decode(self, simulator, mimetype, results):
+        with gem5_api.app.test_request_context(headers={"Accept": mimetype}):
+            flask_response = gem5_api.make_results_response(results)
+        response = self.to_requests_response(flask_response)
+        assert response.headers["Content-Type"].startswith(mimetype)
+        return simulator.decode_results_response(response)
+    
+    def make_results(self):
+        stats = {"sim_seconds": 0.001035, "sim_seconds_precise": 0.001035073468, "system.cpu.ipc": 1.5, 
+                 # distributions have several values per stat
+                 "system.cpu.dist::0": [10, 12.5, 12.5]}
+        return [{"compile_success": True, "accs": {0: 1.0, 1: 1.0}, 
+                 "gem5": {0: {"success": True, "error": None, "stats": stats, "stdout": "0\n", "stderr": "", "time": 0.001035073468}, 
+                          1: {"success": False, "error": "timeout", "stats": None, "stdout": None, "stderr": None, "time": None}}}, 
+                {"compile_success": True, "accs": {0: 1.0}, 
+                 "gem5": {0: {"success": True, "error": None, "stats": {**stats, "system.cpu.ipc": 2.0}, "stdout": "0\n", "stderr": "", "time": 0.001035073468}}}, 
+                {"compile_success": False, "accs": {0: 0.0}, "gem5": {}}, 
+                # a second stat layout, first used after the other records were streamed
+                {"compile_success": True, "accs": {0: 1.0}, 
+                 "gem5": {0: {"success": True, "error": None, "stats": {"sim_seconds": 0.002, "sim_seconds_precise": 0.002}, "stdout": "0\n", "stderr": "", "time": 0.002}}}]
+    
+    def test_msgpack_round_trip(self):
+        pytest.importorskip("msgpack")
+        simulator = pytest.importorskip("gem5.simulator")
+        results = self.make_results()
+        json_results = self.decode(simulator, "application/json", results)
+        msgpack_results = self.decode(simulator, gem5_api.MSGPACK_MIMETYPE, results)
+        assert msgpack_results == json_results
+        assert msgpack_results[0]["gem5"]["1"]["stats"] is None
+        assert msgpack_results[0]["gem5"]["0"]["stats"]["system.cpu.dist::0"] == [10, 12.5, 12.5]
+        assert simulator.parse_submission_result(msgpack_results) == simulator.parse_submission_result(json_results)
+    
+    def test_msgpack_stream(self, monkeypatch):
+        pytest.importorskip("msgpack")
+        simulator = pytest.importorskip("gem5.simulator")
+        results = self.make_results()
+        # out of order, like the results of the pool
+        monkeypatch.setattr(gem5_api, "iter_multiple_single_submissions", 
+                            lambda code_list, *args, **kwargs: ((index, results[index]) for index in reversed(range(len(code_list)))))
+        monkeypatch.setitem(gem5_api.app.config, "api_key", "key")
+        submissions = [{"code": "int main() {}", "testcases": [0], "problem_id": "p0"}] * len(results)
+        streamed = {}
+        for mimetype in ["application/json", gem5_api.MSGPACK_MIMETYPE]:
+            with gem5_api.app.test_client() as client:
+                flask_response = client.get("/gem5/multiple_single_submissions_stream", headers={"Accept": mimetype}, 
+                                            json={"submissions": submissions, "timing_env": "gem5", "api_key": "key"})
+            response = self.to_requests_response(flask_response)
+            assert response.headers["Content-Type"].startswith(mimetype if mimetype == gem5_api.MSGPACK_MIMETYPE else "application/x-ndjson")
+            streamed[mimetype] = list(simulator.iter_results_stream(response))
+        assert [index for index, _ in streamed[gem5_api.MSGPACK_MIMETYPE]] == list(reversed(range(len(results))))
+        assert streamed[gem5_api.MSGPACK_MIMETYPE] == streamed["application/json"]
+        assert dict(streamed[gem5_api.MSGPACK_MIMETYPE])[3]["gem5"]["0"]["stats"] == {"sim_seconds": 0.002, "sim_seconds_precise": 0.002}
+        assert dict(streamed[gem5_api.MSGPACK_MIMETYPE])[0]["gem5"]["0"]["stats"]["system.cpu.dist::0"] == [10, 12.5, 12.5]
+    
+    def test_msgpack_job(self, monkeypatch):
+        pytest.importorskip("msgpack")
+        simulator = pytest.importorskip("gem5.simulator")
+        results = self.make_results()
+        monkeypatch.setitem(gem5_api.app.config, "api_key", "key")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            job_store = gem5_api.JobStore(os.path.join(tmpdir, "jobs.db"))
+            monkeypatch.setattr(gem5_api, "JOB_STORE", job_store)
+            job_id = job_store.create_job([{"code": "int main() {}", "testcases": [0], "problem_id": "p0"}] * len(results), "gem5")
+            for index, result in enumerate(results):
+                job_store.add_result(job_id, index, result)
+            jobs = {}
+            for mimetype in ["application/json", gem5_api.MSGPACK_MIMETYPE]:
+                with gem5_api.app.test_client() as client:
+                    flask_response = client.get(f"/gem5/jobs/{job_id}", headers={"Accept": mimetype}, json={"cursor": 0, "api_key": "key"})
+                response = self.to_requests_response(flask_response)
+                assert response.headers["Content-Type"].startswith(mimetype)
+                jobs[mimetype] = simulator.decode_results_response(response)
+        assert jobs[gem5_api.MSGPACK_MIMETYPE] == jobs["application/json"]
+        assert jobs[gem5_api.MSGPACK_MIMETYPE]["n_completed"] == len(results)
+        assert [r["index"] for r in jobs[gem5_api.MSGPACK_MIMETYPE]["results"]] == list(range(len(results)))
+        assert jobs[gem5_api.MSGPACK_MIMETYPE]["results"][3]["result"]["gem5"]["0"]["stats"] == {"sim_seconds": 0.002, "sim_seconds_precise": 0.002}
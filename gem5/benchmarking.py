@@ -1,5 +1,6 @@
 import argparse
 import pandas as pd
+import numpy as np
 import shutil
 import os
 import warnings
@@ -11,14 +12,17 @@ import re
 import traceback
 import time
 import shlex
-from typing import Optional, List, Tuple, Dict, Any, Union
+from typing import Optional, List, Tuple, Dict, Any, Union, Iterable
 import multiprocessing
 from collections import defaultdict
 import json 
 import resource
 import re
-import ast
+import hashlib
+import sqlite3
+import functools
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger("resource").setLevel(logging.DEBUG)
@@ -50,22 +54,128 @@ def get_accuracy(output: str, ground_truth: str) -> float:
 
     return num_correct / len(ground_truth_lines)
 
-def compile_cpp_code(code_path: str, timeout: int = 30, output_path: str = None, cflags: str = "--std=c++17 -O3", cpu_number: Optional[int] = None) -> str:
-    """_summary_
+CXX_PATH = "/usr/bin/g++"
+
+@functools.lru_cache(maxsize=None)
+def get_compiler_version(cxx_path: str = CXX_PATH) -> str:
+    p = subprocess.run([cxx_path, "--version"], capture_output=True, text=True)
+    return p.stdout.strip()
+
+
+class CompileCache:
+    """
+    Persistent, content-addressed cache of compiled binaries.
+    
+    Binaries are keyed by a hash of (source, cflags, compiler version) and stored as flat files in cache_dir;
+    the modification time of each entry is bumped on every hit, so that eviction can drop the least recently used
+    entries once the cache grows beyond max_size_bytes. The hit/miss counters live in shared memory so that
+    they are aggregated over all of the (forked) worker processes.
+    """
+    def __init__(self, cache_dir: str, max_size_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hits = multiprocessing.Value("i", 0)
+        self._misses = multiprocessing.Value("i", 0)
+        self._evictions = multiprocessing.Value("i", 0)
+    
+    def make_key(self, code_path: str, cflags: str) -> str:
+        h = hashlib.sha256()
+        with open(code_path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0" + cflags.encode("utf-8"))
+        h.update(b"\0" + get_compiler_version().encode("utf-8"))
+        return h.hexdigest()
+    
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.out")
+    
+    def get(self, key: str, output_path: str) -> bool:
+        """copies the cached binary to output_path, returns False on a miss"""
+        entry_path = self._entry_path(key)
+        try:
+            shutil.copy2(entry_path, output_path)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._misses.get_lock():
+                self._misses.value += 1
+            return False
+        with self._hits.get_lock():
+            self._hits.value += 1
+        return True
+    
+    def put(self, key: str, bin_path: str):
+        # write to a temporary file first and rename, so that concurrent readers never see a partial binary
+        tmp_path = self._entry_path(key) + f".{os.getpid()}.tmp"
+        shutil.copy2(bin_path, tmp_path)
+        os.replace(tmp_path, self._entry_path(key))
+        self.evict()
+    
+    def size_bytes(self) -> int:
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith(".out"))
+    
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".out"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError: # evicted concurrently by another worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total_size -= size
+            with self._evictions.get_lock():
+                self._evictions.value += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"hits": self._hits.value,
+                "misses": self._misses.value,
+                "evictions": self._evictions.value,
+                "size_bytes": self.size_bytes(),
+                "max_size_bytes": self.max_size_bytes}
+
+
+COMPILE_CACHE: Optional[CompileCache] = None # set with init_compile_cache, disabled by default
+
+def init_compile_cache(cache_dir: str, max_size_bytes: int = 2 * 1024 ** 3) -> CompileCache:
+    global COMPILE_CACHE
+    COMPILE_CACHE = CompileCache(cache_dir, max_size_bytes)
+    logging.info(f"Initialized compile cache in {cache_dir} with max size {max_size_bytes} bytes")
+    return COMPILE_CACHE
+
+
+def compile_cpp_code(code_path: str, timeout: int = 30, output_path: str = None, cflags: str = "--std=c++17 -O3", cpu_number: Optional[int] = None, use_cache: bool = True) -> str:
+    """
+    Compiles code_path with g++, consulting the COMPILE_CACHE first if it has been initialized.
 
     Args:
-        code_path (str): _description_
-        output_path (str, optional): _description_
-        cflags (str, optional): _description_
+        code_path (str): path to the .cpp file
+        output_path (str, optional): path of the binary, defaults to code_path with the .out extension
+        cflags (str, optional): flags passed to g++
+        use_cache (bool, optional): set to False to bypass the compile cache, e.g. for sources with embedded temporary paths
     
     Returns:
-        str: _description_
+        str: the path to the compiled binary
     """
     if output_path is None:
         output_path = os.path.join(os.path.dirname(code_path), f"{os.path.splitext(os.path.basename(code_path))[0]}.out")
+    cache_key = None
+    if use_cache and COMPILE_CACHE is not None:
+        cache_key = COMPILE_CACHE.make_key(code_path, cflags)
+        if COMPILE_CACHE.get(cache_key, output_path):
+            logging.info(f"Compile cache hit for {code_path} with key {cache_key}")
+            return output_path
     cpu_cmd = f"taskset --cpu-list {cpu_number}" if cpu_number is not None else ""
         
-    cmd = shlex.split(cpu_cmd) + ["/usr/bin/g++", code_path, "-o", output_path] + shlex.split(cflags.replace('"', "").replace("'", ""))
+    cmd = shlex.split(cpu_cmd) + [CXX_PATH, code_path, "-o", output_path] + shlex.split(cflags.replace('"', "").replace("'", ""))
     logging.critical(f"Running command: {' '.join(cmd)}")
     p = subprocess.run(cmd, capture_output=True, timeout=timeout, text=True)
     if p.returncode != 0:
@@ -74,6 +184,8 @@ def compile_cpp_code(code_path: str, timeout: int = 30, output_path: str = None,
         # sometimes there can be latency in the file system, so we wait a bit
         while(not os.path.exists(output_path)):
             time.sleep(0.05)
+    if cache_key is not None:
+        COMPILE_CACHE.put(cache_key, output_path)
     return output_path
 
 def exec_bin(bin_path, in_path, timeout, cpu_number=None):
@@ -104,17 +216,67 @@ def exec_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, in_path, stats_out
         p = subprocess.run(cmd, capture_output=True, timeout=timeout, text=True)
     return p.returncode, p.stdout, p.stderr
     
-def exec_bin_for_acc(bin_path, in_path, ground_truth_output, timeout=None):
+def exec_bin_for_acc(bin_path, in_path, ground_truth_output, timeout=None, max_memory_bytes: Optional[int] = None):
     logging.info(f'executing {bin_path}, with input {in_path}')
+    args = [bin_path]
+    if max_memory_bytes: 
+        # prlimit instead of a preexec_fn, which is not safe to use when running from several threads
+        args = ["prlimit", f"--as={max_memory_bytes}", "--"] + args
     with open(in_path, 'r') as fh:
-        p = subprocess.run([bin_path], capture_output=True, timeout=timeout, stdin=fh, text=True)
+        p = subprocess.run(args, capture_output=True, timeout=timeout, stdin=fh, text=True)
     if p.returncode != 0:
-        raise Exception(f"Error executing code: {bin_path}, return code: {p.returncode}, stderr: {p.stderr.decode('utf-8')}")
+        raise Exception(f"Error executing code: {bin_path}, return code: {p.returncode}, stderr: {p.stderr}")
     else: 
         return get_accuracy(p.stdout, ground_truth_output)
     
-def compile_and_check_outputs(code_path, problem_id, testcases_dir, timeout=None, cflags: str ="--std=c++17 -O3", testcases: List[int] = None, cpu_number=None):
+def order_testcases_by_runtime(problem_id: str, input_output_pairs: Dict[str, Tuple[str, str]]) -> List[str]:
+    """
+    orders the testcases shortest first, by their historical native runtime in the GEM5_RESULT_STORE if known, 
+    falling back to the size of the input file for testcases that have not been run yet
+    """
+    tc2runtime = GEM5_RESULT_STORE.get_runtimes(problem_id, "native") if GEM5_RESULT_STORE is not None else {}
+    def _sort_key(tc_no):
+        runtime = tc2runtime.get(int(tc_no))
+        return (runtime is None, runtime if runtime is not None else os.path.getsize(input_output_pairs[tc_no][0]))
+    return sorted(input_output_pairs.keys(), key=_sort_key)
+    
+def check_testcase_output(bin_path, tc_no, in_path, out_path, timeout=None, max_memory_bytes: Optional[int] = None) -> Tuple[str, float, Optional[float]]:
+    """
+    runs the binary on a single testcase, returning (tc_no, accuracy, wall time in seconds or None if the run failed)
+    """
+    with open(out_path, 'r') as fh:
+        ground_truth_output = fh.read().strip()
+    try:
+        start_time = time.perf_counter()
+        acc = exec_bin_for_acc(bin_path, in_path, ground_truth_output, timeout, max_memory_bytes=max_memory_bytes)
+        return tc_no, acc, time.perf_counter() - start_time
+    except Exception as e:
+        logging.error(f"Error executing code: {bin_path} with input: {in_path}, error: {e}")
+        return tc_no, 0, None
+    
+def mean_accuracy(accs: Dict[str, Optional[float]]) -> float:
+    """
+    mean accuracy over the testcases that were checked, the ones skipped by an early exit (None) are left out; 
+    an early exit only happens once the mean of the checked testcases is below the threshold, so skipping stays skipping
+    """
+    checked = [acc for acc in accs.values() if acc is not None]
+    return float(np.mean(checked)) if len(checked) > 0 else 0.0
+
+def compile_and_check_outputs(code_path, problem_id, testcases_dir, timeout=None, cflags: str ="--std=c++17 -O3", testcases: List[int] = None, cpu_number=None, 
+                              early_exit_acc_threshold: Optional[float] = None, n_workers: int = 1, max_memory_bytes: Optional[int] = None, 
+                              return_native_times: bool = False):
+    """
+    compiles the code and checks its outputs on the testcases, returning the binary path (None if compilation failed) and the accuracy per testcase
     
+    if early_exit_acc_threshold is set, the testcases are run shortest first and checking stops as soon as the mean accuracy 
+    can no longer reach the threshold; the testcases that were not run get an accuracy of None, use mean_accuracy to average them out
+    
+    the outputs are only checked for correctness, not timed, so up to n_workers testcases are run concurrently; 
+    each run is bounded by timeout and, if set, by max_memory_bytes of virtual memory
+    
+    if return_native_times is True, the wall times in seconds of the correct runs are returned as a third element {tc_no (int): seconds}; 
+    the runs are only timed if they are not concurrent, as the wall times of concurrent runs are inflated by each other
+    """
     input_output_pairs = {}
     input_paths = glob.glob(os.path.join(testcases_dir, problem_id, f"input.*.txt"))
     for in_path in input_paths:
@@ -128,22 +290,64 @@ def compile_and_check_outputs(code_path, problem_id, testcases_dir, timeout=None
         bin_path = compile_cpp_code(code_path, timeout, cflags=cflags, cpu_number=cpu_number)
         logging.info(f"Compiled {code_path} to {bin_path}")
     except Exception as e:
-        return None, {tc_no: 0 for tc_no in input_output_pairs.keys()}
+        accs = {tc_no: 0 for tc_no in input_output_pairs.keys()}
+        return (None, accs, {}) if return_native_times else (None, accs)
     
     accs = {}    
+    tc2native_time = {}
     
-    for tc_no, (in_path, out_path) in input_output_pairs.items():
-        with open(out_path, 'r') as fh:
-            ground_truth_output = fh.read().strip()
-        try:
-            acc = exec_bin_for_acc(bin_path, in_path, ground_truth_output, timeout)
-            accs[tc_no] = acc
+    if early_exit_acc_threshold is not None:
+        tc_order = order_testcases_by_runtime(problem_id, input_output_pairs)
+    else: 
+        tc_order = list(input_output_pairs.keys())
+        
+    def _can_reach_threshold():
+        if early_exit_acc_threshold is None:
+            return True
+        n_remaining = len(tc_order) - len(accs)
+        max_mean_acc = (sum(accs.values()) + n_remaining) / len(tc_order)
+        if n_remaining > 0 and max_mean_acc < early_exit_acc_threshold:
+            logging.info(f"Mean accuracy of {bin_path} can be at most {max_mean_acc} < {early_exit_acc_threshold}, skipping the remaining {n_remaining} testcases")
+            return False
+        return True
+    
+    run_concurrently = n_workers > 1 and len(tc_order) > 1
+    
+    def _add_result(tc_no, acc, seconds):
+        accs[tc_no] = acc
+        # a wrong answer can exit long before a correct one would, so its wall time is not a runtime of the program
+        if seconds is not None and acc == 1 and not run_concurrently:
+            tc2native_time[int(tc_no)] = seconds
+        
+    if run_concurrently:
+        # when checking stops early the queued testcases are cancelled, leaving the executor to wait only on the ones already running 
+        # (at most n_workers, each bounded by the timeout) so that none outlives the binary in the caller's temporary directory
+        with ThreadPoolExecutor(max_workers=min(n_workers, len(tc_order))) as executor:
+            futures = [executor.submit(check_testcase_output, bin_path, tc_no, *input_output_pairs[tc_no], timeout, max_memory_bytes) for tc_no in tc_order]
+            for future in as_completed(futures):
+                _add_result(*future.result())
+                if not _can_reach_threshold():
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    else: 
+        for tc_no in tc_order:
+            _add_result(*check_testcase_output(bin_path, tc_no, *input_output_pairs[tc_no], timeout, max_memory_bytes))
+            if not _can_reach_threshold():
+                break
+    # keep the original order of the testcases, the ones skipped by the early exit are unknown rather than failed
+    accs = {tc_no: accs.get(tc_no) for tc_no in input_output_pairs.keys()}
+    
+    if GEM5_RESULT_STORE is not None and len(tc2native_time) > 0:
+        try: 
+            GEM5_RESULT_STORE.record_runtimes(problem_id, "native", tc2native_time, bin_sha256=file_sha256(bin_path))
         except Exception as e:
-            logging.error(f"Error executing code: {bin_path} with input: {in_path}, error: {e}")
-            accs[tc_no] = 0
+            logging.warning(f"could not record the native runtimes in the gem5 result store: {e}")
             
     logging.info(f"bin_path: {bin_path}, accs: {accs}")
-            
+    
+    if return_native_times:
+        return bin_path, accs, tc2native_time
     return bin_path, accs
 
 def compile_and_check_outputs_multi(
@@ -169,47 +373,232 @@ def calc_sim_seconds(stats):
     return float(stats["sim_ticks"]) / float(stats["sim_freq"]) # more accurate than sim_seconds
 
 
-def parse_stats_txt(stats_path):
-    with open(stats_path, 'r') as f:
-        stats_lines = f.readlines()
+# sim_seconds_precise is computed from these, so they are parsed even if not requested
+REQUIRED_STATS_KEYS = ("sim_ticks", "sim_freq")
+STATS_NONE_VALUES = frozenset(("nan", "inf", "-inf", "+inf"))
+
+def parse_stats_value(value: str):
+    value = value.replace("%", "")
+    if value in STATS_NONE_VALUES:
+        return None
+    try: 
+        return int(value)
+    except ValueError:
+        pass
+    try: 
+        return float(value)
+    except ValueError:
+        logging.warning(f"could not parse value {value}")
+        return value
     
+
+def parse_stats_txt(stats_path, keys: Optional[Iterable[str]] = None, columnar: bool = False):
+    """
+    parses a gem5 stats.txt in a single pass; if keys is given, only those stats (and sim_seconds_precise) are parsed and returned
+    
+    if columnar is True, the stats are returned as a numpy structured array with one row per value, 
+    see stats_to_columnar
+    """
+    if keys is not None: 
+        keys = set(keys).union(REQUIRED_STATS_KEYS)
     stats = {}
-    for line in stats_lines:
-        if line.strip() == '':
-            continue
-        if "Begin" in line:
-            continue
-        if "End" in line:
-            continue
-        line = re.sub("#.*", "", line).strip() # remove comments
-        parts = line.split()
-        parts = [part.strip() for part in parts]
-        if len(parts) > 2: 
-            value = parts[1:]
-        elif len(parts) == 2:
-            value = parts[1]
-        else: 
-            logging.warn(f'could not parse line {line}')
-            continue
-        key = parts[0]
-        if isinstance(value, str): 
-            try: 
-                value = value.replace("%", "").replace("nan", "None").replace("inf", "None").replace("-inf", "None")
-                value = ast.literal_eval(value) if value != "None" else None
-            except:
-                logging.warn(f"could not parse value {value} for key {key}")
-        elif isinstance(value, list):
-            try: 
-                value = [v.replace("%", "").replace("nan", "None").replace("inf", "None").replace("-inf", "None") for v in value]
-                value = [ast.literal_eval(v) if v != "None" else None for v in value]
-            except:
-                logging.warn(f"could not parse value {value} for key {key}")
-        stats[key] = value
+    with open(stats_path, 'r') as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split() # remove comments
+            if len(parts) == 0 or parts[0].startswith("-----"): # blank lines and the Begin/End Simulation Statistics markers
+                continue
+            key = parts[0]
+            if keys is not None and key not in keys:
+                continue
+            if len(parts) > 2: 
+                stats[key] = [parse_stats_value(part) for part in parts[1:]]
+            elif len(parts) == 2:
+                stats[key] = parse_stats_value(parts[1])
+            else: 
+                logging.warning(f'could not parse line {line}')
     stats["sim_seconds_precise"] = calc_sim_seconds(stats)
+    if columnar:
+        return stats_to_columnar(stats)
     return stats
      
 
-def run_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, problem_id, testcases_dir, timeout, testcases: List[int] = None, cpu_number=None, exit_early_on_fail=True):
+def normalize_stat_keys(stat_keys: Union[None, str, Iterable[str]]) -> Optional[frozenset]:
+    """
+    None keeps all the stats, "none" keeps only sim_seconds_precise and a list keeps the listed stats and sim_seconds_precise
+    """
+    if stat_keys is None:
+        return None
+    if isinstance(stat_keys, str):
+        if stat_keys.lower() != "none":
+            raise ValueError(f"stat_keys must be None, 'none' or a list of stat names, got {stat_keys}")
+        return frozenset(("sim_seconds_precise",))
+    return frozenset(stat_keys).union(("sim_seconds_precise",))
+
+
+def project_stats(stats: Optional[Dict[str, Any]], stat_keys: Optional[frozenset]) -> Optional[Dict[str, Any]]:
+    if stats is None or stat_keys is None:
+        return stats
+    return {key: value for key, value in stats.items() if key in stat_keys}
+
+
+def project_gem5_result(result: Dict[str, Any], stat_keys: Optional[frozenset]) -> Dict[str, Any]:
+    if stat_keys is None or result.get("stats") is None:
+        return result
+    return {**result, "stats": project_stats(result["stats"], stat_keys)}
+
+
+def stats_to_columnar(stats: Dict[str, Any]) -> np.ndarray:
+    """
+    converts a stats dict to a structured array with the fields key, index (the position in multi-valued stats such as distributions) 
+    and value, where missing and non-numeric values are nan 
+    """
+    rows = []
+    for key, value in stats.items():
+        values = value if isinstance(value, list) else [value]
+        for index, v in enumerate(values):
+            rows.append((key, index, v if isinstance(v, (int, float)) else np.nan))
+    max_key_len = max((len(key) for key in stats), default=1)
+    return np.array(rows, dtype=[("key", f"U{max_key_len}"), ("index", np.int32), ("value", np.float64)])
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _static_file_sha256(path: str, mtime: float) -> str:
+    # test inputs and gem5 configs do not change during a run, so their hashes are memoized per (path, mtime)
+    return file_sha256(path)
+
+
+class Gem5ResultStore:
+    """
+    Persistent SQLite store of successful gem5 results, keyed by 
+    (binary sha256, gem5 config, cpu_type, testcase number, input sha256). 
+    
+    gem5 is deterministic given the binary and the input, so a stored result can be returned in place of re-running
+    the simulation. Failures are never stored, as they may depend on the timeout or on the load of the machine. 
+    Each (forked) worker process opens its own connection, the hit/miss counters are shared between them.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = None
+        self._conn_pid = None
+        self._hits = multiprocessing.Value("i", 0)
+        self._misses = multiprocessing.Value("i", 0)
+        conn = self._connect()
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS gem5_results (
+                                bin_sha256 TEXT NOT NULL, 
+                                gem5_config TEXT NOT NULL, 
+                                cpu_type TEXT NOT NULL, 
+                                tc_no INTEGER NOT NULL, 
+                                input_sha256 TEXT NOT NULL, 
+                                result TEXT NOT NULL, 
+                                PRIMARY KEY (bin_sha256, gem5_config, cpu_type, tc_no, input_sha256))""")
+            # running mean of the wall time of each testcase over all the programs run on it, 
+            # used to order the testcases by their expected cost
+            conn.execute("""CREATE TABLE IF NOT EXISTS testcase_runtimes (
+                                problem_id TEXT NOT NULL, 
+                                tc_no INTEGER NOT NULL, 
+                                kind TEXT NOT NULL, 
+                                n INTEGER NOT NULL, 
+                                mean_seconds REAL NOT NULL, 
+                                PRIMARY KEY (problem_id, tc_no, kind))""")
+            # the same running mean per binary, so that the gem5 and native wall times of the same program are paired 
+            # when calibrating the slowdown factor
+            conn.execute("""CREATE TABLE IF NOT EXISTS binary_runtimes (
+                                bin_sha256 TEXT NOT NULL, 
+                                problem_id TEXT NOT NULL, 
+                                tc_no INTEGER NOT NULL, 
+                                kind TEXT NOT NULL, 
+                                n INTEGER NOT NULL, 
+                                mean_seconds REAL NOT NULL, 
+                                PRIMARY KEY (bin_sha256, problem_id, tc_no, kind))""")
+    
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections must not be shared across a fork
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    @staticmethod
+    def make_gem5_config(gem5_dir: str, gem5_script_path: str) -> str:
+        script_sha256 = _static_file_sha256(gem5_script_path, os.path.getmtime(gem5_script_path))
+        return f"{os.path.join(gem5_dir, 'gem5.opt')}:{gem5_script_path}:{script_sha256}"
+    
+    def make_key(self, bin_sha256: str, gem5_dir: str, gem5_script_path: str, cpu_type: str, tc_no: int, in_path: str) -> Tuple[str, str, str, int, str]:
+        input_sha256 = _static_file_sha256(in_path, os.path.getmtime(in_path))
+        return (bin_sha256, self.make_gem5_config(gem5_dir, gem5_script_path), cpu_type, int(tc_no), input_sha256)
+    
+    def get(self, key: Tuple[str, str, str, int, str]) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("""SELECT result FROM gem5_results WHERE 
+                                         bin_sha256 = ? AND gem5_config = ? AND cpu_type = ? AND tc_no = ? AND input_sha256 = ?""", key).fetchone()
+        counter = self._hits if row is not None else self._misses
+        with counter.get_lock():
+            counter.value += 1
+        return json.loads(row[0]) if row is not None else None
+    
+    def put(self, key: Tuple[str, str, str, int, str], result: Dict[str, Any]):
+        conn = self._connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO gem5_results VALUES (?, ?, ?, ?, ?, ?)", key + (json.dumps(result),))
+    
+    def record_runtimes(self, problem_id: str, kind: str, tc2seconds: Dict[int, float], bin_sha256: Optional[str] = None):
+        """adds the wall times to the running means of the testcases and, if bin_sha256 is given, to those of the binary"""
+        conn = self._connect()
+        with conn:
+            conn.executemany("""INSERT INTO testcase_runtimes VALUES (?, ?, ?, 1, ?) 
+                                ON CONFLICT (problem_id, tc_no, kind) DO UPDATE SET 
+                                mean_seconds = (mean_seconds * n + excluded.mean_seconds) / (n + 1), n = n + 1""", 
+                             [(problem_id, int(tc_no), kind, seconds) for tc_no, seconds in tc2seconds.items()])
+            if bin_sha256 is not None:
+                conn.executemany("""INSERT INTO binary_runtimes VALUES (?, ?, ?, ?, 1, ?) 
+                                    ON CONFLICT (bin_sha256, problem_id, tc_no, kind) DO UPDATE SET 
+                                    mean_seconds = (mean_seconds * n + excluded.mean_seconds) / (n + 1), n = n + 1""", 
+                                 [(bin_sha256, problem_id, int(tc_no), kind, seconds) for tc_no, seconds in tc2seconds.items()])
+    
+    def get_runtimes(self, problem_id: str, kind: str) -> Dict[int, float]:
+        rows = self._connect().execute("SELECT tc_no, mean_seconds FROM testcase_runtimes WHERE problem_id = ? AND kind = ?", (problem_id, kind)).fetchall()
+        return {tc_no: mean_seconds for tc_no, mean_seconds in rows}
+    
+    def slowdown_factor(self) -> Optional[float]:
+        """
+        the ratio of the gem5 to the native wall time over the (binary, testcase) pairs that were run both ways, None if there are none; 
+        the per testcase means are not paired, as they mix the programs that only passed the correctness check with the ones run in gem5
+        """
+        gem5_seconds, native_seconds = self._connect().execute("""SELECT SUM(gem5.mean_seconds), SUM(native.mean_seconds) 
+                                                                  FROM binary_runtimes gem5 JOIN binary_runtimes native 
+                                                                  ON gem5.bin_sha256 = native.bin_sha256 AND gem5.problem_id = native.problem_id 
+                                                                  AND gem5.tc_no = native.tc_no 
+                                                                  WHERE gem5.kind = 'gem5' AND native.kind = 'native'""").fetchone()
+        if not gem5_seconds or not native_seconds:
+            return None
+        return gem5_seconds / native_seconds
+    
+    def stats(self) -> Dict[str, Any]:
+        n_results = self._connect().execute("SELECT COUNT(*) FROM gem5_results").fetchone()[0]
+        return {"hits": self._hits.value,
+                "misses": self._misses.value,
+                "n_results": n_results}
+
+
+GEM5_RESULT_STORE: Optional[Gem5ResultStore] = None # set with init_gem5_result_store, disabled by default
+
+def init_gem5_result_store(db_path: str) -> Gem5ResultStore:
+    global GEM5_RESULT_STORE
+    GEM5_RESULT_STORE = Gem5ResultStore(db_path)
+    logging.info(f"Initialized gem5 result store in {db_path}")
+    return GEM5_RESULT_STORE
+
+
+def get_testcase_input_paths(problem_id: str, testcases_dir: str, testcases: List[int] = None) -> Dict[int, str]:
     input_paths = glob.glob(os.path.join(testcases_dir, problem_id, f"input.*.txt"))
     tc_2_in_path = {}
     logging.info(f"Found {len(input_paths)} total testcases for problem: {problem_id} in testcases_dir: {testcases_dir} with testcases: {testcases}")
@@ -219,29 +608,90 @@ def run_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, problem_id, testcas
             continue
         tc_2_in_path[tc_no] = in_path
     logging.info(f"Found {len(tc_2_in_path)} testcases to actually run for problem: {problem_id} in testcases_dir: {testcases_dir} with testcases: {testcases}")
+    return tc_2_in_path
+
+
+PREDICTED_TIMEOUT_ERROR = "The gem5 runtime predicted from the native runtime exceeds the timeout, so skipping this testcase"
+
+def make_skipped_gem5_result(error: str = "Previous testcase was incorrect or timed out, so skipping this testcase") -> Dict[str, Any]:
+    return {"success": False, "error": error, "stats": None, "stdout": None, "stderr": None, "time": None}
+
+
+def run_gem5_testcase(gem5_dir, gem5_script_path, cpu_type, bin_path, tc_no, in_path, timeout, cpu_number=None, bin_sha256: str = None, use_result_store: bool = True, 
+                      stat_keys: Union[None, str, Iterable[str]] = None, problem_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    runs gem5 on a single testcase, returning a stored result from the GEM5_RESULT_STORE if there is one; 
+    if problem_id is given, the wall time of successful simulations is recorded in the GEM5_RESULT_STORE to schedule later runs
+    
+    only the stats in stat_keys are returned (see normalize_stat_keys), the result store always keeps all of them
+    """
+    stat_keys = normalize_stat_keys(stat_keys)
+    store_key = None
+    if use_result_store and GEM5_RESULT_STORE is not None:
+        try: 
+            if bin_sha256 is None:
+                bin_sha256 = file_sha256(bin_path)
+            store_key = GEM5_RESULT_STORE.make_key(bin_sha256, gem5_dir, gem5_script_path, cpu_type, tc_no, in_path)
+            stored_result = GEM5_RESULT_STORE.get(store_key)
+            if stored_result is not None:
+                logging.info(f"gem5 result store hit for {bin_path} on testcase {tc_no}")
+                return project_gem5_result(stored_result, stat_keys)
+        except Exception as e:
+            logging.warning(f"could not read from the gem5 result store: {e}")
+            store_key = None
+    #### TOOD: MAKE SURE ALL CODE/BINARIES ARE IN UNIQUE DIRECTORIES
+    stats_out_path = os.path.splitext(bin_path)[0] + f".{tc_no}.txt"
+    try: 
+        start_time = time.perf_counter()
+        returncode, stdout, stderr = exec_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, in_path, stats_out_path, timeout, cpu_number=cpu_number)
+        gem5_seconds = time.perf_counter() - start_time
+        if returncode != 0:
+            return {"success": False, "error": f"Error executing code: {bin_path}, return code: {returncode}, stderr: {stderr}", 
+                    "stats": None, "stdout": stdout, "stderr": stderr, "time": None}
+        # the stats are only filtered while parsing if they are not stored
+        stats = parse_stats_txt(stats_out_path, keys=stat_keys if store_key is None else None)
+        result = {"success": True, "error": None, "stats": stats, "stdout": stdout, "stderr": stderr, "time": stats["sim_seconds_precise"]}
+    except Exception as e:
+        traceback_err = traceback.format_exc()
+        return {"success": False, "error": f"Error executing code: {bin_path}, error: {e}, traceback: {traceback_err}", 
+                "stats": None, "stdout": None, "stderr": None, "time": None}
+    if store_key is not None:
+        try: 
+            GEM5_RESULT_STORE.put(store_key, result)
+        except Exception as e:
+            logging.warning(f"could not write to the gem5 result store: {e}")
+    if problem_id is not None and GEM5_RESULT_STORE is not None:
+        try: 
+            GEM5_RESULT_STORE.record_runtimes(problem_id, "gem5", {tc_no: gem5_seconds}, bin_sha256=bin_sha256 or file_sha256(bin_path))
+        except Exception as e:
+            logging.warning(f"could not record the gem5 runtime in the gem5 result store: {e}")
+    return project_gem5_result(result, stat_keys)
+
+
+def run_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, problem_id, testcases_dir, timeout, testcases: List[int] = None, cpu_number=None, exit_early_on_fail=True, 
+             stat_keys: Union[None, str, Iterable[str]] = None, tc2timeout: Optional[Dict[int, Optional[float]]] = None):
+    """
+    runs gem5 on the testcases one after the other; tc2timeout overrides the timeout of the testcases it contains, 
+    where a timeout of None marks a testcase that is predicted to time out and is not run
+    """
+    tc2timeout = tc2timeout or {}
+    tc_2_in_path = get_testcase_input_paths(problem_id, testcases_dir, testcases)
     tc_2_results = {}
     any_incorrect_or_timeout = False
     logging.critical(f"Running {bin_path} on testcases: {tc_2_in_path.keys()}")
+    # hash the binary once for all the lookups in the result store
+    bin_sha256 = file_sha256(bin_path) if GEM5_RESULT_STORE is not None else None
     for tc_no, in_path in tc_2_in_path.items():
         # logging.critical(f"Running {bin_path} on testcase {tc_no} with input {in_path}")
-        #### TOOD: MAKE SURE ALL CODE/BINARIES ARE IN UNIQUE DIRECTORIES
-        stats_out_path = os.path.splitext(bin_path)[0] + f".{tc_no}.txt"
         if exit_early_on_fail and any_incorrect_or_timeout:
-            tc_2_results[tc_no] = {"success": False, "error": "Previous testcase was incorrect or timed out, so skipping this testcase",
-                                   "stats": None, "stdout": None, "stderr": None, "time": None} 
+            tc_2_results[tc_no] = make_skipped_gem5_result()
+        elif tc_no in tc2timeout and tc2timeout[tc_no] is None:
+            tc_2_results[tc_no] = make_skipped_gem5_result(error=PREDICTED_TIMEOUT_ERROR)
+            any_incorrect_or_timeout = True
         else: 
-            try: 
-                returncode, stdout, stderr = exec_gem5(gem5_dir, gem5_script_path, cpu_type, bin_path, in_path, stats_out_path, timeout, cpu_number=cpu_number)
-                if returncode != 0:
-                    tc_2_results[tc_no] = {"success": False, "error": f"Error executing code: {bin_path}, return code: {returncode}, stderr: {stderr.decode('utf-8')}", 
-                                        "stats": None, "stdout": stdout, "stderr": stderr, "time": None}
-                    any_incorrect_or_timeout = True
-                else: 
-                    tc_2_results[tc_no] = {"success": True, "error": None, "stats": parse_stats_txt(stats_out_path), "stdout": stdout, "stderr": stderr, "time": parse_stats_txt(stats_out_path)["sim_seconds_precise"]}
-            except Exception as e:
-                traceback_err = traceback.format_exc()
-                tc_2_results[tc_no] = {"success": False, "error": f"Error executing code: {bin_path}, error: {e}, traceback: {traceback_err}", 
-                                        "stats": None, "stdout": None, "stderr": None, "time": None}
+            tc_timeout = tc2timeout.get(tc_no, timeout)
+            tc_2_results[tc_no] = run_gem5_testcase(gem5_dir, gem5_script_path, cpu_type, bin_path, tc_no, in_path, tc_timeout, cpu_number=cpu_number, bin_sha256=bin_sha256, stat_keys=stat_keys, problem_id=problem_id)
+            if not tc_2_results[tc_no]["success"]:
                 any_incorrect_or_timeout = True
     return tc_2_results     
 
@@ -308,13 +758,21 @@ def redirect_cpp_io_file(code_path, stdin_path, stdout_path=None, new_code_dir=N
 
 def redirect_cpp_io_and_compile(code_path, stdin_path, cpu_number=None, new_code_dir=None, stdout_path=None, cflags="--std=c++17 -O3"): 
     new_code_path, stdout_path = redirect_cpp_io_file(code_path, stdin_path, new_code_dir, stdout_path)
-    new_binary_path = compile_cpp_code(new_code_path, cpu_number=cpu_number, cflags=cflags)
+    # the redirected source embeds temporary paths, so it would never hit the compile cache
+    new_binary_path = compile_cpp_code(new_code_path, cpu_number=cpu_number, cflags=cflags, use_cache=False)
     return new_binary_path, new_code_path, stdout_path
 
     
 ## physical / logical cpu management
 
+def get_available_cpus() -> List[int]:
+    """the logical cpus this process may run on, e.g. the cpuset of the container, which can be fewer than the cpus of the host"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
 def get_physical_cpu_list():
+    allowed_cpus = set(get_available_cpus())
     cmd = " grep -E '^processor|^physical id|^core id' /proc/cpuinfo "
     output = os.popen(cmd).read()
     output = output.split("processor")
@@ -324,6 +782,9 @@ def get_physical_cpu_list():
     for cpu_info in output:
         logical_id = re.search("(?<=\t: )\d+", cpu_info).group(0)
         physical_id = re.search("(?<=core id\t\t: )\d+", cpu_info).group(0)
+        # cpus outside of the cpuset cannot be pinned with taskset
+        if int(logical_id) not in allowed_cpus:
+            continue
         physical2logical[int(physical_id)].append(int(logical_id))
         n_logical += 1
     n_physical = len(physical2logical)
@@ -338,13 +799,14 @@ def get_physical_cpu_list():
     return unique_logical_ids
 
 def add_logicial_cpus_to_queue(num_processes, queue):
-    highest_num_processes = multiprocessing.cpu_count() 
+    allowed_cpus = get_available_cpus()
+    highest_num_processes = len(allowed_cpus)
     if num_processes < 0: 
         num_processes = highest_num_processes
     else: 
         if num_processes > highest_num_processes:
-            raise ValueError(f"num_processes {num_processes} is greater than the highest available cpu: {highest_num_processes}.")
-    available_cpus = list(range(num_processes))
+            raise ValueError(f"num_processes {num_processes} is greater than the number of available cpus: {highest_num_processes}.")
+    available_cpus = allowed_cpus[:num_processes]
     if len(available_cpus) > 2: 
         available_cpus = available_cpus[:-2]
     else: 
@@ -367,7 +829,7 @@ def add_physical_cpus_to_queue(num_processes, queue):
     for cpu_id in available_cpus[:num_processes]:
         queue.put(cpu_id)
     logging.info(f"List of cpus to be used: {available_cpus[:num_processes]}")
-    return available_cpus
+    return available_cpus[:num_processes]
 
 def run_benchmark(args, json_output_path, timeout_seconds: int = 60) -> Union[str, None]:
     try: 
@@ -407,20 +869,34 @@ def run_hyperfine(code_paths: List[str],
                    warmup_runs_per_test_case: int = 5,
                    cpu_number: int = None, 
                    do_sanity_check: bool = False, 
-                   cflags: str = "--std=c++17 -O3"):
+                   cflags: Union[str, List[str]] = "--std=c++17 -O3",
+                   compile_once: bool = False, 
+                   bin_paths: List[Optional[str]] = None):
     """
     will benchmark all in 1 json / 1 run of hyperfine, all on the same cpu
+    
+    cflags is either shared by all codes or a list with the flags of each code in code_paths
+    
+    if compile_once, each code is compiled a single time and the test inputs are fed through stdin, 
+    see run_hyperfine_compile_once, which also reuses bin_paths if given
     """
     
     ### TODO: need to change to handle compilation errors and timeouts
     
+    if compile_once:
+        return run_hyperfine_compile_once(code_paths, problem_ids, path_to_testcases, json_out_path, test_cases_list,
+                                          min_runs_per_test_case, max_runs_per_test_case, strict_runs_per_test_case,
+                                          warmup_runs_per_test_case, cpu_number, do_sanity_check, cflags, bin_paths)
+    
     code2benchmarks = defaultdict(list)
     benchmark2code = {}
     code2results = defaultdict(dict)
     code2testcases = defaultdict(list)
     if test_cases_list is None: 
         test_cases_list = [None] * len(code_paths)
-    for code_path, problem_id, test_case_list in zip(code_paths, problem_ids, test_cases_list):
+    if isinstance(cflags, str):
+        cflags = [cflags] * len(code_paths)
+    for code_path, problem_id, test_case_list, code_cflags in zip(code_paths, problem_ids, test_cases_list, cflags):
         problem_dir = os.path.join(path_to_testcases, problem_id)
         testcases_paths = glob.glob(os.path.join(problem_dir, "input.*.txt"))
         if test_case_list is not None:
@@ -431,23 +907,13 @@ def run_hyperfine(code_paths: List[str],
             bin_redirect, code_redirect, _ = redirect_cpp_io_and_compile(code_path, 
                                                                          testcase_path, 
                                                                          cpu_number=cpu_number, 
-                                                                         cflags=cflags)
+                                                                         cflags=code_cflags)
             code2benchmarks[code_path].append(bin_redirect)
             benchmark2code[bin_redirect] = code_path
     
     cmds = " ".join([bin_redirect for bin_redirects in code2benchmarks.values() for bin_redirect in bin_redirects])
     n_cmds = len(cmds.split(" "))
-    if strict_runs_per_test_case:
-        assert min_runs_per_test_case is not None 
-        runs_str = f" --runs {min_runs_per_test_case}"
-    else: 
-        runs_str = ""
-        if min_runs_per_test_case is not None: 
-            runs_str += f" --min-runs {min_runs_per_test_case}"
-        if max_runs_per_test_case is not None:
-            runs_str += f" --max-runs {max_runs_per_test_case}"
-    if warmup_runs_per_test_case is not None:
-        runs_str += f" --warmup {warmup_runs_per_test_case}"
+    runs_str = make_hyperfine_runs_str(min_runs_per_test_case, max_runs_per_test_case, strict_runs_per_test_case, warmup_runs_per_test_case)
     
     cmd_benchmark = (
         f"hyperfine {runs_str} -N {cmds}  --export-json {json_out_path} "
@@ -474,7 +940,97 @@ def run_hyperfine(code_paths: List[str],
         for tc_no in missing_tcs:
             results[tc_no] = None
     return code2results, output
-        
-        
-        
+
+
+def make_hyperfine_runs_str(min_runs_per_test_case: int = None, 
+                            max_runs_per_test_case: int = None, 
+                            strict_runs_per_test_case: bool = False, 
+                            warmup_runs_per_test_case: int = 5) -> str:
+    if strict_runs_per_test_case:
+        assert min_runs_per_test_case is not None 
+        runs_str = f" --runs {min_runs_per_test_case}"
+    else: 
+        runs_str = ""
+        if min_runs_per_test_case is not None: 
+            runs_str += f" --min-runs {min_runs_per_test_case}"
+        if max_runs_per_test_case is not None:
+            runs_str += f" --max-runs {max_runs_per_test_case}"
+    if warmup_runs_per_test_case is not None:
+        runs_str += f" --warmup {warmup_runs_per_test_case}"
+    return runs_str
+
+
+def run_hyperfine_compile_once(code_paths: List[str], 
+                               problem_ids: List[str], 
+                               path_to_testcases: str,
+                               json_out_path: str,
+                               test_cases_list: List[int] = None,
+                               min_runs_per_test_case: int = None, 
+                               max_runs_per_test_case: int = None,
+                               strict_runs_per_test_case: bool = False,
+                               warmup_runs_per_test_case: int = 5,
+                               cpu_number: int = None, 
+                               do_sanity_check: bool = False, 
+                               cflags: Union[str, List[str]] = "--std=c++17 -O3", 
+                               bin_paths: List[Optional[str]] = None):
+    """
+    compiles every code once and feeds each test input through stdin with hyperfine's --input (hyperfine >= 1.16), 
+    instead of compiling one binary with redirected io per test case. 
+    
+    bin_paths are the binaries already compiled from code_paths with cflags (e.g. by compile_and_check_outputs), None for 
+    the codes that did not compile; they are benchmarked as they are instead of being compiled again. 
+    
+    all codes reading the same input file are benchmarked in 1 run of hyperfine, all on the same cpu; 
+    the returned code2results has the same format as run_hyperfine, with None results for the codes that did not compile
+    """
+    code2bin = {}
+    code2results = defaultdict(dict)
+    in_path2benchmarks = defaultdict(list)
+    if test_cases_list is None: 
+        test_cases_list = [None] * len(code_paths)
+    if isinstance(cflags, str):
+        cflags = [cflags] * len(code_paths)
+    if bin_paths is None:
+        bin_paths = [None] * len(code_paths)
+        for i, (code_path, code_cflags) in enumerate(zip(code_paths, cflags)):
+            try: 
+                bin_paths[i] = compile_cpp_code(code_path, cpu_number=cpu_number, cflags=code_cflags)
+            except Exception as e:
+                logging.error(f"Error compiling {code_path} for hyperfine: {e}")
+    for code_path, bin_path, problem_id, test_case_list in zip(code_paths, bin_paths, problem_ids, test_cases_list):
+        problem_dir = os.path.join(path_to_testcases, problem_id)
+        testcases_paths = glob.glob(os.path.join(problem_dir, "input.*.txt"))
+        if test_case_list is not None:
+            testcases_paths = [t for t in testcases_paths if int(re.search("(?<=input\.)\d+", t).group(0)) in test_case_list]
+        code2bin[code_path] = bin_path
+        for testcase_path in testcases_paths:
+            tc_no = int(re.search("(?<=input\.)\d+", testcase_path).group(0))
+            code2results[code_path][tc_no] = None # overwritten below if the benchmark succeeds
+            if bin_path is not None:
+                in_path2benchmarks[testcase_path].append((code_path, tc_no))
     
+    runs_str = make_hyperfine_runs_str(min_runs_per_test_case, max_runs_per_test_case, strict_runs_per_test_case, warmup_runs_per_test_case)
+    json_out_stem = os.path.splitext(json_out_path)[0]
+    outputs = []
+    for i, (in_path, benchmarks) in enumerate(in_path2benchmarks.items()):
+        cmds = " ".join([code2bin[code_path] for code_path, _ in benchmarks])
+        in_path_json_out_path = f"{json_out_stem}.{i}.json"
+        cmd_benchmark = (
+            f"hyperfine {runs_str} -N --input {in_path} {cmds}  --export-json {in_path_json_out_path} "
+        )
+        if cpu_number is not None:
+            cmd_benchmark = f"taskset --cpu-list {cpu_number} {cmd_benchmark}"
+        if do_sanity_check: 
+            SANITY_CHECK_TIMEOUT = 1.5 * len(benchmarks)
+            cmd_sanity_check = cmd_benchmark.replace(runs_str, f" --runs 2 --warmup 1 ") 
+            p = subprocess.run(shlex.split(cmd_sanity_check), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=SANITY_CHECK_TIMEOUT, encoding="utf-8")
+            if p.returncode != 0:
+                return None, f"Sanity check failed for {cmd_sanity_check}: {p.stderr}"
+        results, output = run_benchmark(shlex.split(cmd_benchmark), in_path_json_out_path)
+        outputs.append(output)
+        if results is None:
+            continue
+        # hyperfine reports the results in the order of the commands
+        for (code_path, tc_no), result in zip(benchmarks, results):
+            code2results[code_path][tc_no] = result
+    return code2results, "\n".join([str(output) for output in outputs])
@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from werkzeug.serving import WSGIRequestHandler
 import argparse
 import json
 import logging
@@ -12,6 +13,17 @@ import numpy as np
 import joblib
 from tqdm import tqdm
 import contextlib
+import sqlite3
+import threading
+import time
+import uuid
+import queue
+import collections
+import signal
+try: 
+    import msgpack
+except ImportError: 
+    msgpack = None
 
 LOGGING_DIR="/home/logs/"
 if not os.path.exists(LOGGING_DIR): 
@@ -43,11 +55,15 @@ app = Flask(__name__)
 
 
 global MANAGER
-global QUEUE
+global CPU_ALLOCATOR
 global N_CPUS
+global JOB_STORE
 MANAGER = ...
-QUEUE = ...
+CPU_ALLOCATOR = ...
 N_CPUS=... # Will be set in init_globals after parse_args()
+JOB_STORE = None # Will be set in __main__ if the job queue is enabled
+
+JOB_TERMINAL_STATUSES = ("completed", "cancelled", "failed")
 
 @contextlib.contextmanager
 def tqdm_joblib(tqdm_object):
@@ -66,18 +82,129 @@ def tqdm_joblib(tqdm_object):
         tqdm_object.close()
         
 
-def init_globals(n_workers: int = -1, use_logical_cpus: bool = False): 
+def isolate_process_group():
+    """
+    makes the calling worker the leader of a new process group and kills the whole group on SIGTERM, so that terminating 
+    the pool (a cancelled job or a disconnected stream) also stops the gem5, hyperfine and binary subprocesses of the worker 
+    instead of leaving them running on the cpus that are handed out to the next submissions
+    """
+    if os.getpgid(0) == os.getpid():
+        return
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, _kill_process_group)
+
+
+def _kill_process_group(signum, frame):
+    os.killpg(os.getpid(), signal.SIGKILL)
+
+
+class CpuAllocator:
+    """
+    Lease-based allocator of the cpus used for pinning, shared between the worker processes through the manager. 
+    
+    Use `with cpu_allocator.lease() as cpu_number:` so that the cpu is always given back, including on early returns and 
+    exceptions. Leases held by processes that died (e.g. terminated pool workers) are reclaimed once the process group of 
+    the holder is killed, so that its orphaned gem5 or hyperfine subprocesses do not keep running on the cpu; leases held 
+    for longer than lease_timeout seconds are reclaimed if it is set, and a release of an already reclaimed lease is a no-op. 
+    """
+    def __init__(self, manager, cpu_queue, cpu_list, lease_timeout: float = None, poll_interval: float = 5.0):
+        self.cpu_queue = cpu_queue # pre-filled with the cpus in cpu_list
+        self.cpu_list = list(cpu_list)
+        self.leases = manager.dict()
+        self.lock = manager.Lock()
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.owner_pid = os.getpid()
+    
+    def acquire(self):
+        # the workers that hold leases lead their own process group, which is killed if they die while holding one
+        if os.getpid() != self.owner_pid:
+            isolate_process_group()
+        while True:
+            try: 
+                cpu_number = self.cpu_queue.get(block=True, timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                self.reap_expired()
+        lease_id = uuid.uuid4().hex
+        with self.lock:
+            self.leases[cpu_number] = {"lease_id": lease_id, "pid": os.getpid(), "pgid": os.getpgid(0), "acquired_at": time.time()}
+        return cpu_number, lease_id
+    
+    def release(self, cpu_number, lease_id):
+        with self.lock:
+            lease = self.leases.get(cpu_number)
+            if lease is None or lease["lease_id"] != lease_id:
+                logging.warning(f"lease {lease_id} on cpu {cpu_number} was already reclaimed")
+                return
+            del self.leases[cpu_number]
+            self.cpu_queue.put(cpu_number)
+    
+    @contextlib.contextmanager
+    def lease(self):
+        cpu_number, lease_id = self.acquire()
+        try: 
+            yield cpu_number
+        finally: 
+            self.release(cpu_number, lease_id)
+    
+    @staticmethod
+    def _is_alive(pid):
+        try: 
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    
+    @staticmethod
+    def _kill_process_group(pgid):
+        try: 
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    
+    def reap_expired(self):
+        now = time.time()
+        with self.lock:
+            for cpu_number, lease in list(self.leases.items()):
+                is_expired = self.lease_timeout is not None and now - lease["acquired_at"] > self.lease_timeout
+                is_dead = not self._is_alive(lease["pid"])
+                if is_expired or is_dead:
+                    logging.warning(f"reclaiming cpu {cpu_number} from lease {lease}")
+                    if is_dead and lease.get("pgid") == lease["pid"]:
+                        self._kill_process_group(lease["pgid"])
+                    del self.leases[cpu_number]
+                    self.cpu_queue.put(cpu_number)
+    
+    def status(self):
+        self.reap_expired()
+        now = time.time()
+        leases = dict(self.leases.items())
+        return {"n_cpus": len(self.cpu_list), 
+                "free": [cpu_number for cpu_number in self.cpu_list if cpu_number not in leases], 
+                "held": {cpu_number: {"pid": lease["pid"], "held_seconds": now - lease["acquired_at"]} for cpu_number, lease in leases.items()}}
+
+
+def init_globals(n_workers: int = -1, use_logical_cpus: bool = False, compile_cache_dir: str = None, compile_cache_max_mb: int = 0, gem5_result_store_path: str = None, cpu_lease_timeout: float = None): 
     global MANAGER
-    global QUEUE 
+    global CPU_ALLOCATOR 
     global N_CPUS
     
     MANAGER = multiprocessing.Manager()
-    QUEUE = MANAGER.Queue()
+    cpu_queue = MANAGER.Queue()
     if use_logical_cpus: 
-        cpu_list = benchmarking.add_logicial_cpus_to_queue(n_workers, QUEUE)
+        cpu_list = benchmarking.add_logicial_cpus_to_queue(n_workers, cpu_queue)
     else: 
-        cpu_list = benchmarking.add_physical_cpus_to_queue(n_workers, QUEUE)
+        cpu_list = benchmarking.add_physical_cpus_to_queue(n_workers, cpu_queue)
+    CPU_ALLOCATOR = CpuAllocator(MANAGER, cpu_queue, cpu_list, lease_timeout=cpu_lease_timeout)
     N_CPUS = len(cpu_list)
+    if compile_cache_dir is not None and compile_cache_max_mb > 0:
+        # must be initialized before the worker processes are forked, so that they share the hit/miss counters
+        benchmarking.init_compile_cache(compile_cache_dir, compile_cache_max_mb * 1024 * 1024)
+    if gem5_result_store_path is not None:
+        benchmarking.init_gem5_result_store(gem5_result_store_path)
     print(f"Initialized globals with {N_CPUS} cpus")
     return None
 
@@ -93,6 +220,17 @@ def parse_args():
     parser.add_argument('--gem5_acc_threshold', type=float, default=0.95, help="mean threshold where if below this, we do not run gem5")
     parser.add_argument('--debug',  default=False, action="store_true")
     parser.add_argument('--exit_early_on_fail', action="store_true")
+    parser.add_argument('--correctness_workers', type=int, default=1, help="number of testcases whose outputs are checked concurrently for each submission")
+    parser.add_argument('--correctness_max_memory_mb', type=int, default=0, help="virtual memory limit of each output check in MB, 0 for no limit")
+    parser.add_argument('--gem5_slowdown_factor', type=float, default=None, help="ratio of the gem5 to the native runtime used for predictions, calibrated from the gem5 result store if not set")
+    parser.add_argument('--preskip_gem5_timeouts', action="store_true", help="do not run gem5 on testcases whose predicted gem5 runtime exceeds gem5_timeout_margin times the timeout")
+    parser.add_argument('--scale_gem5_timeouts', action="store_true", help="set the gem5 timeout of each testcase to gem5_timeout_margin times its predicted runtime, between min_scaled_gem5_timeout and timeout_seconds_gem5")
+    parser.add_argument('--gem5_timeout_margin', type=float, default=3.0)
+    parser.add_argument('--min_scaled_gem5_timeout', type=float, default=10.0)
+    parser.add_argument('--longest_job_first', action="store_true", help="start the submissions (or with parallelize_testcases, the testcases) with the longest expected gem5 runtime first")
+    parser.add_argument('--early_exit_correctness', action="store_true", help="stop checking the outputs (shortest testcases first) once the mean accuracy cannot reach gem5_acc_threshold")
+    parser.add_argument('--cpu_lease_timeout', type=float, default=None, help="seconds after which a held cpu is reclaimed, by default only cpus of dead processes are reclaimed")
+    parser.add_argument('--parallelize_testcases', action="store_true", help="with the gem5 timing_env, schedule each (submission, testcase) independently across the cpus")
     ## gem5 and compilation parameters
     parser.add_argument('--testcases_dir', type=str, help='testcases directory', default="/home/pie-perf/data/codenet/merged_test_cases/")
     parser.add_argument('--cstd', type=str, help='cstd', default='--std=c++17')
@@ -103,36 +241,65 @@ def parse_args():
     parser.add_argument('--path_to_atcoder', type=str, help='path to atcoder', default='/home/ac-library/')
     parser.add_argument('--timeout_seconds_binary', type=int, help='timeout seconds for binary', default=10)
     parser.add_argument('--timeout_seconds_gem5', type=int, help='timeout seconds for gem5', default=120)
+    parser.add_argument('--hyperfine_compile_once', action="store_true", help="compile each submission once and feed the test inputs to hyperfine through stdin")
+    ## caching parameters
+    parser.add_argument('--compile_cache_dir', type=str, help='directory of the compiled binary cache, defaults to <cache_dir>/compile_cache or <working_dir>/compile_cache', default=None)
+    parser.add_argument('--compile_cache_max_mb', type=int, help='max size of the compiled binary cache in MB, 0 disables the cache', default=2048)
+    parser.add_argument('--cache_dir', type=str, help='directory of the caches that are kept across servers, e.g. a volume mounted from the host', default=None)
+    parser.add_argument('--gem5_result_store_path', type=str, help='path of the sqlite store of gem5 results, defaults to <cache_dir>/gem5_results.sqlite3 or <working_dir>/gem5_results.sqlite3', default=None)
+    parser.add_argument('--disable_gem5_result_store', action="store_true", help="always re-run gem5 instead of reusing stored results")
+    parser.add_argument('--job_store_path', type=str, help='path of the sqlite job queue, defaults to <working_dir>/jobs.sqlite3', default=None)
+    parser.add_argument('--disable_job_queue', action="store_true", help="disable the asynchronous /gem5/jobs api")
     
     
     args = parser.parse_args()
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+    if args.compile_cache_dir is None:
+        args.compile_cache_dir = os.path.join(args.cache_dir or args.working_dir, "compile_cache")
+    if args.gem5_result_store_path is None and not args.disable_gem5_result_store:
+        args.gem5_result_store_path = os.path.join(args.cache_dir or args.working_dir, "gem5_results.sqlite3")
+    if args.job_store_path is None and not args.disable_job_queue:
+        args.job_store_path = os.path.join(args.working_dir, "jobs.sqlite3")
     app.config.update(vars(args))
     return args
 
-def single_submission(code, testcases, problem_id, timing_env, queue, override_flags=""):
+def correctness_kwargs(early_exit: bool) -> dict:
+    """
+    the keyword arguments of benchmarking.compile_and_check_outputs set from the command line; 
+    early_exit should only be set where a mean accuracy below gem5_acc_threshold is not reported
+    """
+    return {"early_exit_acc_threshold": app.config['gem5_acc_threshold'] if early_exit and app.config['early_exit_correctness'] else None, 
+            "n_workers": app.config['correctness_workers'], 
+            "max_memory_bytes": app.config['correctness_max_memory_mb'] * 1024 * 1024 or None}
+
+def single_submission(code, testcases, problem_id, timing_env, cpu_allocator, override_flags="", stat_keys=None):
     ## TODO -> check if any test cases are missing with hyperfine
     logging.info(f"single_submission for problem {problem_id} with timing_env {timing_env} and testcases {testcases}")
     override_flags = "" if not isinstance(override_flags, str) else override_flags
     result = {}
-    cpu_number = queue.get(block=True) if timing_env in ("binary", "both") else None
-    logging.info(f"got cpu {cpu_number} in pid {os.getpid()}")
-    with tempfile.TemporaryDirectory() as tmpdirname:
+    # only the binary timing needs a pinned cpu
+    cpu_lease = cpu_allocator.lease() if timing_env in ("binary", "both") else contextlib.nullcontext()
+    with cpu_lease as cpu_number, tempfile.TemporaryDirectory() as tmpdirname:
+        logging.info(f"got cpu {cpu_number} in pid {os.getpid()}")
         code_path = os.path.join(tmpdirname, 'code.cpp')
         with open(code_path, 'w') as f:
             f.write(code)
         print(f"app cfg cstd {app.config['cstd']} app.config['optimization_flag']: {app.config['optimization_flag']}  override_flags: {override_flags }")
         cflags = app.config['cstd'] + ' ' + app.config['optimization_flag'] + override_flags
-        bin_path, accs = benchmarking.compile_and_check_outputs(
+        bin_path, accs, tc2native_time = benchmarking.compile_and_check_outputs(
             code_path=code_path,
             problem_id=problem_id,
             testcases_dir=app.config['testcases_dir'], 
             timeout=app.config['timeout_seconds_binary'],
             cflags=cflags, 
             testcases=testcases, 
-            cpu_number=cpu_number)
+            cpu_number=cpu_number, 
+            return_native_times=True, 
+            **correctness_kwargs(early_exit=True))
         result["compile_success"] = bin_path is not None
         result['accs'] = accs
-        mean_accs = np.mean(list(accs.values()))
+        mean_accs = benchmarking.mean_accuracy(accs)
         logging.info(f"mean_accs: {mean_accs}")
         if mean_accs < app.config["gem5_acc_threshold"]: 
             logging.info(f"mean_accs: {mean_accs} is below threshold {app.config['gem5_acc_threshold']}, skipping gem5")
@@ -154,7 +321,9 @@ def single_submission(code, testcases, problem_id, timing_env, queue, override_f
                 timeout=app.config['timeout_seconds_gem5'],
                 testcases=testcases,
                 cpu_number=cpu_number, 
-                exit_early_on_fail=app.config['exit_early_on_fail'])
+                exit_early_on_fail=app.config['exit_early_on_fail'], 
+                stat_keys=stat_keys, 
+                tc2timeout=plan_gem5_timeouts(tc2native_time))
             result['gem5'] = gem5_results
         if timing_env in ['binary', 'both']:
             code2results, output = benchmarking.run_hyperfine(
@@ -168,19 +337,20 @@ def single_submission(code, testcases, problem_id, timing_env, queue, override_f
                 max_runs_per_test_case=500,
                 warmup_runs_per_test_case=5,
                 cpu_number=cpu_number, 
-                do_sanity_check=True) # TODO: PIN TO CPU
+                do_sanity_check=True, 
+                cflags=cflags, 
+                compile_once=app.config['hyperfine_compile_once'], 
+                bin_paths=[bin_path]) # TODO: PIN TO CPU
             binary_results = code2results[code_path]
             result["binary"] = binary_results
-    queue.put(cpu_number)
     return result
 
 
-def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue, override_flags_v0="", override_flags_v1=""):
+def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, cpu_allocator, override_flags_v0="", override_flags_v1="", stat_keys=None):
     override_flags_v0 = "" if not isinstance(override_flags_v0, str) else override_flags_v0
     override_flags_v1 = "" if not isinstance(override_flags_v1, str) else override_flags_v1
     result = {}
-    cpu_number = queue.get(block=True)
-    with tempfile.TemporaryDirectory() as tmpdirname_v0, tempfile.TemporaryDirectory() as tmpdirname_v1:
+    with cpu_allocator.lease() as cpu_number, tempfile.TemporaryDirectory() as tmpdirname_v0, tempfile.TemporaryDirectory() as tmpdirname_v1:
         code_path_v0 = os.path.join(tmpdirname_v0, 'code.cpp')
         with open(code_path_v0, 'w') as f:
             f.write(code_v0)
@@ -199,7 +369,8 @@ def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue,
             timeout=app.config['timeout_seconds_binary'],
             cflags=cflags_v0, 
             testcases=testcases, 
-            cpu_number=cpu_number)
+            cpu_number=cpu_number, 
+            **correctness_kwargs(early_exit=False))
         bin_path_v1, accs_v1 = benchmarking.compile_and_check_outputs(
             code_path=code_path_v1,
             problem_id=problem_id,
@@ -207,7 +378,8 @@ def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue,
             timeout=app.config['timeout_seconds_binary'],
             cflags=cflags_v1, 
             testcases=testcases, 
-            cpu_number=cpu_number)
+            cpu_number=cpu_number, 
+            **correctness_kwargs(early_exit=False))
         result["compile_success_v0"] = bin_path_v0 is not None
         result["compile_success_v1"] = bin_path_v1 is not None
         result['accs_v0'] = accs_v0
@@ -223,7 +395,8 @@ def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue,
                 timeout=app.config['timeout_seconds_gem5'],
                 testcases=testcases,
                 cpu_number=cpu_number, 
-                exit_early_on_fail=app.config['exit_early_on_fail'])
+                exit_early_on_fail=app.config['exit_early_on_fail'], 
+                stat_keys=stat_keys)
             result['gem5_v0'] = gem5_results_v0
             gem5_results_v1 = benchmarking.run_gem5(
                 gem5_dir=app.config['gem5_dir'],
@@ -235,7 +408,8 @@ def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue,
                 timeout=app.config['timeout_seconds_gem5'],
                 testcases=testcases,
                 cpu_number=cpu_number, 
-                exit_early_on_fail=app.config['exit_early_on_fail'])
+                exit_early_on_fail=app.config['exit_early_on_fail'], 
+                stat_keys=stat_keys)
             result['gem5_v1'] = gem5_results_v1
         if timing_env in ['binary', 'both']:
             code2results, output = benchmarking.run_hyperfine(
@@ -248,25 +422,515 @@ def dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, queue,
                 max_runs_per_test_case=500,
                 warmup_runs_per_test_case=5,
                 cpu_number=cpu_number, 
-                do_sanity_check=True)
+                do_sanity_check=True, 
+                cflags=[cflags_v0, cflags_v1], 
+                compile_once=app.config['hyperfine_compile_once'], 
+                bin_paths=[bin_path_v0, bin_path_v1])
             result["binary_v0"] = code2results[code_path_v0]
             result["binary_v1"] = code2results[code_path_v1]
-    queue.put(cpu_number)
     return result
 
 
-def multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, queue, cpus, override_flags_list=None):
+def prepare_single_submission(code, testcases, problem_id, submission_dir, override_flags=""):
+    """
+    compiles and checks the outputs of a submission for the gem5 timing_env, 
+    returns the partial result, the path to the binary, which is None if gem5 should be skipped, and the native wall time per testcase
+    """
+    override_flags = "" if not isinstance(override_flags, str) else override_flags
+    os.makedirs(submission_dir)
+    code_path = os.path.join(submission_dir, 'code.cpp')
+    with open(code_path, 'w') as f:
+        f.write(code)
+    cflags = app.config['cstd'] + ' ' + app.config['optimization_flag'] + override_flags
+    bin_path, accs, tc2native_time = benchmarking.compile_and_check_outputs(
+        code_path=code_path,
+        problem_id=problem_id,
+        testcases_dir=app.config['testcases_dir'], 
+        timeout=app.config['timeout_seconds_binary'],
+        cflags=cflags, 
+        testcases=testcases, 
+        return_native_times=True, 
+        **correctness_kwargs(early_exit=True))
+    result = {"compile_success": bin_path is not None, "accs": accs, "gem5": {}}
+    mean_accs = benchmarking.mean_accuracy(accs)
+    if mean_accs < app.config["gem5_acc_threshold"]: 
+        logging.info(f"mean_accs: {mean_accs} is below threshold {app.config['gem5_acc_threshold']}, skipping gem5")
+        return result, None, tc2native_time
+    return result, bin_path, tc2native_time
+
+
+# rough ratio of the gem5 to the native wall time, until the result store has testcases that were run both ways
+DEFAULT_GEM5_SLOWDOWN_FACTOR = 1000.0
+
+def get_runtime_history(problem_ids):
+    """
+    returns the mean gem5 and native wall time per testcase of each problem from the gem5 result store and the gem5 slowdown factor
+    """
+    gem5_history, native_history, slowdown_factor = {}, {}, None
+    if benchmarking.GEM5_RESULT_STORE is not None:
+        for problem_id in set(problem_ids):
+            gem5_history[problem_id] = benchmarking.GEM5_RESULT_STORE.get_runtimes(problem_id, "gem5")
+            native_history[problem_id] = benchmarking.GEM5_RESULT_STORE.get_runtimes(problem_id, "native")
+        slowdown_factor = benchmarking.GEM5_RESULT_STORE.slowdown_factor()
+    return gem5_history, native_history, get_gem5_slowdown_factor(slowdown_factor)
+
+
+def get_calibrated_gem5_slowdown_factor(calibrated_slowdown_factor=None):
+    """
+    the --gem5_slowdown_factor if set, else the factor calibrated from the gem5 result store, else None
+    """
+    if app.config['gem5_slowdown_factor'] is not None:
+        return app.config['gem5_slowdown_factor']
+    if calibrated_slowdown_factor is None and benchmarking.GEM5_RESULT_STORE is not None:
+        calibrated_slowdown_factor = benchmarking.GEM5_RESULT_STORE.slowdown_factor()
+    return calibrated_slowdown_factor
+
+
+def get_gem5_slowdown_factor(calibrated_slowdown_factor=None):
+    """
+    the --gem5_slowdown_factor if set, else the factor calibrated from the gem5 result store, else DEFAULT_GEM5_SLOWDOWN_FACTOR
+    """
+    return get_calibrated_gem5_slowdown_factor(calibrated_slowdown_factor) or DEFAULT_GEM5_SLOWDOWN_FACTOR
+
+
+def plan_gem5_timeouts(tc2native_time):
+    """
+    the gem5 timeout of each testcase, from its gem5 runtime predicted as its native runtime times the slowdown factor; 
+    with preskip_gem5_timeouts, testcases predicted to take more than gem5_timeout_margin times the timeout get None and are not run, 
+    with scale_gem5_timeouts, the timeout is gem5_timeout_margin times the prediction, between min_scaled_gem5_timeout and the timeout; 
+    returns None if neither is enabled or if the slowdown factor is neither set nor calibrated yet
+    """
+    if not app.config['preskip_gem5_timeouts'] and not app.config['scale_gem5_timeouts']:
+        return None
+    slowdown_factor = get_calibrated_gem5_slowdown_factor()
+    if slowdown_factor is None:
+        # DEFAULT_GEM5_SLOWDOWN_FACTOR is only good enough to order the testcases, not to skip them or cut their timeout
+        return None
+    timeout = app.config['timeout_seconds_gem5']
+    margin = app.config['gem5_timeout_margin']
+    tc2timeout = {}
+    for tc_no, native_seconds in tc2native_time.items():
+        predicted_seconds = native_seconds * slowdown_factor
+        if app.config['preskip_gem5_timeouts'] and predicted_seconds > margin * timeout:
+            logging.info(f"testcase {tc_no} is predicted to take {predicted_seconds}s in gem5, skipping it")
+            tc2timeout[tc_no] = None
+        elif app.config['scale_gem5_timeouts']:
+            tc2timeout[tc_no] = min(timeout, max(app.config['min_scaled_gem5_timeout'], margin * predicted_seconds))
+        else: 
+            tc2timeout[tc_no] = timeout
+    return tc2timeout
+
+
+def expected_gem5_seconds(problem_id, tc_no, history, native_seconds=None):
+    """
+    the expected gem5 wall time of a testcase: from the native run of the binary itself if available, 
+    else from the past gem5 or native runs on the testcase, or None if it was never run
+    """
+    gem5_history, native_history, slowdown_factor = history
+    tc_no = int(tc_no)
+    if native_seconds is not None:
+        return native_seconds * slowdown_factor
+    if tc_no in gem5_history.get(problem_id, {}):
+        return gem5_history[problem_id][tc_no]
+    if tc_no in native_history.get(problem_id, {}):
+        return native_history[problem_id][tc_no] * slowdown_factor
+    return None
+
+
+def longest_expected_first(expected_seconds, input_sizes):
+    """
+    indices sorted by decreasing expected cost, which keeps a long job from starting last and delaying the whole batch; 
+    jobs without an expected cost go last, largest input first
+    """
+    return sorted(range(len(expected_seconds)), key=lambda i: (expected_seconds[i] is None, -(expected_seconds[i] or 0), -input_sizes[i]))
+
+
+def order_submissions_by_expected_cost(testcases_list, problem_id_list):
+    history = get_runtime_history(problem_id_list)
+    expected_seconds, input_sizes = [], []
+    for testcases, problem_id in zip(testcases_list, problem_id_list):
+        tc_2_in_path = benchmarking.get_testcase_input_paths(problem_id, app.config['testcases_dir'], testcases)
+        tc_expected_seconds = [expected_gem5_seconds(problem_id, tc_no, history) for tc_no in tc_2_in_path.keys()]
+        known_seconds = [seconds for seconds in tc_expected_seconds if seconds is not None]
+        expected_seconds.append(sum(known_seconds) if len(known_seconds) > 0 else None)
+        input_sizes.append(sum(os.path.getsize(in_path) for in_path in tc_2_in_path.values()))
+    return longest_expected_first(expected_seconds, input_sizes)
+
+
+def run_gem5_unit(submission_idx, bin_path, tc_no, in_path, timeout, cpu_allocator, failed_submissions, stat_keys=None, problem_id=None):
+    """
+    runs gem5 for a single (submission, testcase) unit on a cpu leased from the cpu_allocator; 
+    with exit_early_on_fail, the pending units of a submission are cancelled once any of its units has failed. 
+    a timeout of None skips a unit that is predicted to time out (see plan_gem5_timeouts)
+    """
+    if app.config['exit_early_on_fail'] and submission_idx in failed_submissions:
+        return benchmarking.make_skipped_gem5_result()
+    if timeout is None:
+        failed_submissions[submission_idx] = True
+        return benchmarking.make_skipped_gem5_result(error=benchmarking.PREDICTED_TIMEOUT_ERROR)
+    with cpu_allocator.lease() as cpu_number:
+        result = benchmarking.run_gem5_testcase(
+            gem5_dir=app.config['gem5_dir'],
+            gem5_script_path=app.config['gem5_script_path'],
+            cpu_type=app.config['cpu_type'],
+            bin_path=bin_path,
+            tc_no=tc_no,
+            in_path=in_path,
+            timeout=timeout,
+            cpu_number=cpu_number, 
+            stat_keys=stat_keys, 
+            problem_id=problem_id)
+    if not result["success"]:
+        failed_submissions[submission_idx] = True
+    return result
+
+
+def plan_gem5_units(prepared, testcases_list, problem_id_list):
+    """
+    the (submission_idx, bin_path, tc_no, in_path) units of the prepared submissions (see prepare_single_submission) that pass the checks, 
+    their gem5 timeouts and the order in which to run them
+    """
+    units = []
+    unit_timeouts = []
+    expected_seconds = []
+    history = get_runtime_history(problem_id_list)
+    for submission_idx, (_, bin_path, tc2native_time) in enumerate(prepared):
+        if bin_path is None:
+            continue
+        problem_id = problem_id_list[submission_idx]
+        tc2timeout = plan_gem5_timeouts(tc2native_time) or {}
+        tc_2_in_path = benchmarking.get_testcase_input_paths(problem_id, app.config['testcases_dir'], testcases_list[submission_idx])
+        for tc_no, in_path in tc_2_in_path.items():
+            units.append((submission_idx, bin_path, tc_no, in_path))
+            unit_timeouts.append(tc2timeout.get(tc_no, app.config['timeout_seconds_gem5']))
+            expected_seconds.append(expected_gem5_seconds(problem_id, tc_no, history, tc2native_time.get(tc_no)))
+    if app.config['longest_job_first']:
+        unit_order = longest_expected_first(expected_seconds, [os.path.getsize(in_path) for _, _, _, in_path in units])
+    else: 
+        unit_order = list(range(len(units)))
+    return units, unit_timeouts, unit_order
+
+
+def multiple_single_submissions_per_testcase(code_list, testcases_list, problem_id_list, cpu_allocator, cpus, override_flags_list, stat_keys=None):
+    """
+    gem5-only variant of multiple_single_submissions that schedules every (submission, testcase) unit independently, 
+    so that a submission with many testcases is spread across all cpus instead of holding a single one; 
+    the unit results are reassembled into the same per-submission results as single_submission
+    """
+    with tempfile.TemporaryDirectory() as batch_dir:
+        with tqdm_joblib(tqdm(desc="Compiling and checking multiple single submissions", total=len(code_list))) as progress_bar:
+            prepared = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing")(delayed(prepare_single_submission)(code, testcases, problem_id, os.path.join(batch_dir, str(i)), override_flags) for i, (code, testcases, problem_id, override_flags) in enumerate(zip(code_list, testcases_list, problem_id_list, override_flags_list)))
+        results = [result for result, _, _ in prepared]
+        units, unit_timeouts, unit_order = plan_gem5_units(prepared, testcases_list, problem_id_list)
+        failed_submissions = MANAGER.dict()
+        with tqdm_joblib(tqdm(desc="Running gem5 on multiple testcases", total=len(units))) as progress_bar:
+            # batch_size=1 so that units are handed out one at a time as cpus free up
+            unit_results = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing", batch_size=1)(delayed(run_gem5_unit)(*units[i], unit_timeouts[i], cpu_allocator, failed_submissions, stat_keys, problem_id_list[units[i][0]]) for i in unit_order)
+    unit_results = dict(zip(unit_order, unit_results))
+    for i, (submission_idx, _, tc_no, _) in enumerate(units):
+        results[submission_idx]["gem5"][tc_no] = unit_results[i]
+    return results
+
+
+def multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, cpu_allocator, cpus, override_flags_list=None, stat_keys=None):
     assert len(code_list) == len(testcases_list) == len(problem_id_list) == len(override_flags_list)
+    if timing_env == "gem5" and app.config["parallelize_testcases"]:
+        return multiple_single_submissions_per_testcase(code_list, testcases_list, problem_id_list, cpu_allocator, cpus, override_flags_list, stat_keys)
+    if app.config['longest_job_first']:
+        order = order_submissions_by_expected_cost(testcases_list, problem_id_list)
+    else: 
+        order = list(range(len(code_list)))
     with tqdm_joblib(tqdm(desc="Running multiple single submissions", total=len(code_list))) as progress_bar:
-        results = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing")(delayed(single_submission)(code, testcases, problem_id, timing_env, queue, override_flags) for code, testcases, problem_id, override_flags in zip(code_list, testcases_list, problem_id_list, override_flags_list))
-    return results
+        # batch_size=1 so that the submissions are started in order
+        results = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing", batch_size=1)(delayed(single_submission)(code_list[i], testcases_list[i], problem_id_list[i], timing_env, cpu_allocator, override_flags_list[i], stat_keys) for i in order)
+    results = dict(zip(order, results))
+    return [results[i] for i in range(len(code_list))]
+
+def iter_pool_results(results_iter, cancel_event=None, poll_interval=1.0):
+    """
+    yields from a pool imap iterator until it is exhausted or cancel_event is set; the iterator is polled with a timeout 
+    so that a cancellation is noticed while all the workers are busy, the caller then exits the pool to terminate them
+    """
+    while cancel_event is None or not cancel_event.is_set():
+        try: 
+            yield results_iter.next(timeout=poll_interval)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration:
+            return
+
+
+def _indexed_single_submission(args):
+    submission_idx, code, testcases, problem_id, timing_env, cpu_allocator, override_flags, stat_keys = args
+    return submission_idx, single_submission(code, testcases, problem_id, timing_env, cpu_allocator, override_flags, stat_keys)
+
+
+def _indexed_prepare_single_submission(args):
+    submission_idx, code, testcases, problem_id, submission_dir, override_flags = args
+    return submission_idx, prepare_single_submission(code, testcases, problem_id, submission_dir, override_flags)
 
-def multiple_dual_submissions(code_v0_list, code_v1_list, testcases_list, problem_id_list, timing_env, queue, cpus, override_flags_list_v0, override_flags_list_v1):
+
+def _indexed_gem5_unit(args):
+    unit_idx, unit_args = args
+    return unit_idx, run_gem5_unit(*unit_args)
+
+
+def iter_multiple_single_submissions_per_testcase(code_list, testcases_list, problem_id_list, cpu_allocator, cpus, override_flags_list, stat_keys=None, cancel_event=None):
+    """
+    streaming variant of multiple_single_submissions_per_testcase, yields (submission_idx, result) once all the units of a submission 
+    have finished, and right after the checks for the submissions that are not run in gem5
+    """
+    with tempfile.TemporaryDirectory() as batch_dir, multiprocessing.Pool(processes=cpus, initializer=isolate_process_group) as pool:
+        prepare_args = [(i, code, testcases, problem_id, os.path.join(batch_dir, str(i)), override_flags) for i, (code, testcases, problem_id, override_flags) in enumerate(zip(code_list, testcases_list, problem_id_list, override_flags_list))]
+        prepared = [None] * len(code_list)
+        for submission_idx, prepared_submission in tqdm(iter_pool_results(pool.imap_unordered(_indexed_prepare_single_submission, prepare_args), cancel_event), desc="Compiling and checking multiple single submissions", total=len(prepare_args)):
+            prepared[submission_idx] = prepared_submission
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        results = [result for result, _, _ in prepared]
+        units, unit_timeouts, unit_order = plan_gem5_units(prepared, testcases_list, problem_id_list)
+        n_pending_units = collections.Counter(submission_idx for submission_idx, _, _, _ in units)
+        for submission_idx in range(len(code_list)):
+            if n_pending_units[submission_idx] == 0:
+                yield submission_idx, results[submission_idx]
+        failed_submissions = MANAGER.dict()
+        unit_args = [(i, (*units[i], unit_timeouts[i], cpu_allocator, failed_submissions, stat_keys, problem_id_list[units[i][0]])) for i in unit_order]
+        for unit_idx, unit_result in tqdm(iter_pool_results(pool.imap_unordered(_indexed_gem5_unit, unit_args), cancel_event), desc="Streaming gem5 on multiple testcases", total=len(unit_args)):
+            submission_idx, _, tc_no, _ = units[unit_idx]
+            results[submission_idx]["gem5"][tc_no] = unit_result
+            n_pending_units[submission_idx] -= 1
+            if n_pending_units[submission_idx] == 0:
+                yield submission_idx, results[submission_idx]
+
+
+def iter_multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, cpu_allocator, cpus, override_flags_list=None, stat_keys=None, cancel_event=None):
+    """
+    like multiple_single_submissions, but yields (submission_idx, result) as soon as each submission completes; 
+    setting cancel_event stops the stream and terminates the pending submissions
+    """
+    assert len(code_list) == len(testcases_list) == len(problem_id_list) == len(override_flags_list)
+    if timing_env == "gem5" and app.config["parallelize_testcases"]:
+        yield from iter_multiple_single_submissions_per_testcase(code_list, testcases_list, problem_id_list, cpu_allocator, cpus, override_flags_list, stat_keys, cancel_event)
+        return
+    args_list = [(i, code, testcases, problem_id, timing_env, cpu_allocator, override_flags, stat_keys) for i, (code, testcases, problem_id, override_flags) in enumerate(zip(code_list, testcases_list, problem_id_list, override_flags_list))]
+    if app.config['longest_job_first']:
+        args_list = [args_list[i] for i in order_submissions_by_expected_cost(testcases_list, problem_id_list)]
+    # exiting the pool terminates the workers, e.g. when the client disconnects from the stream
+    with multiprocessing.Pool(processes=cpus, initializer=isolate_process_group) as pool:
+        for submission_idx, result in tqdm(iter_pool_results(pool.imap_unordered(_indexed_single_submission, args_list), cancel_event), desc="Streaming multiple single submissions", total=len(args_list)):
+            yield submission_idx, result
+
+
+class JobStore: 
+    """
+    Persistent sqlite queue of batch jobs of single submissions and their (partial) results. 
+    
+    Jobs go through pending -> running -> completed / failed, or cancelled at any point. Results are written as 
+    each submission completes, so a job that was running when the server stopped is re-queued on startup and only 
+    its missing submissions are run again. A new connection is opened per call since the store is shared between
+    the request threads and the job worker thread.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                job_id TEXT PRIMARY KEY, 
+                                status TEXT NOT NULL, 
+                                timing_env TEXT NOT NULL, 
+                                submissions TEXT NOT NULL, 
+                                n_submissions INTEGER NOT NULL, 
+                                created_at REAL NOT NULL, 
+                                updated_at REAL NOT NULL, 
+                                error TEXT, 
+                                stat_keys TEXT)""")
+            # stores created before stat_keys had its own column
+            if "stat_keys" not in [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN stat_keys TEXT")
+            conn.execute("""CREATE TABLE IF NOT EXISTS job_results (
+                                job_id TEXT NOT NULL, 
+                                submission_idx INTEGER NOT NULL, 
+                                result TEXT NOT NULL, 
+                                UNIQUE (job_id, submission_idx))""")
+            # jobs that were running when the server stopped are resumed
+            conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+    
+    def create_job(self, submissions, timing_env, stat_keys=None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT INTO jobs VALUES (?, 'pending', ?, ?, ?, ?, ?, NULL, ?)", 
+                         (job_id, timing_env, json.dumps(submissions), len(submissions), now, now, json.dumps(stat_keys)))
+        return job_id
+    
+    def finish_job(self, job_id, status, error=None) -> bool:
+        """moves a running job to completed / failed, unless it was cancelled in the meantime"""
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ? AND status = 'running'", 
+                                  (status, error, time.time(), job_id))
+        return cursor.rowcount > 0
+    
+    def cancel(self, job_id) -> bool:
+        placeholders = ", ".join("?" * len(JOB_TERMINAL_STATUSES))
+        with self._connect() as conn:
+            cursor = conn.execute(f"UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE job_id = ? AND status NOT IN ({placeholders})", 
+                                  (time.time(), job_id, *JOB_TERMINAL_STATUSES))
+        return cursor.rowcount > 0
+    
+    def get_status(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row is not None else None
+    
+    def claim_next_job(self):
+        """marks the oldest pending job as running and returns (job_id, submissions, timing_env, stat_keys), or None"""
+        while True: 
+            with self._connect() as conn:
+                row = conn.execute("SELECT job_id, submissions, timing_env, stat_keys FROM jobs WHERE status = 'pending' ORDER BY created_at LIMIT 1").fetchone()
+                if row is None:
+                    return None
+                # the job may have been cancelled since the select, in which case we try the next one
+                cursor = conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ? AND status = 'pending'", (time.time(), row[0]))
+            if cursor.rowcount > 0:
+                return row[0], json.loads(row[1]), row[2], json.loads(row[3]) if row[3] is not None else None
+    
+    def add_result(self, job_id, submission_idx, result):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO job_results VALUES (?, ?, ?)", (job_id, submission_idx, json.dumps(result)))
+    
+    def completed_indices(self, job_id):
+        with self._connect() as conn:
+            return {row[0] for row in conn.execute("SELECT submission_idx FROM job_results WHERE job_id = ?", (job_id,))}
+    
+    def get_job(self, job_id, cursor=0):
+        """returns the status of the job and the results completed after cursor, along with the cursor to use for the next poll"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT status, n_submissions, error, created_at, updated_at FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            n_completed = conn.execute("SELECT COUNT(*) FROM job_results WHERE job_id = ?", (job_id,)).fetchone()[0]
+            result_rows = conn.execute("SELECT rowid, submission_idx, result FROM job_results WHERE job_id = ? AND rowid > ? ORDER BY rowid", 
+                                       (job_id, cursor)).fetchall()
+        status, n_submissions, error, created_at, updated_at = row
+        return {"job_id": job_id, 
+                "status": status, 
+                "n_submissions": n_submissions, 
+                "n_completed": n_completed, 
+                "error": error, 
+                "created_at": created_at, 
+                "updated_at": updated_at, 
+                "results": [{"index": submission_idx, "result": json.loads(result)} for _, submission_idx, result in result_rows], 
+                "cursor": result_rows[-1][0] if len(result_rows) > 0 else cursor}
+    
+    def list_jobs(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT job_id, status, n_submissions, created_at, updated_at FROM jobs ORDER BY created_at").fetchall()
+        return [{"job_id": job_id, "status": status, "n_submissions": n_submissions, "created_at": created_at, "updated_at": updated_at} 
+                for job_id, status, n_submissions, created_at, updated_at in rows]
+
+
+def watch_for_cancellation(job_store, job_id, cancel_event, stop_event, poll_interval=1.0):
+    """sets cancel_event once the job is no longer running, e.g. cancelled through the api"""
+    while not stop_event.wait(poll_interval):
+        if job_store.get_status(job_id) != "running":
+            cancel_event.set()
+            return
+
+
+def run_job(job_store, job_id, submissions, timing_env, stat_keys=None, poll_interval=1.0):
+    completed = job_store.completed_indices(job_id)
+    remaining = [i for i in range(len(submissions)) if i not in completed]
+    logging.info(f"running job {job_id} with {len(remaining)} of {len(submissions)} submissions remaining")
+    if len(remaining) > 0:
+        cancel_event, stop_event = threading.Event(), threading.Event()
+        # the status is polled on a timer rather than after each result, so that a cancelled job stops even while its submissions are still running
+        watcher_thread = threading.Thread(target=watch_for_cancellation, args=(job_store, job_id, cancel_event, stop_event, poll_interval), daemon=True)
+        watcher_thread.start()
+        try: 
+            for remaining_idx, result in iter_multiple_single_submissions([submissions[i]['code'] for i in remaining], 
+                                                                          [submissions[i]['testcases'] for i in remaining], 
+                                                                          [submissions[i]['problem_id'] for i in remaining], 
+                                                                          timing_env, CPU_ALLOCATOR, N_CPUS, 
+                                                                          [submissions[i].get('override_flags', "") for i in remaining], 
+                                                                          stat_keys, 
+                                                                          cancel_event):
+                job_store.add_result(job_id, remaining[remaining_idx], result)
+        finally: 
+            stop_event.set()
+        if cancel_event.is_set():
+            logging.info(f"job {job_id} was cancelled")
+            return
+    job_store.finish_job(job_id, "completed")
+
+
+def job_worker(job_store, poll_interval=1.0):
+    """runs the queued jobs one at a time, so that all of the cpus are used for a single job"""
+    while True: 
+        job = job_store.claim_next_job()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        job_id, submissions, timing_env, stat_keys = job
+        try: 
+            run_job(job_store, job_id, submissions, timing_env, stat_keys, poll_interval)
+        except Exception as e:
+            logging.exception(f"job {job_id} failed")
+            job_store.finish_job(job_id, "failed", error=str(e))
+
+
+def start_job_worker(job_store_path):
+    global JOB_STORE
+    JOB_STORE = JobStore(job_store_path)
+    worker_thread = threading.Thread(target=job_worker, args=(JOB_STORE,), daemon=True)
+    worker_thread.start()
+    return worker_thread
+
+
+def multiple_dual_submissions(code_v0_list, code_v1_list, testcases_list, problem_id_list, timing_env, cpu_allocator, cpus, override_flags_list_v0, override_flags_list_v1, stat_keys=None):
     assert len(code_v0_list) == len(code_v1_list) == len(testcases_list) == len(problem_id_list) == len(override_flags_list_v0) == len(override_flags_list_v1)
-    results = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing")(delayed(dual_submission)(code_v0, code_v1, testcases, problem_id, timing_env, queue, override_flags_v0, override_flags_v1) for code_v0, code_v1, testcases, problem_id, override_flags_v0, override_flags_v1 in zip(code_v0_list, code_v1_list, testcases_list, problem_id_list, override_flags_list_v0, override_flags_list_v1))
+    results = Parallel(n_jobs=cpus, verbose=10, backend="multiprocessing")(delayed(dual_submission)(code_v0, code_v1, testcases, problem_id, timing_env, cpu_allocator, override_flags_v0, override_flags_v1, stat_keys) for code_v0, code_v1, testcases, problem_id, override_flags_v0, override_flags_v1 in zip(code_v0_list, code_v1_list, testcases_list, problem_id_list, override_flags_list_v0, override_flags_list_v1))
     return results
 
     
+MSGPACK_MIMETYPE = "application/msgpack"
+
+def encode_stats_layouts(obj, layouts: dict):
+    """
+    replaces every gem5 stats dict in obj by [layout index, values], where layouts maps the tuple of stat keys to its index; 
+    all the stats of a gem5 configuration share the same keys, so they are sent only once per response. 
+    dict keys are converted to str as they would be in json
+    """
+    if isinstance(obj, dict):
+        encoded = {}
+        for key, value in obj.items():
+            if key == "stats" and isinstance(value, dict):
+                layout = tuple(value.keys())
+                encoded[key] = [layouts.setdefault(layout, len(layouts)), list(value.values())]
+            else: 
+                encoded[str(key)] = encode_stats_layouts(value, layouts)
+        return encoded
+    if isinstance(obj, (list, tuple)):
+        return [encode_stats_layouts(value, layouts) for value in obj]
+    return obj
+
+def accepts_msgpack():
+    """whether the client of the current request accepts msgpack and msgpack is installed"""
+    return msgpack is not None and request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+def make_results_response(results):
+    """
+    serializes the results as msgpack with the stat keys factored out if the client accepts it and msgpack is installed, as json otherwise
+    """
+    if accepts_msgpack():
+        layouts = {}
+        encoded = encode_stats_layouts(results, layouts)
+        payload = {"stat_layouts": [list(layout) for layout in layouts.keys()], "results": encoded}
+        return Response(msgpack.packb(payload, use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+    return jsonify(results)
+    
 @app.route('/gem5/single_submission', methods=['GET'])
 def SingleSubmission(): 
     req = request.get_json()
@@ -281,8 +945,8 @@ def SingleSubmission():
     assert timing_env in ['gem5', 'binary', 'both']
     
     override_flags = req.get('override_flags', "")
-    results = single_submission(code, testcases, problem_id, timing_env, QUEUE, override_flags)
-    return jsonify(results)
+    results = single_submission(code, testcases, problem_id, timing_env, CPU_ALLOCATOR, override_flags, req.get("stat_keys"))
+    return make_results_response(results)
 
 @app.route('/gem5/multiple_single_submissions', methods=['GET'])
 def MultipleSubmissions():
@@ -294,7 +958,7 @@ def MultipleSubmissions():
     code_list = [r['code'] for r in submissions]
     testcases_list = [r['testcases'] for r in submissions]
     problem_id_list = [r['problem_id'] for r in submissions]
-    override_flags_list = [r.get('override_flags_list', "") for r in submissions]
+    override_flags_list = [r.get('override_flags', "") for r in submissions]
     
     assert len(code_list) == len(testcases_list) == len(problem_id_list) == len(override_flags_list)
     assert timing_env in ['gem5', 'binary', 'both']
@@ -305,9 +969,48 @@ def MultipleSubmissions():
     assert all([len(code) > 0 for code in code_list])
     assert all([len(testcases) > 0 for testcases in testcases_list])
     
-    results = multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, QUEUE, N_CPUS, override_flags_list)
+    results = multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, CPU_ALLOCATOR, N_CPUS, override_flags_list, req.get("stat_keys"))
     
-    return jsonify(results)
+    return make_results_response(results)
+
+@app.route('/gem5/multiple_single_submissions_stream', methods=['GET'])
+def MultipleSubmissionsStream():
+    """
+    streams the results of multiple single submissions as newline-delimited json, 
+    one {"index": ..., "result": ...} line per submission in order of completion. 
+    if the client accepts msgpack, the stream is a sequence of msgpack objects instead, one per submission, 
+    where "stat_layouts" holds the stat layouts first used by that result, appended to those of the previous objects
+    """
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    submissions = req['submissions']
+    timing_env = req['timing_env']
+    code_list = [r['code'] for r in submissions]
+    testcases_list = [r['testcases'] for r in submissions]
+    problem_id_list = [r['problem_id'] for r in submissions]
+    override_flags_list = [r.get('override_flags', "") for r in submissions]
+    
+    assert timing_env in ['gem5', 'binary', 'both']
+    assert len(code_list) > 0
+    assert all([len(code) > 0 for code in code_list])
+    assert all([len(testcases) > 0 for testcases in testcases_list])
+    
+    def generate():
+        for submission_idx, result in iter_multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, CPU_ALLOCATOR, N_CPUS, override_flags_list, req.get("stat_keys")):
+            yield json.dumps({"index": submission_idx, "result": result}) + "\n"
+    
+    def generate_msgpack():
+        layouts = {}
+        for submission_idx, result in iter_multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, CPU_ALLOCATOR, N_CPUS, override_flags_list, req.get("stat_keys")):
+            n_layouts = len(layouts)
+            encoded = encode_stats_layouts(result, layouts)
+            new_layouts = [list(layout) for layout in list(layouts.keys())[n_layouts:]]
+            yield msgpack.packb({"index": submission_idx, "stat_layouts": new_layouts, "result": encoded}, use_bin_type=True)
+    
+    if accepts_msgpack():
+        return Response(stream_with_context(generate_msgpack()), mimetype=MSGPACK_MIMETYPE)
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 @app.route('/gem5/single_submission_pair', methods=['GET'])
 def SingleSubmissionPair():
@@ -326,8 +1029,8 @@ def SingleSubmissionPair():
     assert timing_env in ['gem5', 'binary', 'both']
     
     override_flags = req.get('override_flags', "")
-    results = dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, QUEUE, override_flags)
-    return jsonify(results)
+    results = dual_submission(code_v0, code_v1, testcases, problem_id, timing_env, CPU_ALLOCATOR, override_flags, stat_keys=req.get("stat_keys"))
+    return make_results_response(results)
 
 @app.route('/gem5/multiple_submissions_pairs', methods=['GET'])
 def MultipleSubmissionsPair():
@@ -343,8 +1046,8 @@ def MultipleSubmissionsPair():
     testcases_list = [r['testcases'] for r in submissions_v0]
     problem_id_list = [r['problem_id'] for r in submissions_v0]
     
-    override_flags_list_v0 = [r.get('override_flags_list', "") for r in submissions_v0]
-    override_flags_list_v1 = [r.get('override_flags_list', "") for r in submissions_v1]
+    override_flags_list_v0 = [r.get('override_flags', "") for r in submissions_v0]
+    override_flags_list_v1 = [r.get('override_flags', "") for r in submissions_v1]
     
     assert len(code_list_v0) == len(testcases_list) == len(problem_id_list) == len(override_flags_list_v0) == len(code_list_v1) == len(override_flags_list_v1)
     assert timing_env in ['gem5', 'binary', 'both']
@@ -355,17 +1058,84 @@ def MultipleSubmissionsPair():
     assert all([len(code) > 0 for code in code_list_v1])
     assert all([len(testcases) > 0 for testcases in testcases_list])
     
-    results = multiple_dual_submissions(code_list_v0, code_list_v1, testcases_list, problem_id_list, timing_env, QUEUE, N_CPUS, override_flags_list_v0, override_flags_list_v1)
-    return jsonify(results)
+    results = multiple_dual_submissions(code_list_v0, code_list_v1, testcases_list, problem_id_list, timing_env, CPU_ALLOCATOR, N_CPUS, override_flags_list_v0, override_flags_list_v1, req.get("stat_keys"))
+    return make_results_response(results)
+
+@app.route('/gem5/jobs', methods=['POST'])
+def SubmitJob():
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    if JOB_STORE is None:
+        return jsonify({"error": "The job queue is disabled"})
+    submissions = req['submissions']
+    timing_env = req['timing_env']
+    assert timing_env in ['gem5', 'binary', 'both']
+    assert len(submissions) > 0
+    assert all([len(r['code']) > 0 for r in submissions])
+    assert all([len(r['testcases']) > 0 for r in submissions])
+    job_id = JOB_STORE.create_job(submissions, timing_env, req.get("stat_keys"))
+    return jsonify({"job_id": job_id})
+
+@app.route('/gem5/jobs', methods=['GET'])
+def ListJobs():
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    if JOB_STORE is None:
+        return jsonify({"error": "The job queue is disabled"})
+    return jsonify(JOB_STORE.list_jobs())
+
+@app.route('/gem5/jobs/<job_id>', methods=['GET'])
+def GetJob(job_id):
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    if JOB_STORE is None:
+        return jsonify({"error": "The job queue is disabled"})
+    job = JOB_STORE.get_job(job_id, cursor=req.get("cursor", 0))
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}"})
+    return make_results_response(job)
+
+@app.route('/gem5/jobs/<job_id>', methods=['DELETE'])
+def CancelJob(job_id):
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    if JOB_STORE is None:
+        return jsonify({"error": "The job queue is disabled"})
+    return jsonify({"job_id": job_id, "cancelled": JOB_STORE.cancel(job_id)})
 
 @app.route('/gem5/ping', methods=['GET'])
 def Ping():
     return jsonify({"status": "ok"})
 
+@app.route('/gem5/cpus', methods=['GET'])
+def Cpus():
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    return jsonify(CPU_ALLOCATOR.status())
+
+@app.route('/gem5/cache_stats', methods=['GET'])
+def CacheStats():
+    req = request.get_json()
+    if req["api_key"] != app.config["api_key"]:
+        return jsonify({"error": "Invalid API key"})
+    compile_cache = benchmarking.COMPILE_CACHE
+    gem5_result_store = benchmarking.GEM5_RESULT_STORE
+    return jsonify({"compile_cache": compile_cache.stats() if compile_cache is not None else None, 
+                    "gem5_result_store": gem5_result_store.stats() if gem5_result_store is not None else None})
+
 
 if __name__ == '__main__':
     args = parse_args()
-    init_globals(args.workers, args.use_logical_cpus)
+    init_globals(args.workers, args.use_logical_cpus, args.compile_cache_dir, args.compile_cache_max_mb, args.gem5_result_store_path, args.cpu_lease_timeout)
+    if args.job_store_path is not None:
+        start_job_worker(args.job_store_path)
+    # HTTP/1.1 so that clients can keep their connections alive between requests
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="0.0.0.0", port=args.port, debug=args.debug)
     
     
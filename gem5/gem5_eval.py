@@ -16,15 +16,31 @@ import pdb
 import threading
 from tqdm import tqdm
 import re
-from typing import Optional, Any
+from typing import Optional, Any, Union, List, Iterator
 import yaml
 from dataclasses import dataclass, field
 import ast
+try: 
+    import orjson
+except ImportError: 
+    orjson = None
+try: 
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: 
+    pa = None
+    pq = None
 
 logging.basicConfig(level=logging.INFO)
 
 import signal
 import time
+import hashlib
+import inspect
+import math
+import sqlite3
+import warnings
+import numpy as np
 
 KEY_COLS = ["n_tests", 
             "problem_id", 
@@ -42,35 +58,85 @@ def get_key_columns(df, cfg):
     key_cols = list(set(key_cols))
     return df[key_cols]
 
+def loads_json(s: Union[str, bytes]) -> Any:
+    ## orjson is much faster, but does not accept the NaN / Infinity that json.dumps writes
+    if orjson is not None:
+        try: 
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(s)
+
 def _fix_value(x: Any) -> Any:
     ## if starts with '[' and ends with ']', as a string, then convert to list
     if isinstance(x, str) and len(x) > 1 and x[0] == '[' and x[-1] == ']':
-        x = ast.literal_eval(x)
+        ## lists written with json.dumps are decoded as json, the ones written with str() need literal_eval
+        try: 
+            x = loads_json(x)
+        except ValueError:
+            x = ast.literal_eval(x)
     return x
 
 def fix_df_columns(df):
     for col in df.columns:
-        df[col] = df[col].apply(lambda x: _fix_value(x))
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].apply(lambda x: _fix_value(x))
     return df
+
+def iter_jsonl_chunks(path: str, columns: Optional[List[str]] = None, chunksize: int = 10000) -> Iterator[pd.DataFrame]:
+    """
+    Reads a jsonl file as DataFrames of chunksize rows, indexed by line number, keeping only the given columns (all of them if None), 
+    so that the whole file is never held in memory as python objects
+    """
+    records = []
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = loads_json(line)
+            if columns is not None:
+                record = {col: record[col] for col in columns if col in record}
+            records.append(record)
+            if len(records) == chunksize:
+                yield pd.DataFrame.from_records(records, index=pd.RangeIndex(offset, offset + len(records)))
+                offset += len(records)
+                records = []
+    if len(records) > 0:
+        yield pd.DataFrame.from_records(records, index=pd.RangeIndex(offset, offset + len(records)))
+
+def get_input_columns(cfg) -> Optional[List[str]]:
+    ## the columns that evaluation needs are always read, on top of cfg.input_columns
+    if cfg.input_columns is None:
+        return None
+    required_cols = ["src_id", "problem_id", "tests", "n_tests", "src_agg_runtime", "tgt_agg_runtime", 
+                     cfg.slow_code_col, cfg.reference_code_col, cfg.model_generated_potentially_faster_code_col]
+    return list(dict.fromkeys(required_cols + list(cfg.input_columns)))
     
 
 
+def join_results(melted: pd.DataFrame, result_positions: list, result_records: list) -> pd.DataFrame:
+    """Takes the rows of melted at result_positions and adds the RESULT_COLS of the matching records as columns."""
+    results_df = pd.DataFrame.from_records(result_records, columns=RESULT_COLS)
+    rows = melted.iloc[np.asarray(result_positions, dtype=int)].reset_index(drop=True)
+    return pd.concat([rows.drop(columns=[c for c in RESULT_COLS if c in rows.columns]), results_df], axis=1)
+
+
 def unmelt_results(results_df, cfg, remove_extra_cols=False):
-        unmelted_data = []
-        for src_id, group in results_df.groupby("src_id"):
-            src_code_row = group[group["code_type"] == "src_code"].iloc[0]
-            new_row = src_code_row.to_dict()
-            for index, row in group.iterrows():
-                new_row["src_id"] = src_id
-                new_row[f'{row["code_type"]}_compilation'] = row["compilation"]
-                new_row[f'{row["code_type"]}'] = row["code"]
-                if row["code_type"].startswith(cfg.model_generated_potentially_faster_code_col) or cfg.redo_src_tgt:
-                    new_row[f'{row["code_type"]}_accuracy'] = row["accuracy"]
-                    new_row[f'{row["code_type"]}_agg_runtime'] = row["agg_runtime"]
-                    new_row[f'{row["code_type"]}_tc2time'] = row["tc2time"]
-            unmelted_data.append(new_row)
-        ## clean up the column names
-        unmelted_df = pd.DataFrame(unmelted_data)
+        ## one row per src_id, starting from the columns of its src_code row, and one set of columns per code_type
+        unmelted_df = results_df[results_df["code_type"] == cfg.slow_code_col].drop_duplicates(subset=["src_id"]).set_index("src_id", drop=False).sort_index()
+        ## a src_id / code_type pair that appears more than once takes the values of the last row
+        results_df = results_df.drop_duplicates(subset=["src_id", "code_type"], keep="last")
+        new_cols = {}
+        for code_type, rows in results_df.groupby("code_type", sort=False):
+            rows = rows.set_index("src_id").reindex(unmelted_df.index)
+            new_cols[f'{code_type}_compilation'] = rows["compilation"]
+            new_cols[f'{code_type}'] = rows["code"]
+            if code_type.startswith(cfg.model_generated_potentially_faster_code_col) or cfg.redo_src_tgt:
+                new_cols[f'{code_type}_accuracy'] = rows["accuracy"]
+                new_cols[f'{code_type}_agg_runtime'] = rows["agg_runtime"]
+                new_cols[f'{code_type}_tc2time'] = rows["tc2time"]
+        unmelted_df = unmelted_df.assign(**new_cols).reset_index(drop=True)
         if remove_extra_cols:
             unmelted_df = get_key_columns(unmelted_df, cfg)
         
@@ -78,6 +144,34 @@ def unmelt_results(results_df, cfg, remove_extra_cols=False):
         
         return unmelted_df
         
+def estimate_at_k(speedups: np.ndarray, is_correct: np.ndarray, is_present: np.ndarray):
+    """
+    unbiased estimates of the expected best speedup and of pass@k for every k from the (n_programs x n_generations) matrices of 
+    the speedups of the generations, returned as two (n_programs x n_generations) matrices where column k - 1 is for k samples
+    with n generations of which c are correct, pass@k = 1 - C(n - c, k) / C(n, k) and the expected best speedup is 
+    sum_i s_(i) C(i - 1, k - 1) / C(n, k) over the speedups sorted in ascending order, NaN where k > n
+    """
+    n_programs, n_generations = speedups.shape
+    n = is_present.sum(axis=1)
+    c = (is_correct & is_present).sum(axis=1)
+    # comb[a, b] = C(a, b)
+    comb = np.array([[math.comb(a, b) for b in range(n_generations + 1)] for a in range(n_generations + 1)], dtype=float)
+    ks = np.arange(1, n_generations + 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # weights[m, i, k - 1] = C(i, k - 1) / C(m, k), the probability that the (i + 1)-th smallest of m values is the largest of k samples
+        weights = np.where(np.arange(n_generations + 1)[:, None, None] > np.arange(n_generations)[None, :, None], 
+                           comb[None, :n_generations, :n_generations] / comb[:, None, 1:], 0.0)
+        # missing generations are sorted last and get a weight of 0
+        sorted_speedups = np.sort(np.where(is_present, speedups, np.nan), axis=1)
+        weighted = sorted_speedups[:, :, None] * weights[n]
+        expected_speedups = np.where(weights[n] > 0, weighted, 0.0).sum(axis=1)
+        pass_at_k = 1.0 - comb[n - c][:, 1:] / comb[n][:, 1:]
+    too_few = ks[None, :] > n[:, None]
+    expected_speedups[too_few] = np.nan
+    pass_at_k[too_few] = np.nan
+    return expected_speedups, pass_at_k
+
+
 def report_results(df, cfg, orig_df): 
         ## all columns will be cfg.model_generated_potentially_faster_code_col_*
         ## for these, consider only use those that are not None, above threshold_accuracy, and have the fastest_runtime
@@ -137,68 +231,71 @@ def report_results(df, cfg, orig_df):
         print(f"unique rows columns {unique_rows.columns}")
         assert len(df) == 978, f"len(df) {len(df)} == 978"
         
-        new_rows = []
-        for i, row in df.iterrows():
-            for j in range(num_generated_cols):
-                colname = f"{cfg.model_generated_potentially_faster_code_col}_{j}" if num_generated_cols > 0 else cfg.model_generated_potentially_faster_code_col
-                # print(row)
-                if row[colname] is None or pd.isna(row[colname]) or pd.isnull(row[colname]):
-                    row[f"{colname}_agg_runtime_adjusted"] = float("inf")
-                if row[f"{colname}_accuracy"] < cfg.threshold_accuracy:
-                    row[f"{colname}_agg_runtime_adjusted"] = float("inf")
-                else: 
-                    row[f"{colname}_agg_runtime_adjusted"] = row[f"{colname}_agg_runtime"]
-            row["fastest_generated_agg_runtime"] = min([row[f"{cfg.model_generated_potentially_faster_code_col}_{j}_agg_runtime_adjusted"] for j in range(num_generated_cols)])
-            new_rows.append(row)
-            
-        df = pd.DataFrame(new_rows)
-        
-        problem_id_to_fastest_agg_runtime = {}
-        problem_id_to_fastest_correctness = {}
-        for i, group in df.groupby("problem_id"):
-            problem_id_to_fastest_agg_runtime[i] = group["fastest_generated_agg_runtime"].min()
-            problem_id_to_fastest_correctness[i] = problem_id_to_fastest_agg_runtime[i] < float("inf")
-            
-        df["fastest_generated_runtime_over_all_submissions"] = df["problem_id"].apply(lambda x: problem_id_to_fastest_agg_runtime[x])
-        df["fastest_generated_speedup_over_all_submissions"] = df[cfg.slow_code_col+"_agg_runtime"] / df["fastest_generated_runtime_over_all_submissions"]
-        df["fastest_generated_speedup_over_all_submissions"] = df["fastest_generated_speedup_over_all_submissions"].apply(lambda x: max(1.0, x))
-        df["fastest_generated_correctness_over_all_submissions"] = df["problem_id"].apply(lambda x: problem_id_to_fastest_correctness[x])
+        ## (n_programs x n_generations) matrices of the accuracies and runtimes of the generations
+        generated_colnames = [f"{cfg.model_generated_potentially_faster_code_col}_{j}" for j in range(num_generated_cols)]
+        accuracies = df[[f"{colname}_accuracy" for colname in generated_colnames]].to_numpy(dtype=float)
+        runtimes = df[[f"{colname}_agg_runtime" for colname in generated_colnames]].to_numpy(dtype=float)
+        ## generations below threshold_accuracy never finish, missing generations (NaN accuracy) keep their runtime
+        adjusted_runtimes = np.where(accuracies < cfg.threshold_accuracy, np.inf, runtimes)
+        ## same as the builtin min over the generations in order, which skips NaNs except for a leading one
+        fastest_generated_agg_runtime = adjusted_runtimes[:, 0]
+        for j in range(1, num_generated_cols):
+            fastest_generated_agg_runtime = np.where(adjusted_runtimes[:, j] < fastest_generated_agg_runtime, adjusted_runtimes[:, j], fastest_generated_agg_runtime)
+        ## column k - 1 holds the best of the first k generations, ignoring NaNs like DataFrame.min / max
+        best_runtimes = np.fmin.accumulate(adjusted_runtimes, axis=1)
+        best_accuracies = np.fmax.accumulate(accuracies, axis=1)
         
+        src_runtimes = df[cfg.slow_code_col+"_agg_runtime"].to_numpy(dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fastest_generated_runtime_over_all_submissions = pd.Series(fastest_generated_agg_runtime, index=df.index).groupby(df["problem_id"]).transform("min").to_numpy()
+            fastest_generated_speedup_over_all_submissions = np.fmax(src_runtimes / fastest_generated_runtime_over_all_submissions, 1.0)
+            speedups_best = np.fmax(src_runtimes[:, None] / best_runtimes, 1.0)
+            speedup_tgt_over_src = src_runtimes / df[cfg.reference_code_col+"_agg_runtime"].to_numpy(dtype=float)
         
+        new_cols = {f"{colname}_agg_runtime_adjusted": adjusted_runtimes[:, j] for j, colname in enumerate(generated_colnames)}
+        new_cols["fastest_generated_agg_runtime"] = fastest_generated_agg_runtime
+        new_cols["fastest_generated_runtime_over_all_submissions"] = fastest_generated_runtime_over_all_submissions
+        new_cols["fastest_generated_speedup_over_all_submissions"] = fastest_generated_speedup_over_all_submissions
+        new_cols["fastest_generated_correctness_over_all_submissions"] = fastest_generated_runtime_over_all_submissions < float("inf")
         for i in range(1, num_generated_cols+1):
-            if num_generated_cols == 0:
-                df[f"agg_runtime_best@{i}"] = df[f"{cfg.model_generated_potentially_faster_code_col}_agg_runtime_adjusted"]
-                df[f"accuracy_best@{i}"] = df[f"{cfg.model_generated_potentially_faster_code_col}_accuracy"]
-                df[f"is_correct_best@{i}"] = df[f"accuracy_best@{i}"] == cfg.threshold_accuracy
-            else:
-                df[f"agg_runtime_best@{i}"] = df[[f"{cfg.model_generated_potentially_faster_code_col}_{j}_agg_runtime_adjusted" for j in range(i)]].min(axis=1)
-                df[f"accuracy_best@{i}"] = df[[f"{cfg.model_generated_potentially_faster_code_col}_{j}_accuracy" for j in range(i)]].max(axis=1)
-                df[f"is_correct_best@{i}"] = df[f"accuracy_best@{i}"] == cfg.threshold_accuracy
-            df[f"speedup_best@{i}"] = df[cfg.slow_code_col+"_agg_runtime"] / df[f"agg_runtime_best@{i}"]
-            df[f"speedup_best@{i}"] = df[f"speedup_best@{i}"].apply(lambda x: max(1.0, x))
-            df["speedup_of_fastest_generated_of_all_submissions"] = df[cfg.slow_code_col+"_agg_runtime"] / df["fastest_generated_runtime_over_all_submissions"]
-            df["speedup_of_fastest_generated_of_all_submissions"] = df["speedup_of_fastest_generated_of_all_submissions"].apply(lambda x: max(1.0, x))
-        
-        ## aggregate over all rows
-        agg_df = pd.DataFrame(index=[0])
-        # agg_df["fastest_generated_runtime_over_all_submissions"] = df["fastest_generated_runtime_over_all_submissions"].mean()
-        agg_df["fastest_generated_correctness_over_all_submissions"] = df["fastest_generated_correctness_over_all_submissions"].mean()
-        agg_df["fastest_generated_speedup_over_all_submissions"] = df["fastest_generated_speedup_over_all_submissions"].mean()
-        # import pdb
+            new_cols[f"agg_runtime_best@{i}"] = best_runtimes[:, i - 1]
+            new_cols[f"accuracy_best@{i}"] = best_accuracies[:, i - 1]
+            new_cols[f"is_correct_best@{i}"] = best_accuracies[:, i - 1] == cfg.threshold_accuracy
+            new_cols[f"speedup_best@{i}"] = speedups_best[:, i - 1]
+            new_cols["speedup_of_fastest_generated_of_all_submissions"] = fastest_generated_speedup_over_all_submissions
+        new_cols["speedup_tgt_over_src"] = speedup_tgt_over_src
+        ## unbiased estimates over all the generations of a program rather than the first k
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speedups = np.fmax(src_runtimes[:, None] / adjusted_runtimes, 1.0)
+        expected_speedups, pass_at_k = estimate_at_k(speedups, accuracies >= cfg.threshold_accuracy, ~np.isnan(accuracies))
         for i in range(1, num_generated_cols+1):
-            # pdb.set_trace()
-            agg_df[f"mean_accuracy_best@{i}"] = df[f"accuracy_best@{i}"].mean()
-            agg_df[f"is_correct_best@{i}"] = df[f"is_correct_best@{i}"].mean()
-            agg_df[f"mean_speedup_best@{i}"] = df[f"speedup_best@{i}"].mean()
-            for speedup_threshold in [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]:
-                agg_df[f"percent_programs_speedup_best@{i}>=speedup_threshold_{speedup_threshold}"] = (df[f"speedup_best@{i}"] >= speedup_threshold).mean()
-                
-        ## add the speedup of tgt_code over src_code and the threshold speedups of tgt_code over src_code
-        df["speedup_tgt_over_src"] = df[cfg.slow_code_col+"_agg_runtime"] / df[cfg.reference_code_col+"_agg_runtime"]
-        agg_df["mean_speedup_tgt_over_src"] = df["speedup_tgt_over_src"].mean()
-        for speedup_threshold in [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]:
-            agg_df[f"percent_programs_speedup_tgt_over_src>=speedup_threshold_{speedup_threshold}"] = (df["speedup_tgt_over_src"] >= speedup_threshold).mean()
-            agg_df[f"percent_programs_speedup_fastest_generated_over_src>=speedup_threshold_{speedup_threshold}"] = (df["speedup_of_fastest_generated_of_all_submissions"] >= speedup_threshold).mean()
+            new_cols[f"expected_speedup@{i}"] = expected_speedups[:, i - 1]
+            new_cols[f"pass@{i}"] = pass_at_k[:, i - 1]
+        df = pd.concat([df.drop(columns=[c for c in new_cols if c in df.columns]), pd.DataFrame(new_cols, index=df.index)], axis=1)
+        
+        ## aggregate over all rows, the means skip NaNs like Series.mean
+        speedup_thresholds = [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]
+        agg = {}
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            agg["fastest_generated_correctness_over_all_submissions"] = np.mean(new_cols["fastest_generated_correctness_over_all_submissions"])
+            agg["fastest_generated_speedup_over_all_submissions"] = np.nanmean(fastest_generated_speedup_over_all_submissions)
+            for i in range(1, num_generated_cols+1):
+                agg[f"mean_accuracy_best@{i}"] = np.nanmean(best_accuracies[:, i - 1])
+                agg[f"is_correct_best@{i}"] = np.mean(new_cols[f"is_correct_best@{i}"])
+                agg[f"mean_speedup_best@{i}"] = np.nanmean(speedups_best[:, i - 1])
+                for speedup_threshold in speedup_thresholds:
+                    agg[f"percent_programs_speedup_best@{i}>=speedup_threshold_{speedup_threshold}"] = np.mean(speedups_best[:, i - 1] >= speedup_threshold)
+                    
+            ## add the speedup of tgt_code over src_code and the threshold speedups of tgt_code over src_code
+            agg["mean_speedup_tgt_over_src"] = np.nanmean(speedup_tgt_over_src)
+            for speedup_threshold in speedup_thresholds:
+                agg[f"percent_programs_speedup_tgt_over_src>=speedup_threshold_{speedup_threshold}"] = np.mean(speedup_tgt_over_src >= speedup_threshold)
+                agg[f"percent_programs_speedup_fastest_generated_over_src>=speedup_threshold_{speedup_threshold}"] = np.mean(fastest_generated_speedup_over_all_submissions >= speedup_threshold)
+            for i in range(1, num_generated_cols+1):
+                agg[f"mean_expected_speedup@{i}"] = np.nanmean(expected_speedups[:, i - 1])
+                agg[f"pass@{i}"] = np.nanmean(pass_at_k[:, i - 1])
+        agg_df = pd.DataFrame(agg, index=[0])
         
         ## pretty print out a report 
         
@@ -212,6 +309,7 @@ def report_results(df, cfg, orig_df):
             print(f"mean_accuracy_best@{i}: {mean_accuracy}")
             print(f"mean correctness best@{i}: {agg_df[f'is_correct_best@{i}'][0]}")
             print(f"mean_speedup_best@{i}: {mean_speedup} vs. mean_speedup_tgt_over_src: {agg_df['mean_speedup_tgt_over_src'][0]}")
+            print(f"mean_expected_speedup@{i}: {agg_df[f'mean_expected_speedup@{i}'][0]}, pass@{i}: {agg_df[f'pass@{i}'][0]}")
             for speedup_threshold in [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]:
                 percent_programs = agg_df[f"percent_programs_speedup_best@{i}>=speedup_threshold_{speedup_threshold}"][0]
                 percent_programs_tgt_over_src = agg_df[f"percent_programs_speedup_tgt_over_src>=speedup_threshold_{speedup_threshold}"][0]
@@ -234,7 +332,7 @@ env = None
 def sigint_handler(signum, frame):
     global env
     print("Ctrl-C pressed, running teardown...")
-    if threading.current_thread().name == "MainThread":
+    if threading.current_thread().name == "MainThread" and env is not None:
         env.teardown()
     print("Teardown complete, exiting...")
     exit(0)
@@ -244,18 +342,242 @@ signal.signal(signal.SIGINT, sigint_handler)
 
 
 
+def read_checkpoint(checkpoint_path: str) -> list:
+    """Reads the rows checkpointed by main, ignoring a trailing line that was only partially written before a crash."""
+    rows = []
+    if not os.path.exists(checkpoint_path):
+        return rows
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            try: 
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping a partially written line in {checkpoint_path}")
+                continue
+            # to_json writes inf runtimes (failed or timed out programs) as null
+            if row.get("agg_runtime") is None:
+                row["agg_runtime"] = float("inf")
+            if isinstance(row.get("tc2time"), dict):
+                row["tc2time"] = {int(tc_no): float("inf") if t is None else t for tc_no, t in row["tc2time"].items()}
+            rows.append(row)
+    return rows
+
+
+def open_checkpoint(checkpoint_path: str):
+    """Opens the checkpoint for appending rows, terminating a partially written last line, which read_checkpoint skips."""
+    checkpoint_file = open(checkpoint_path, "a+")
+    if checkpoint_file.tell() > 0:
+        checkpoint_file.seek(checkpoint_file.tell() - 1)
+        if checkpoint_file.read(1) != "\n":
+            checkpoint_file.write("\n")
+    return checkpoint_file
+
+
+def checkpoint_fingerprint(code: str, problem_id: str, tests, config: dict) -> str:
+    """sha256 of what a result depends on, so that a checkpointed result is only reused for the same code, problem, tests and settings"""
+    key = json.dumps([hashlib.sha256(code.encode("utf-8")).hexdigest(), str(problem_id), sorted(int(t) for t in tests), config], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def make_checkpoint_line(src_id, code_type: str, fingerprint: str, record: dict) -> str:
+    # to_json writes inf as null, which read_checkpoint turns back into inf
+    return pd.Series({"src_id": src_id, "code_type": code_type, "fingerprint": fingerprint, **record}).to_json() + "\n"
+
+
+def results_path(cfg, name: str) -> str:
+    return os.path.join(cfg.output_dir, f"{name}.{cfg.output_format}")
+
+
+def _stats_value_to_list(value) -> list:
+    ## multi-valued stats (distributions) have more than one value, non-numeric values are stored as null
+    values = value if isinstance(value, list) else [value]
+    return [float(v) if isinstance(v, (int, float)) else None for v in values]
+
+
+def _to_arrow_column(name: str, values: pd.Series):
+    """
+    tc2time columns are stored as map<int64, double> and tc2stats columns as map<int64, map<string, list<double>>>, 
+    the other columns are converted by arrow, or stored as json strings if arrow cannot infer a type for them
+    """
+    if name.endswith("tc2time"):
+        return pa.array([[(int(tc_no), t) for tc_no, t in d.items()] if isinstance(d, dict) else None for d in values], 
+                        type=pa.map_(pa.int64(), pa.float64())), False
+    if name.endswith("tc2stats"):
+        return pa.array([[(int(tc_no), [(key, _stats_value_to_list(value)) for key, value in stats.items()] if isinstance(stats, dict) else None) 
+                          for tc_no, stats in d.items()] if isinstance(d, dict) else None for d in values], 
+                        type=pa.map_(pa.int64(), pa.map_(pa.string(), pa.list_(pa.float64())))), False
+    ## arrow would store dicts as structs with the union of their keys
+    if not any(isinstance(v, dict) for v in values):
+        try: 
+            return pa.array(values, from_pandas=True), False
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            pass
+    return pa.array([json.dumps(v, default=str) for v in values], type=pa.string()), True
+
+
+def _from_arrow_column(name: str, column, is_json: bool) -> list:
+    if is_json:
+        return [json.loads(v) if v is not None else None for v in column.to_pylist()]
+    if name.endswith("tc2time"):
+        return [dict(d) if d is not None else None for d in column.to_pylist()]
+    if name.endswith("tc2stats"):
+        return [{tc_no: {key: (v[0] if len(v) == 1 else v) for key, v in stats} if stats is not None else None for tc_no, stats in d} 
+                if d is not None else None for d in column.to_pylist()]
+    ## lists are read back as lists rather than numpy arrays
+    return column.to_pylist()
+
+
+def write_results(df: pd.DataFrame, path: str, output_format: str = "jsonl", partition_cols: Optional[List[str]] = None):
+    """
+    writes df as jsonl records, or as parquet with tc2time / tc2stats as nested map columns; 
+    with partition_cols the parquet is a directory with one file per value of the partition columns
+    """
+    if output_format == "jsonl":
+        df.to_json(path, orient="records", lines=True)
+        return
+    if output_format != "parquet":
+        raise ValueError(f"output_format must be jsonl or parquet, got {output_format}")
+    if pq is None:
+        raise ImportError("pyarrow is required for output_format: parquet, install it with pip install pyarrow")
+    arrays = {}
+    json_columns = []
+    for name in df.columns:
+        arrays[str(name)], is_json = _to_arrow_column(str(name), df[name])
+        if is_json:
+            json_columns.append(str(name))
+    table = pa.table(arrays).replace_schema_metadata({"json_columns": json.dumps(json_columns)})
+    ## both a previous file and a previous dataset are replaced, write_to_dataset would add files next to the old ones
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    if partition_cols:
+        pq.write_to_dataset(table, root_path=path, partition_cols=partition_cols)
+    else: 
+        pq.write_table(table, path)
+
+
+def read_results(path: str, output_format: str = "jsonl", columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Reads the results written by write_results, only parsing the given columns (all of them if None)."""
+    if output_format == "jsonl":
+        df = pd.read_json(path, orient="records", lines=True)
+        return df if columns is None else df[columns]
+    if pq is None:
+        raise ImportError("pyarrow is required for output_format: parquet, install it with pip install pyarrow")
+    table = pq.read_table(path, columns=columns)
+    metadata = table.schema.metadata or {}
+    json_columns = set(json.loads(metadata.get(b"json_columns", b"[]")))
+    nested_columns = [name for name in table.column_names if name in json_columns or pa.types.is_nested(table.schema.field(name).type)]
+    df = table.drop_columns(nested_columns).to_pandas()
+    for name in nested_columns:
+        df[name] = _from_arrow_column(name, table.column(name), name in json_columns)
+    ## partition columns are read back as categoricals
+    for name in df.columns:
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype(df[name].cat.categories.dtype)
+    return df[table.column_names]
+
+
+# the arguments of simulator.make used by main
+ENV_KWARGS = dict(timeout_seconds_gem5=120, verbose=True, use_logical_cpus=True, port=8888, workers=-1, exit_early_on_fail=True)
+
+# the settings of the environment that the results depend on
+REFERENCE_CONFIG_KEYS = ["arch", "cstd", "optimization_flag", "cpu_type", "timeout_seconds_gem5", "gem5_acc_threshold", "exit_early_on_fail"]
+
+RESULT_COLS = ["compilation", "accuracy", "agg_runtime", "tc2time", "tc2stats"]
+
+
+def get_reference_config(cfg) -> dict:
+    env_defaults = {name: param.default for name, param in inspect.signature(simulator.PieEnvironment.__init__).parameters.items() 
+                    if param.default is not inspect.Parameter.empty}
+    env_kwargs = {**env_defaults, **ENV_KWARGS}
+    return {**{key: env_kwargs[key] for key in REFERENCE_CONFIG_KEYS}, "stat_keys": cfg.stat_keys}
+
+
+class ReferenceRuntimeStore: 
+    """
+    sqlite store of the results of the reference (src_code / tgt_code) programs shared across evaluation runs, keyed by the hash of the code, 
+    the problem, the tests and the settings of the environment, so that redo_src_tgt only simulates references that were never run before
+    """
+    def __init__(self, db_path: str, reference_config: dict):
+        self.db_path = db_path
+        self.config_key = json.dumps(reference_config, sort_keys=True)
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS reference_results (
+                                code_sha256 TEXT NOT NULL, 
+                                problem_id TEXT NOT NULL, 
+                                tests TEXT NOT NULL, 
+                                config TEXT NOT NULL, 
+                                result TEXT NOT NULL, 
+                                created_at REAL NOT NULL, 
+                                PRIMARY KEY (code_sha256, problem_id, tests, config))""")
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=60)
+    
+    def _make_key(self, code: str, problem_id: str, tests) -> tuple:
+        return (hashlib.sha256(code.encode("utf-8")).hexdigest(), str(problem_id), json.dumps(sorted(int(t) for t in tests)), self.config_key)
+    
+    def get(self, code: str, problem_id: str, tests) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT result FROM reference_results WHERE code_sha256 = ? AND problem_id = ? AND tests = ? AND config = ?", 
+                               self._make_key(code, problem_id, tests)).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        # json object keys are strings
+        for col in ["tc2time", "tc2stats"]:
+            if isinstance(result.get(col), dict):
+                result[col] = {int(tc_no): value for tc_no, value in result[col].items()}
+        return result
+    
+    def put(self, code: str, problem_id: str, tests, result: dict):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO reference_results VALUES (?, ?, ?, ?, ?, ?)", 
+                         (*self._make_key(code, problem_id, tests), json.dumps(result, default=lambda x: x.item()), time.time()))
+
+
+def normalize_code(code: str) -> str:
+    """
+    Strips each line and drops blank lines, so that generations that only differ in whitespace are submitted once. 
+    This can change what a program does, e.g. the whitespace inside a raw string literal or after a backslash continuation.
+    """
+    return "\n".join(line.strip() for line in code.splitlines() if line.strip())
+
+
+def group_duplicate_submissions(codes: list, problem_ids: list, tests: list, normalize: bool = False) -> List[List[int]]:
+    """Groups the indices of the submissions with the same code (normalized if normalize), problem and tests, in order of first occurrence."""
+    key_to_indices = {}
+    for index, (code, problem_id, tcs) in enumerate(zip(codes, problem_ids, tests)):
+        key = (normalize_code(code) if normalize else code, str(problem_id), tuple(sorted(int(t) for t in tcs)))
+        key_to_indices.setdefault(key, []).append(index)
+    return list(key_to_indices.values())
+
+
 def read_inputs_and_prepare_v2(cfg) -> pd.DataFrame:
     """Reads the model generated output, the reference, joins them, and returns a dataframe with the merged data."""
     logging.info(f"Reading reference file from {cfg.reference_file_path}")
     logging.info(f"Reading model generated outputs from {cfg.model_generated_outputs_path}")
 
     
-    gen_df = pd.read_json(
-        cfg.model_generated_outputs_path, lines=True, orient="records"
-    )
-    gen_df = fix_df_columns(gen_df)
+    ## the file is parsed in chunks, and programs that are not evaluated are dropped before the next chunk is read
+    chunks = []
+    n_rows = 0
+    n_kept = 0
+    for chunk in iter_jsonl_chunks(cfg.model_generated_outputs_path, get_input_columns(cfg), cfg.read_chunksize):
+        n_rows += len(chunk)
+        chunk = fix_df_columns(chunk)
+        if cfg.slow_code_col in chunk.columns and cfg.reference_code_col in chunk.columns:
+            chunk = chunk[chunk[cfg.slow_code_col] != chunk[cfg.reference_code_col]]
+        chunks.append(chunk)
+        n_kept += len(chunk)
+        if cfg.num_problems_to_evaluate != -1 and n_kept >= cfg.num_problems_to_evaluate:
+            break
+    gen_df = pd.concat(chunks) if len(chunks) > 0 else pd.DataFrame()
     
-    logging.info(f"Read {len(gen_df)} rows from {cfg.model_generated_outputs_path}")
+    logging.info(f"Read {n_rows} rows from {cfg.model_generated_outputs_path}")
     if cfg.is_prompt_based:
         gen_df["slower_program"] = gen_df.apply(
             lambda x: get_input_from_prompt(x), axis=1
@@ -289,11 +611,11 @@ def read_inputs_and_prepare_v2(cfg) -> pd.DataFrame:
             merged[cfg.model_generated_potentially_faster_code_col] = merged[cfg.model_generated_potentially_faster_code_col].apply(lambda x: ast.literal_eval(x))
         if isinstance(merged[cfg.model_generated_potentially_faster_code_col].iloc[0], pd.Series):
             merged[cfg.model_generated_potentially_faster_code_col] = merged[cfg.model_generated_potentially_faster_code_col].apply(lambda x: x.tolist())
-        num_generations = max(merged[cfg.model_generated_potentially_faster_code_col].apply(lambda x: len(x)).tolist())
-        
-        for i in range(num_generations):
-            merged[f"{cfg.model_generated_potentially_faster_code_col}_{i}"] = merged[cfg.model_generated_potentially_faster_code_col].apply(lambda x: x[i] if i < len(x) else None)
-            # so merged will have the same number of columns for all rows, but some rows will have None in some columns (because they have fewer generations)
+        # one column per generation, built from the lists in a single pass
+        # so merged will have the same number of columns for all rows, but some rows will have None in some columns (because they have fewer generations)
+        generations = pd.DataFrame(merged[cfg.model_generated_potentially_faster_code_col].tolist(), index=merged.index)
+        num_generations = generations.shape[1]
+        merged = pd.concat([merged, generations.rename(columns=lambda i: f"{cfg.model_generated_potentially_faster_code_col}_{i}")], axis=1)
     else: 
         num_generations = 1
             
@@ -306,7 +628,7 @@ def read_inputs_and_prepare_v2(cfg) -> pd.DataFrame:
 def main(cfg):
     # Step 0
     merged = read_inputs_and_prepare_v2(cfg)
-    reference_df = pd.read_json(cfg.reference_file_path, lines=True, orient="records")
+    reference_df = pd.concat(list(iter_jsonl_chunks(cfg.reference_file_path, get_input_columns(cfg), cfg.read_chunksize)))
     
     logging.info(f"Number of programs to evaluate: {len(merged)}")
     logging.info(f"Input column: {cfg.slow_code_col}")
@@ -349,7 +671,9 @@ def main(cfg):
     # sort by "n_tests"
     melted = melted.sort_values(by=["n_tests"], ascending=False)
     
-    if not os.path.exists(os.path.join(cfg.output_dir, "test_results.jsonl")):
+    if cfg.output_format == "parquet" and pq is None:
+        raise ImportError("pyarrow is required for output_format: parquet, install it with pip install pyarrow")
+    if not os.path.exists(results_path(cfg, "test_results")):
         # drop any rows where the code length is 0
         melted = melted[melted["code"].apply(lambda x: len(x) > 0)]
         logging.info(f"Dropped {orig_len - len(melted)} rows with NA or empty code")
@@ -372,42 +696,104 @@ def main(cfg):
             if not os.path.exists(cfg.output_dir):
                 os.makedirs(cfg.output_dir)
             global env
-            env = simulator.make(timeout_seconds_gem5=120, verbose=True, use_logical_cpus=True, port=8888, workers=-1, exit_early_on_fail=True)
-            ## iterate in batches of cpus_available, env.submit_mutliple_single_submissions() will submit the batch at once
-            new_rows = []
-            pbar = tqdm(total=len(melted), desc=f"Submitting {len(melted)} programs to evaluate", smoothing=0)
-            if cfg.cpus_available == -1: 
-                cfg.cpus_available = len(melted)
-            # legacy - we used to submit in batches
-            batch = melted
-            # currently sorting the list of tests in reverse order of length, so that the (potentially) longest tests are run first
-            # this will may give more "conservative" estimates of the runtime with tqdm
-            results = env.submit_multiple_single_submissions(batch["code"].tolist(),
-                                                                [sorted(list(t), reverse=True) for t in batch["tests"].tolist()],
-                                                                batch["problem_id"].tolist(),
-                                                                "gem5")
-            
-            # zip the rows and results together
-            for (i, row), result in zip(batch.iterrows(), results):
-                row["compilation"] = result.compilation
-                row["accuracy"] = result.mean_acc
-                row["agg_runtime"] = result.agg_runtime
-                row["tc2time"] = result.tc2time
-                row["tc2stats"] = result.tc2stats # this is a lot of data, toggle if we need all the outputs from gem5's stats.txt
-                new_rows.append(row)
-            # pbar.update(len(batch))
-            melted = pd.DataFrame(new_rows)
-            melted.to_json(
-                f"{cfg.output_dir}/melted_test_results.jsonl", 
-                orient="records",
-                lines=True
-            )
-            env.teardown()
+            ## results are checkpointed as they arrive, so that a restarted evaluation only submits the missing rows
+            checkpoint_path = os.path.join(cfg.output_dir, "melted_test_results.checkpoint.jsonl")
+            ## the results are kept as records next to the positions of their rows in melted, and joined back once at the end
+            src_ids = melted["src_id"].tolist()
+            codes = melted["code"].tolist()
+            code_types = melted["code_type"].tolist()
+            problem_ids = melted["problem_id"].tolist()
+            tests = melted["tests"].tolist()
+            ## checkpointed results are only reused for rows with the same code, problem, tests and settings, 
+            ## e.g. not after output_dir is pointed at a new generations file
+            reference_config = get_reference_config(cfg)
+            fingerprints = [checkpoint_fingerprint(code, problem_id, tcs, reference_config) for code, problem_id, tcs in zip(codes, problem_ids, tests)]
+            key_to_position = {(str(src_id), code_type): position for position, (src_id, code_type) in enumerate(zip(src_ids, code_types))}
+            result_positions = []
+            result_records = []
+            checkpointed_positions = set()
+            n_stale = 0
+            for row in read_checkpoint(checkpoint_path):
+                position = key_to_position.get((str(row["src_id"]), row["code_type"]))
+                if position is None or position in checkpointed_positions:
+                    continue
+                if row.get("fingerprint") != fingerprints[position]:
+                    n_stale += 1
+                    continue
+                checkpointed_positions.add(position)
+                result_positions.append(position)
+                result_records.append({col: row.get(col) for col in RESULT_COLS})
+            batch_positions = np.array([position for position in range(len(melted)) if position not in checkpointed_positions], dtype=int)
+            if n_stale > 0:
+                logging.warning(f"Ignoring {n_stale} checkpointed rows in {checkpoint_path} whose code, tests or settings changed")
+            logging.info(f"Resuming from {len(result_positions)} checkpointed rows in {checkpoint_path}, {len(batch_positions)} rows left to evaluate")
+            reference_store = None
+            if cfg.redo_src_tgt and cfg.reference_store_path is not None:
+                reference_store = ReferenceRuntimeStore(os.path.expanduser(cfg.reference_store_path), reference_config)
+                is_stored = np.zeros(len(batch_positions), dtype=bool)
+                n_references = 0
+                with open_checkpoint(checkpoint_path) as checkpoint_file:
+                    for index, position in enumerate(batch_positions):
+                        if code_types[position] not in (cfg.slow_code_col, cfg.reference_code_col):
+                            continue
+                        n_references += 1
+                        stored_result = reference_store.get(codes[position], problem_ids[position], tests[position])
+                        if stored_result is None:
+                            continue
+                        record = {col: stored_result[col] for col in RESULT_COLS}
+                        result_positions.append(position)
+                        result_records.append(record)
+                        checkpoint_file.write(make_checkpoint_line(src_ids[position], code_types[position], fingerprints[position], record))
+                        is_stored[index] = True
+                logging.info(f"Reusing {is_stored.sum()} of {n_references} reference results from {cfg.reference_store_path}")
+                batch_positions = batch_positions[~is_stored]
+            if len(batch_positions) > 0:
+                ## identical generations (e.g. with best_of sampling) are only submitted once, and their result is copied to every row
+                if cfg.dedup_submissions:
+                    duplicate_groups = group_duplicate_submissions([codes[position] for position in batch_positions], 
+                                                                   [problem_ids[position] for position in batch_positions], 
+                                                                   [tests[position] for position in batch_positions], 
+                                                                   normalize=cfg.dedup_normalize_whitespace)
+                else: 
+                    duplicate_groups = [[index] for index in range(len(batch_positions))]
+                unique_positions = [batch_positions[indices[0]] for indices in duplicate_groups]
+                logging.info(f"Submitting {len(unique_positions)} unique programs for {len(batch_positions)} rows")
+                env = simulator.make(**ENV_KWARGS)
+                pbar = tqdm(total=len(batch_positions), desc=f"Submitting {len(unique_positions)} programs to evaluate", smoothing=0)
+                if cfg.cpus_available == -1: 
+                    cfg.cpus_available = len(unique_positions)
+                # currently sorting the list of tests in reverse order of length, so that the (potentially) longest tests are run first
+                # this will may give more "conservative" estimates of the runtime with tqdm
+                # results are streamed back as each submission completes, so that the progress bar reflects the actual progress
+                with open_checkpoint(checkpoint_path) as checkpoint_file:
+                    for index, result in env.iter_multiple_single_submissions([codes[position] for position in unique_positions],
+                                                                               [sorted(list(tests[position]), reverse=True) for position in unique_positions],
+                                                                               [problem_ids[position] for position in unique_positions],
+                                                                               "gem5", 
+                                                                               stat_keys=cfg.stat_keys):
+                        # tc2stats is a lot of data, it is shared (not copied) by the rows of duplicates
+                        record = {"compilation": result.compilation, "accuracy": result.mean_acc, "agg_runtime": result.agg_runtime, 
+                                  "tc2time": result.tc2time, "tc2stats": result.tc2stats}
+                        for batch_index in duplicate_groups[index]:
+                            position = batch_positions[batch_index]
+                            result_positions.append(position)
+                            result_records.append(record)
+                            # only keep correct references with a runtime, a failure may be transient
+                            if reference_store is not None and code_types[position] in (cfg.slow_code_col, cfg.reference_code_col) \
+                                    and record["accuracy"] >= cfg.threshold_accuracy and np.isfinite(record["agg_runtime"]):
+                                reference_store.put(codes[position], problem_ids[position], tests[position], record)
+                            checkpoint_file.write(make_checkpoint_line(src_ids[position], code_types[position], fingerprints[position], record))
+                        checkpoint_file.flush()
+                        pbar.update(len(duplicate_groups[index]))
+                pbar.close()
+                env.teardown()
+            melted = join_results(melted, result_positions, result_records)
+            write_results(melted, results_path(cfg, "melted_test_results"), cfg.output_format, partition_cols=["code_type"] if cfg.output_format == "parquet" else None)
         ## if we get an exception, we still want to teardown the environment because it will likely leave a docker container running
         except Exception as e:
             print(e)
             traceback.print_exc()
-            if threading.current_thread().name == "MainThread":
+            if threading.current_thread().name == "MainThread" and env is not None:
                 # global env
                 env.teardown()
             raise e
@@ -418,17 +804,9 @@ def main(cfg):
         
         unmelted_df = unmelt_results(melted, cfg)
         
-        unmelted_df.to_json(
-            f"{cfg.output_dir}/test_results.jsonl",
-            orient="records",
-            lines=True
-        )
+        write_results(unmelted_df, results_path(cfg, "test_results"), cfg.output_format)
     else:
-        unmelted_df = pd.read_json(
-            f"{cfg.output_dir}/test_results.jsonl",
-            orient="records",
-            lines=True
-        )
+        unmelted_df = read_results(results_path(cfg, "test_results"), cfg.output_format)
     
     agg_df, result_df = report_results(unmelted_df, cfg, reference_df)
     
@@ -437,11 +815,7 @@ def main(cfg):
         index=False
     )
     
-    result_df.to_json(
-        f"{cfg.output_dir}/addtl_stats.jsonl",
-        orient="records",
-        lines=True
-    )
+    write_results(result_df, results_path(cfg, "addtl_stats"), cfg.output_format)
     
     print(f"Results written to {cfg.output_dir}")
     
@@ -462,6 +836,20 @@ class EvaluationConfig:
     threshold_accuracy: float = 1.0
     redo_src_tgt: bool = False
     num_generated_cols: int = None
+    # the gem5 stats kept in tc2stats: None for all of them, "none" or a list of stat names (sim_seconds_precise is always kept)
+    stat_keys: Optional[Union[str, List[str]]] = None
+    # results of the references shared across runs and reused with redo_src_tgt, None to always simulate them
+    reference_store_path: Optional[str] = "~/.cache/pie-perf/reference_runtimes.sqlite3"
+    # submit programs with the same code, problem and tests once and copy the result to all of their rows
+    dedup_submissions: bool = True
+    # also treat programs that only differ in the whitespace around their lines as the same (see normalize_code)
+    dedup_normalize_whitespace: bool = False
+    # the columns of the model generated outputs to keep besides the ones evaluation needs, None to keep all of them
+    input_columns: Optional[List[str]] = None
+    # the number of lines of the model generated outputs parsed at a time
+    read_chunksize: int = 10000
+    # the format of melted_test_results, test_results and addtl_stats: "jsonl" or "parquet" (requires pyarrow)
+    output_format: str = "jsonl"
 
 def load_config(yaml_path: str) -> EvaluationConfig:
     with open(yaml_path, 'r') as f:
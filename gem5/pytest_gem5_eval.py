@@ -0,0 +1,338 @@
+import itertools
+import json
+import os
+import tempfile
+import types
+import numpy as np
+import pandas as pd
+import pytest
+from gem5 import gem5_eval
+
+
+def report_results_before_vectorizing(df, cfg):
+    """frozen copy of the per-row loop of report_results before it was vectorized, run on the padded results"""
+    num_generated_cols = cfg.num_generated_cols
+    new_rows = []
+    for i, row in df.iterrows():
+        for j in range(num_generated_cols):
+            colname = f"{cfg.model_generated_potentially_faster_code_col}_{j}" if num_generated_cols > 0 else cfg.model_generated_potentially_faster_code_col
+            if row[colname] is None or pd.isna(row[colname]) or pd.isnull(row[colname]):
+                row[f"{colname}_agg_runtime_adjusted"] = float("inf")
+            if row[f"{colname}_accuracy"] < cfg.threshold_accuracy:
+                row[f"{colname}_agg_runtime_adjusted"] = float("inf")
+            else: 
+                row[f"{colname}_agg_runtime_adjusted"] = row[f"{colname}_agg_runtime"]
+        row["fastest_generated_agg_runtime"] = min([row[f"{cfg.model_generated_potentially_faster_code_col}_{j}_agg_runtime_adjusted"] for j in range(num_generated_cols)])
+        new_rows.append(row)
+    df = pd.DataFrame(new_rows)
+    
+    problem_id_to_fastest_agg_runtime = {}
+    problem_id_to_fastest_correctness = {}
+    for i, group in df.groupby("problem_id"):
+        problem_id_to_fastest_agg_runtime[i] = group["fastest_generated_agg_runtime"].min()
+        problem_id_to_fastest_correctness[i] = problem_id_to_fastest_agg_runtime[i] < float("inf")
+    df["fastest_generated_runtime_over_all_submissions"] = df["problem_id"].apply(lambda x: problem_id_to_fastest_agg_runtime[x])
+    df["fastest_generated_speedup_over_all_submissions"] = df[cfg.slow_code_col+"_agg_runtime"] / df["fastest_generated_runtime_over_all_submissions"]
+    df["fastest_generated_speedup_over_all_submissions"] = df["fastest_generated_speedup_over_all_submissions"].apply(lambda x: max(1.0, x))
+    df["fastest_generated_correctness_over_all_submissions"] = df["problem_id"].apply(lambda x: problem_id_to_fastest_correctness[x])
+    
+    for i in range(1, num_generated_cols+1):
+        df[f"agg_runtime_best@{i}"] = df[[f"{cfg.model_generated_potentially_faster_code_col}_{j}_agg_runtime_adjusted" for j in range(i)]].min(axis=1)
+        df[f"accuracy_best@{i}"] = df[[f"{cfg.model_generated_potentially_faster_code_col}_{j}_accuracy" for j in range(i)]].max(axis=1)
+        df[f"is_correct_best@{i}"] = df[f"accuracy_best@{i}"] == cfg.threshold_accuracy
+        df[f"speedup_best@{i}"] = df[cfg.slow_code_col+"_agg_runtime"] / df[f"agg_runtime_best@{i}"]
+        df[f"speedup_best@{i}"] = df[f"speedup_best@{i}"].apply(lambda x: max(1.0, x))
+        df["speedup_of_fastest_generated_of_all_submissions"] = df[cfg.slow_code_col+"_agg_runtime"] / df["fastest_generated_runtime_over_all_submissions"]
+        df["speedup_of_fastest_generated_of_all_submissions"] = df["speedup_of_fastest_generated_of_all_submissions"].apply(lambda x: max(1.0, x))
+    
+    agg_df = pd.DataFrame(index=[0])
+    agg_df["fastest_generated_correctness_over_all_submissions"] = df["fastest_generated_correctness_over_all_submissions"].mean()
+    agg_df["fastest_generated_speedup_over_all_submissions"] = df["fastest_generated_speedup_over_all_submissions"].mean()
+    for i in range(1, num_generated_cols+1):
+        agg_df[f"mean_accuracy_best@{i}"] = df[f"accuracy_best@{i}"].mean()
+        agg_df[f"is_correct_best@{i}"] = df[f"is_correct_best@{i}"].mean()
+        agg_df[f"mean_speedup_best@{i}"] = df[f"speedup_best@{i}"].mean()
+        for speedup_threshold in [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]:
+            agg_df[f"percent_programs_speedup_best@{i}>=speedup_threshold_{speedup_threshold}"] = (df[f"speedup_best@{i}"] >= speedup_threshold).mean()
+    df["speedup_tgt_over_src"] = df[cfg.slow_code_col+"_agg_runtime"] / df[cfg.reference_code_col+"_agg_runtime"]
+    agg_df["mean_speedup_tgt_over_src"] = df["speedup_tgt_over_src"].mean()
+    for speedup_threshold in [1.10, 1.25, 1.50, 1.75, 2.0, 2.5, 3.0, 4.0, 5.0, 10.0]:
+        agg_df[f"percent_programs_speedup_tgt_over_src>=speedup_threshold_{speedup_threshold}"] = (df["speedup_tgt_over_src"] >= speedup_threshold).mean()
+        agg_df[f"percent_programs_speedup_fastest_generated_over_src>=speedup_threshold_{speedup_threshold}"] = (df["speedup_of_fastest_generated_of_all_submissions"] >= speedup_threshold).mean()
+    return agg_df, df
+
+
+def unmelt_results_before_pivoting(results_df, cfg):
+    """frozen copy of the iterrows version of unmelt_results"""
+    unmelted_data = []
+    for src_id, group in results_df.groupby("src_id"):
+        src_code_row = group[group["code_type"] == "src_code"].iloc[0]
+        new_row = src_code_row.to_dict()
+        for index, row in group.iterrows():
+            new_row["src_id"] = src_id
+            new_row[f'{row["code_type"]}_compilation'] = row["compilation"]
+            new_row[f'{row["code_type"]}'] = row["code"]
+            if row["code_type"].startswith(cfg.model_generated_potentially_faster_code_col) or cfg.redo_src_tgt:
+                new_row[f'{row["code_type"]}_accuracy'] = row["accuracy"]
+                new_row[f'{row["code_type"]}_agg_runtime'] = row["agg_runtime"]
+                new_row[f'{row["code_type"]}_tc2time'] = row["tc2time"]
+        unmelted_data.append(new_row)
+    return pd.DataFrame(unmelted_data)
+
+
+class FakeEnv:
+    """stands in for a PieEnvironment, the runtime of a program is the length of its code"""
+    def __init__(self, submitted):
+        self.submitted = submitted
+    
+    def iter_multiple_single_submissions(self, code_list, testcases_list, problem_id_list, timing_env, stat_keys=None):
+        # out of order, like the streamed results
+        for index in reversed(range(len(code_list))):
+            self.submitted.append((code_list[index], problem_id_list[index]))
+            runtime = float(len(code_list[index]))
+            yield index, types.SimpleNamespace(compilation=True, mean_acc=1.0, agg_runtime=runtime, 
+                                               tc2time={0: runtime}, tc2stats={0: {"sim_seconds": runtime}})
+    
+    def teardown(self):
+        pass
+
+
+def write_generations(inputs_path, generated_answers, n_programs=2):
+    pd.DataFrame([{"src_id": i, "problem_id": f"p{i}", "tests": [0], "n_tests": 1, 
+                   "src_code": f"int src{i};", "tgt_code": f"int tgt{i};", 
+                   "generated_answers": generated_answers, 
+                   "src_agg_runtime": 1.0, "tgt_agg_runtime": 0.5} for i in range(n_programs)]).to_json(inputs_path, orient="records", lines=True)
+
+
+class TestEval:
+    def test_group_duplicate_submissions(self):
+        assert gem5_eval.normalize_code("  int a;\n\n\tint b;  \n") == "int a;\nint b;"
+        codes = ["int a;", "  int a;\n\n", "int a;", "int b;", "int a;"]
+        problem_ids = ["p0", "p0", "p1", "p0", "p0"]
+        tests = [[0, 1], [1, 0], [0, 1], [0, 1], [0]]
+        # the same code is only a duplicate for the same problem and the same tests, in any order
+        assert gem5_eval.group_duplicate_submissions(codes, problem_ids, tests, normalize=True) == [[0, 1], [2], [3], [4]]
+        assert gem5_eval.group_duplicate_submissions(codes, problem_ids, tests) == [[0], [1], [2], [3], [4]]
+        # the whitespace in a raw string is part of the output, so only exact copies are duplicates by default
+        raw_codes = ['puts(R"(a\n  b)");', 'puts(R"(a\nb)");', 'puts(R"(a\n  b)");']
+        assert gem5_eval.group_duplicate_submissions(raw_codes, ["p0"] * 3, [[0]] * 3) == [[0, 2], [1]]
+
+    def test_duplicate_results_fan_out(self, monkeypatch):
+        submitted = []
+        monkeypatch.setattr(gem5_eval.simulator, "make", lambda **kwargs: FakeEnv(submitted))
+        # the aggregate report expects the full benchmark, only the per-row results are checked here
+        monkeypatch.setattr(gem5_eval, "report_results", lambda df, cfg, orig_df: (pd.DataFrame(), pd.DataFrame()))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inputs_path = os.path.join(tmpdir, "generations.jsonl")
+            write_generations(inputs_path, ["int a;", "  int a;\n\n", "int bb;"])
+            cfg = gem5_eval.EvaluationConfig(model_generated_outputs_path=inputs_path, output_dir=os.path.join(tmpdir, "results"), 
+                                             reference_file_path=inputs_path, redo_src_tgt=True, reference_store_path=None, 
+                                             dedup_normalize_whitespace=True)
+            gem5_eval.main(cfg)
+            melted = pd.read_json(os.path.join(cfg.output_dir, "melted_test_results.jsonl"), orient="records", lines=True)
+        # the whitespace variant of "int a;" is only submitted once per problem
+        assert sorted(submitted) == sorted([(code, f"p{i}") for i in range(2) for code in [f"int src{i};", f"int tgt{i};", "int a;", "int bb;"]])
+        assert len(melted) == 10
+        for _, row in melted.iterrows():
+            expected_runtime = float(len(gem5_eval.normalize_code(row["code"])))
+            assert row["agg_runtime"] == expected_runtime
+            assert {int(tc_no): t for tc_no, t in row["tc2time"].items()} == {0: expected_runtime}
+
+    def test_estimate_at_k(self):
+        speedups = np.array([[1.0, 2.5, 0.5, 1.5],
+                             [3.0, 1.0, 100.0, 2.0],
+                             [1.2, 100.0, 100.0, 100.0],
+                             [0.9, 1.1, 1.3, 0.7]])
+        is_correct = np.array([[True, False, True, True],
+                               [False, True, True, False],
+                               [False, True, True, True],
+                               [False, False, False, False]])
+        # the 100.0 speedups are missing generations and must not count
+        is_present = np.array([[True, True, True, True],
+                               [True, True, False, True],
+                               [True, False, False, False],
+                               [True, True, True, True]])
+        expected_speedups, pass_at_k = gem5_eval.estimate_at_k(speedups, is_correct, is_present)
+        assert expected_speedups.shape == pass_at_k.shape == speedups.shape
+        for program in range(speedups.shape[0]):
+            present = np.flatnonzero(is_present[program])
+            for k in range(1, speedups.shape[1] + 1):
+                if k > len(present):
+                    assert np.isnan(expected_speedups[program, k - 1])
+                    assert np.isnan(pass_at_k[program, k - 1])
+                    continue
+                samples = list(itertools.combinations(present, k))
+                brute_force_speedup = np.mean([max(speedups[program, i] for i in sample) for sample in samples])
+                brute_force_pass = np.mean([any(is_correct[program, i] for i in sample) for sample in samples])
+                assert np.isclose(expected_speedups[program, k - 1], brute_force_speedup), (program, k)
+                assert np.isclose(pass_at_k[program, k - 1], brute_force_pass), (program, k)
+
+    def test_write_read_results(self):
+        pytest.importorskip("pyarrow")
+        df = pd.DataFrame({"src_id": [0, 0, 1, 1], 
+                           "code_type": ["src_code", "generated_answers_0", "src_code", "generated_answers_0"], 
+                           "code": ["a", "b", "c", "d"], 
+                           "tests": [[0, 1], [0, 1], [2], [2]], 
+                           "accuracy": [1.0, 1.0, 1.0, 0.0], 
+                           # failed test cases have an infinite runtime
+                           "agg_runtime": [0.002, np.inf, 0.5, np.inf], 
+                           "tc2time": [{0: 0.001, 1: 0.001}, {0: 0.001, 1: np.inf}, {2: 0.5}, None], 
+                           "tc2stats": [{0: {"sim_seconds": 0.001, "system.cpu.dist::0": [10.0, 12.5, 12.5]}, 1: {"sim_seconds": 0.001, "system.cpu.dist::0": [1.0, 2.0, 3.0]}}, 
+                                        {0: {"sim_seconds": 0.001, "system.cpu.dist::0": [10.0, 12.5, 12.5]}, 1: None}, 
+                                        {2: {"sim_seconds": 0.5, "system.cpu.dist::0": [4.0, 5.0, 6.0]}}, 
+                                        None]})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for path, partition_cols in [(os.path.join(tmpdir, "results.parquet"), None), 
+                                         (os.path.join(tmpdir, "partitioned.parquet"), ["code_type"])]:
+                gem5_eval.write_results(df, path, "parquet", partition_cols=partition_cols)
+                # a second write replaces the first one instead of adding files to the dataset
+                gem5_eval.write_results(df, path, "parquet", partition_cols=partition_cols)
+                read_df = gem5_eval.read_results(path, "parquet")
+                # a partitioned dataset is read back grouped by the partition columns
+                read_df = read_df.sort_values(["src_id", "code_type"]).reset_index(drop=True)
+                expected_df = df.sort_values(["src_id", "code_type"]).reset_index(drop=True)
+                assert sorted(read_df.columns) == sorted(df.columns)
+                for name in df.columns:
+                    assert read_df[name].tolist() == expected_df[name].tolist(), name
+                projected_df = gem5_eval.read_results(path, "parquet", columns=["src_id", "tc2time"])
+                assert list(projected_df.columns) == ["src_id", "tc2time"]
+                assert sorted(projected_df["tc2time"].tolist(), key=str) == sorted(df["tc2time"].tolist(), key=str)
+    
+    def test_report_results_matches_loop(self):
+        rng = np.random.default_rng(0)
+        n_generated = 4
+        # report_results pads the results with the programs of the reference that were not evaluated, up to the 978 of the benchmark
+        orig_df = pd.DataFrame({"src_id": range(978), "problem_id": [f"p{i % 300}" for i in range(978)], 
+                                "src_code": [f"int src{i};" for i in range(978)], "tgt_code": [f"int tgt{i};" for i in range(978)]})
+        rows = []
+        for i in range(40):
+            row = {"src_id": i, "problem_id": f"p{i % 300 if i < 30 else 0}", "src_code": f"int src{i};", "tgt_code": f"int tgt{i};", 
+                   "src_code_agg_runtime": rng.choice([1.0, 2.0, 0.0]), "tgt_code_agg_runtime": rng.choice([0.5, 1.0, np.inf])}
+            for j in range(n_generated):
+                colname = f"generated_answers_{j}"
+                # missing generations, wrong ones, failed runs and fast correct ones
+                kind = rng.integers(4)
+                row[colname] = None if kind == 0 else f"int gen{i}_{j};"
+                row[f"{colname}_accuracy"] = np.nan if kind == 0 else (0.5 if kind == 1 else 1.0)
+                row[f"{colname}_agg_runtime"] = np.nan if kind == 0 else (np.inf if kind == 2 else rng.choice([0.1, 0.5, 1.0, 3.0]))
+                row[f"{colname}_tc2time"] = {}
+            rows.append(row)
+        df = pd.DataFrame(rows)
+        cfg = gem5_eval.EvaluationConfig(model_generated_outputs_path="", output_dir="", reference_file_path="", num_generated_cols=n_generated)
+        agg_df, report_df = gem5_eval.report_results(df.copy(), cfg, orig_df.copy())
+        assert len(report_df) == 978
+        padded_df = report_df[[c for c in report_df.columns if c in df.columns or c == "src_tgt_code"]]
+        expected_agg_df, expected_df = report_results_before_vectorizing(padded_df, cfg)
+        for name in expected_df.columns:
+            pd.testing.assert_series_equal(report_df[name], expected_df[name], check_dtype=False, check_index_type=False)
+        for name in expected_agg_df.columns:
+            assert np.isclose(agg_df[name][0], expected_agg_df[name][0], equal_nan=True), name
+    
+    def test_read_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint_path = os.path.join(tmpdir, "checkpoint.jsonl")
+            assert gem5_eval.read_checkpoint(checkpoint_path) == []
+            record = {"accuracy": 0.0, "agg_runtime": np.inf, "tc2time": {0: 0.5, 1: np.inf}}
+            with gem5_eval.open_checkpoint(checkpoint_path) as checkpoint_file:
+                checkpoint_file.write(gem5_eval.make_checkpoint_line(0, "src_code", "f0", record))
+                # a crash in the middle of a line
+                checkpoint_file.write(gem5_eval.make_checkpoint_line(1, "src_code", "f1", record)[:20])
+            rows = gem5_eval.read_checkpoint(checkpoint_path)
+            assert len(rows) == 1
+            # the inf runtimes of failed programs are written as null and read back as inf
+            assert rows[0]["agg_runtime"] == np.inf
+            assert rows[0]["tc2time"] == {0: 0.5, 1: np.inf}
+            # a restart appends after the partial line instead of to it
+            with gem5_eval.open_checkpoint(checkpoint_path) as checkpoint_file:
+                checkpoint_file.write(gem5_eval.make_checkpoint_line(1, "src_code", "f1", record))
+            rows = gem5_eval.read_checkpoint(checkpoint_path)
+            assert [(row["src_id"], row["fingerprint"]) for row in rows] == [(0, "f0"), (1, "f1")]
+    
+    def test_checkpoint_fingerprint(self):
+        config = {"timeout_seconds_gem5": 120, "stat_keys": None}
+        fingerprint = gem5_eval.checkpoint_fingerprint("int a;", "p0", [0, 1], config)
+        assert gem5_eval.checkpoint_fingerprint("int a;", "p0", ["1", "0"], dict(config)) == fingerprint
+        assert gem5_eval.checkpoint_fingerprint("int a; ", "p0", [0, 1], config) != fingerprint
+        assert gem5_eval.checkpoint_fingerprint("int a;", "p1", [0, 1], config) != fingerprint
+        assert gem5_eval.checkpoint_fingerprint("int a;", "p0", [0], config) != fingerprint
+        assert gem5_eval.checkpoint_fingerprint("int a;", "p0", [0, 1], {**config, "stat_keys": "none"}) != fingerprint
+    
+    def test_resume_from_checkpoint(self, monkeypatch):
+        submitted = []
+        monkeypatch.setattr(gem5_eval.simulator, "make", lambda **kwargs: FakeEnv(submitted))
+        monkeypatch.setattr(gem5_eval, "report_results", lambda df, cfg, orig_df: (pd.DataFrame(), pd.DataFrame()))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            inputs_path = os.path.join(tmpdir, "generations.jsonl")
+            def evaluate(generated_answers, **kwargs):
+                submitted.clear()
+                write_generations(inputs_path, generated_answers)
+                cfg = gem5_eval.EvaluationConfig(model_generated_outputs_path=inputs_path, output_dir=os.path.join(tmpdir, "results"), 
+                                                 reference_file_path=inputs_path, redo_src_tgt=True, reference_store_path=None, **kwargs)
+                gem5_eval.main(cfg)
+                melted = pd.read_json(os.path.join(cfg.output_dir, "melted_test_results.jsonl"), orient="records", lines=True)
+                assert len(melted) == 6
+                for _, row in melted.iterrows():
+                    assert row["agg_runtime"] == float(len(row["code"]))
+                # the finished results are reused as a whole, the checkpoint is for a run that stopped before writing them
+                os.remove(gem5_eval.results_path(cfg, "test_results"))
+                return sorted(code for code, _ in submitted)
+            assert evaluate(["int a;"]) == ["int a;", "int a;", "int src0;", "int src1;", "int tgt0;", "int tgt1;"]
+            # everything is checkpointed
+            assert evaluate(["int a;"]) == []
+            # only the rows whose code changed are submitted again
+            assert evaluate(["int bb;"]) == ["int bb;", "int bb;"]
+            # a setting that changes the results invalidates every row
+            assert len(evaluate(["int bb;"], stat_keys="none")) == 6
+    
+    def test_unmelt_results_matches_loop(self):
+        rng = np.random.default_rng(0)
+        rows = []
+        # shuffled src_ids, with some generations missing
+        for src_id in rng.permutation(12):
+            for code_type in ["src_code", "tgt_code"] + [f"generated_answers_{j}" for j in range(3)]:
+                if code_type.startswith("generated_answers") and rng.random() < 0.3:
+                    continue
+                compilation = bool(rng.random() < 0.8)
+                rows.append({"src_id": int(src_id), "problem_id": f"p{src_id}", "tests": [0, 1], "n_tests": 2, "code_type": code_type, 
+                             "code": f"int {code_type}{src_id};", "compilation": compilation, "accuracy": 1.0 if compilation else 0.0, 
+                             "agg_runtime": float(rng.choice([0.5, 1.0, np.inf])), "tc2time": {0: 0.25, 1: 0.25} if compilation else None, 
+                             "src_agg_runtime": 1.0})
+        results_df = pd.DataFrame(rows).sample(frac=1.0, random_state=0)
+        for redo_src_tgt in [False, True]:
+            cfg = gem5_eval.EvaluationConfig(model_generated_outputs_path="", output_dir="", reference_file_path="", redo_src_tgt=redo_src_tgt)
+            unmelted_df = gem5_eval.unmelt_results(results_df.copy(), cfg)
+            expected_df = unmelt_results_before_pivoting(results_df.copy(), cfg)
+            assert sorted(unmelted_df.columns) == sorted(expected_df.columns)
+            for name in expected_df.columns:
+                pd.testing.assert_series_equal(unmelted_df[name], expected_df[name], check_dtype=False)
+    
+    def test_iter_jsonl_chunks_matches_read_json(self):
+        records = []
+        for i in range(7):
+            generated_answers = [f"int gen{i}_{j};" for j in range(i % 3 + 1)]
+            record = {"src_id": i, "problem_id": f"p{i}", "tests": [0, 1], "n_tests": 2, 
+                      # lists written with json.dumps, with str() and as lists
+                      "generated_answers": json.dumps(generated_answers) if i % 3 == 0 else (str(generated_answers) if i % 3 == 1 else generated_answers), 
+                      "src_code": f"int src{i};", "tgt_code": f"int tgt{i};", "src_agg_runtime": float(i), 
+                      "tgt_agg_runtime": float("nan") if i == 2 else (float("inf") if i == 3 else i / 2), 
+                      "prompt": f"prompt {i}", "score": {"bleu": i}}
+            if i == 4:
+                # columns that are missing on some lines
+                del record["prompt"]
+            records.append(record)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "generations.jsonl")
+            with open(path, "w") as f:
+                for record in records:
+                    # json.dumps writes NaN and Infinity, which orjson rejects
+                    f.write(json.dumps(record) + "\n")
+                f.write("\n")
+            expected_df = gem5_eval.fix_df_columns(pd.read_json(path, orient="records", lines=True))
+            for columns in [None, ["src_id", "generated_answers", "tgt_agg_runtime", "prompt"]]:
+                for chunksize in [1, 3, 100]:
+                    chunks_df = pd.concat([gem5_eval.fix_df_columns(chunk) for chunk in gem5_eval.iter_jsonl_chunks(path, columns, chunksize)])
+                    assert sorted(chunks_df.columns) == sorted(columns or expected_df.columns)
+                    assert list(chunks_df.index) == list(range(len(records)))
+                    # pd.read_json downcasts integral floats to int, the chunks keep them as floats
+                    for name in chunks_df.columns:
+                        pd.testing.assert_series_equal(chunks_df[name], expected_df[name], check_dtype=False)
@@ -97,7 +97,39 @@ def get_pie_env():
     yield env
     env.teardown()
 
+@pytest.fixture(scope='session')
+def get_parallel_pie_env():
+    # without the result store, so that the simulations are not served from the results of get_pie_env
+    env = simulator.make(api_key=API_KEY, port=4001, parallelize_testcases=True, use_gem5_result_store=False)
+    yield env
+    env.teardown()
+
 class TestFrontEnd:
+   def test_parallelize_testcases(self, get_pie_env, get_parallel_pie_env):
+      code_list = [example_1_code, example_2_code] * 2
+      testcases_list = [[0, 1]] * 4
+      problem_id_list = [example_1_problem_id, example_2_problem_id] * 2
+
+      sequential_results = get_pie_env.submit_multiple_single_submissions(code_list=code_list,
+                                                                          testcases_list=testcases_list,
+                                                                          problem_id_list=problem_id_list,
+                                                                          timing_env="gem5")
+      parallel_results = get_parallel_pie_env.submit_multiple_single_submissions(code_list=code_list,
+                                                                                 testcases_list=testcases_list,
+                                                                                 problem_id_list=problem_id_list,
+                                                                                 timing_env="gem5")
+      streamed_results = dict(get_parallel_pie_env.iter_multiple_single_submissions(code_list=code_list,
+                                                                                     testcases_list=testcases_list,
+                                                                                     problem_id_list=problem_id_list,
+                                                                                     timing_env="gem5"))
+      assert sorted(streamed_results) == [0, 1, 2, 3]
+      for i, sequential_result in enumerate(sequential_results):
+         for result in [parallel_results[i], streamed_results[i]]:
+            assert result.compilation == sequential_result.compilation
+            assert result.tc2success == sequential_result.tc2success
+            assert result.tc2time == sequential_result.tc2time
+            assert result.agg_runtime == sequential_result.agg_runtime
+
    def test_multiple_dual_submissions(self, get_pie_env):
 
       # use example_1_code 2 times; the only difference is that the keys are gem5_v0 and gem5_v1 and binary_v0 and binary_v1
@@ -379,4 +411,83 @@ class TestFrontEnd:
             
       
          assert len(tc2hyperfine_v0) == 2
-         assert len(tc2hyperfine_v1) == 2
\ No newline at end of file
+         assert len(tc2hyperfine_v1) == 2
+
+
+   def test_iter_multiple_single_submissions(self, get_pie_env):
+      env = get_pie_env
+      code_list = [example_1_code, example_2_code] * 2
+      testcases_list = [[0, 1]] * 4
+      problem_id_list = [example_1_problem_id, example_2_problem_id] * 2
+
+      indices = []
+      for index, result in env.iter_multiple_single_submissions(code_list=code_list,
+                                                                 testcases_list=testcases_list,
+                                                                 problem_id_list=problem_id_list,
+                                                                 timing_env="gem5"):
+         indices.append(index)
+         assert result.compilation == True
+         if (index % 2) == 0:
+            assert result.tc2time[0] == 0.001035073468
+            assert result.tc2time[1] == 0.001039205596
+         else:
+            assert result.tc2time[0] == 0.001026564396
+            assert result.tc2time[1] == 0.001029346032
+
+      assert sorted(indices) == [0, 1, 2, 3]
+
+
+   def test_job(self, get_pie_env):
+      env = get_pie_env
+      job_id = env.submit_job(code_list=[example_1_code, example_2_code],
+                              testcases_list=[[0, 1], [0, 1]],
+                              problem_id_list=[example_1_problem_id, example_2_problem_id],
+                              timing_env="gem5")
+      assert job_id in [job["job_id"] for job in env.list_jobs()]
+      results = env.wait_for_job(job_id, poll_interval=1.0)
+      assert env.get_job(job_id)["status"] == "completed"
+      assert results[0].tc2time[0] == 0.001035073468
+      assert results[1].tc2time[0] == 0.001026564396
+
+      job_id = env.submit_job(code_list=[example_1_code] * 4,
+                              testcases_list=[[0, 1]] * 4,
+                              problem_id_list=[example_1_problem_id] * 4,
+                              timing_env="gem5")
+      assert env.cancel_job(job_id) == True
+      assert env.get_job(job_id)["status"] == "cancelled"
+
+
+   def test_override_flags(self, get_pie_env):
+      env = get_pie_env
+      # the flag changes the output, so the accuracy shows whether it reached the compiler
+      code = example_1_code.replace("cout << dp[n - 1] << endl;", "#ifdef WRONG_ANSWER\n\tdp[n - 1]++;\n#endif\n\tcout << dp[n - 1] << endl;")
+      code_list = [code, code]
+      testcases_list = [[0, 1], [0, 1]]
+      problem_id_list = [example_1_problem_id, example_1_problem_id]
+      override_flags_list = ["", " -DWRONG_ANSWER"]
+
+      results = env.submit_multiple_single_submissions(code_list=code_list,
+                                                       testcases_list=testcases_list,
+                                                       problem_id_list=problem_id_list,
+                                                       override_flags_list=override_flags_list,
+                                                       timing_env="gem5")
+      streamed_results = dict(env.iter_multiple_single_submissions(code_list=code_list,
+                                                                   testcases_list=testcases_list,
+                                                                   problem_id_list=problem_id_list,
+                                                                   override_flags_list=override_flags_list,
+                                                                   timing_env="gem5"))
+      for result in [results[0], streamed_results[0]]:
+         assert result.mean_acc == 1.0
+      for result in [results[1], streamed_results[1]]:
+         assert result.mean_acc == 0.0
+
+      pair_results = env.submit_multiple_dual_submissions(code_list_v0=[code],
+                                                          code_list_v1=[code],
+                                                          testcases_list=[[0, 1]],
+                                                          problem_id_list=[example_1_problem_id],
+                                                          override_flags_list_v0=[""],
+                                                          override_flags_list_v1=[" -DWRONG_ANSWER"],
+                                                          timing_env="gem5")
+      assert pair_results[0].mean_acc_v0 == 1.0
+      assert pair_results[0].mean_acc_v1 == 0.0
+
@@ -4,10 +4,22 @@ import secrets
 import string
 import numpy as np
 from dataclasses import dataclass
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Optional
 from collections import defaultdict
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import json
+import asyncio
+try: 
+    import msgpack
+except ImportError: 
+    msgpack = None
+try: 
+    import httpx
+except ImportError: 
+    httpx = None
 
 
 import os
@@ -17,6 +29,7 @@ import io
 import shutil
 from pprint import pprint
 import threading
+import queue
 import pdb
 import gem5
 import inspect
@@ -92,6 +105,47 @@ def docker_copy_to(src, dst, client):
 def make(*args, **kwargs):
     return PieEnvironment(*args, **kwargs)
 
+def make_cluster(cpuset_cpus_list: List[str] = None, endpoints: List[str] = None, base_port: int = 4000, chunk_size: int = None, chunk_timeout: float = None, **kwargs):
+    """
+    makes a PieCluster of local containers, one per entry of cpuset_cpus_list (which should be disjoint), on ports base_port, base_port + 1, ...
+    and of servers that are already running at endpoints given as "host:port", which must share the api_key passed in kwargs; 
+    the other kwargs are passed to every PieEnvironment
+    """
+    envs = []
+    try: 
+        # the containers are started one at a time since they are built from the same Dockerfile
+        for i, cpuset_cpus in enumerate(cpuset_cpus_list or []):
+            envs.append(PieEnvironment(cpuset_cpus=cpuset_cpus, port=base_port + i, **kwargs))
+        for endpoint in endpoints or []:
+            host, port = endpoint.rsplit(":", 1)
+            envs.append(PieEnvironment(host=host, port=int(port), connect_only=True, **kwargs))
+    except Exception: 
+        for env in envs:
+            env.teardown()
+        raise
+    return PieCluster(envs, chunk_size=chunk_size, chunk_timeout=chunk_timeout)
+
+def make_session(max_retries: int = 3, retry_backoff_factor: float = 0.5, pool_maxsize: int = 10, retry_reads: bool = False) -> requests.Session:
+    """
+    session with a pool of keep-alive connections, retrying with exponential backoff when connecting fails; 
+    with retry_reads, requests are also retried when the connection is reset after they were sent, which is only safe for routes 
+    that do not start any work, since the submission routes are GETs and would otherwise be simulated twice
+    """
+    retry = Retry(total=max_retries, connect=max_retries, read=max_retries if retry_reads else 0, status=0, backoff_factor=retry_backoff_factor)
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize))
+    return session
+
+def make_submissions(code_list: List[str], testcases_list: List[List[str]], problem_id_list: List[str], override_flags_list: List[str] = None) -> List[Dict[str, Any]]:
+    if override_flags_list is None:
+        override_flags_list = [None] * len(code_list)
+    return [{"code": code,
+             "testcases": testcases,
+             "problem_id": problem_id,
+             "override_flags": override_flags} 
+            for code, testcases, problem_id, override_flags 
+            in zip(code_list, testcases_list, problem_id_list, override_flags_list)]
+
 def generate_api_key(length=256):
     alphabet = string.digits + string.ascii_letters 
     api_key = ''.join(secrets.choice(alphabet) for _ in range(length))
@@ -103,6 +157,60 @@ def parse_submission_result(result: Union[List[Dict[str, Any]], Dict[str, Any]])
     else:
         return _parse_submission(result)
     
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# where the host cache_dir is mounted in the container
+CONTAINER_CACHE_DIR = "/home/cache"
+
+# the read timeout of the pings, so that a server that accepts connections but hangs is not waited on forever
+PING_READ_TIMEOUT = 5.0
+
+def decode_stats_layouts(obj, stat_layouts: List[List[str]]):
+    """
+    inverse of gem5_api.encode_stats_layouts, rebuilds the gem5 stats dicts from [layout index, values]
+    """
+    if isinstance(obj, dict):
+        decoded = {}
+        for key, value in obj.items():
+            if key == "stats" and isinstance(value, list):
+                layout_idx, values = value
+                decoded[key] = dict(zip(stat_layouts[layout_idx], values))
+            else: 
+                decoded[key] = decode_stats_layouts(value, stat_layouts)
+        return decoded
+    if isinstance(obj, list):
+        return [decode_stats_layouts(value, stat_layouts) for value in obj]
+    return obj
+
+def decode_results_response(response):
+    """
+    decodes a submission response (a requests or httpx response), which is msgpack with factored out stat keys if it was requested and the server supports it, and json otherwise
+    """
+    if response.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE):
+        payload = msgpack.unpackb(response.content, raw=False)
+        return decode_stats_layouts(payload["results"], payload["stat_layouts"])
+    return response.json()
+
+def iter_results_stream(response):
+    """
+    yields the (index, result) records of a streamed submission response (a requests response), 
+    which is a sequence of msgpack objects if it was requested and the server supports it, and newline-delimited json otherwise
+    """
+    if response.headers.get("Content-Type", "").startswith(MSGPACK_MIMETYPE):
+        unpacker = msgpack.Unpacker(raw=False)
+        stat_layouts = []
+        for chunk in response.iter_content(chunk_size=None):
+            unpacker.feed(chunk)
+            for record in unpacker:
+                stat_layouts.extend(record["stat_layouts"])
+                yield record["index"], decode_stats_layouts(record["result"], stat_layouts)
+        return
+    for line in response.iter_lines():
+        if not line:
+            continue
+        line = json.loads(line)
+        yield line["index"], line["result"]
+
 def _parse_submission(result: Dict[str, Any]):
     # pprint(f"Result: {result}")
     # pprint(f"Keys: {result.keys()}")
@@ -236,7 +344,8 @@ def _parse_single_submission(result: Dict[str, Any]):
     parsed_result = {}
     compilation = result["compile_success"]
     accs = result["accs"]
-    mean_acc = np.mean([acc for acc in accs.values()])
+    # the testcases skipped by the early exit of the correctness check have no accuracy
+    mean_acc = np.mean([acc for acc in accs.values() if acc is not None])
     
     parsed_result["compilation"] = compilation
     parsed_result["accs"] = accs
@@ -426,7 +535,29 @@ class PieEnvironment:
                  api_key: str = None, 
                  verbose: bool = False, 
                  do_run_without_container: bool = False, 
-                 exit_early_on_fail: bool = True): 
+                 exit_early_on_fail: bool = True, 
+                 compile_cache_max_mb: int = 2048, 
+                 hyperfine_compile_once: bool = False, 
+                 use_gem5_result_store: bool = True, 
+                 parallelize_testcases: bool = False, 
+                 early_exit_correctness: bool = False, 
+                 longest_job_first: bool = False, 
+                 gem5_slowdown_factor: Optional[float] = None, 
+                 preskip_gem5_timeouts: bool = False, 
+                 scale_gem5_timeouts: bool = False, 
+                 gem5_timeout_margin: float = 3.0, 
+                 min_scaled_gem5_timeout: float = 10.0, 
+                 correctness_workers: int = 1, 
+                 correctness_max_memory_mb: int = 0, 
+                 wire_format: str = "json", 
+                 connect_timeout: float = 10.0, 
+                 read_timeout: Optional[float] = None, 
+                 max_retries: int = 3, 
+                 retry_backoff_factor: float = 0.5, 
+                 pool_maxsize: int = 10, 
+                 host: str = "localhost", 
+                 connect_only: bool = False, 
+                 cache_dir: Optional[str] = "~/.cache/pie-perf/gem5"): 
         
         if arch != 'X86-skylake':
             raise NotImplementedError(f"Architecture {arch} not supported, only X86-skylake is supported")
@@ -439,6 +570,9 @@ class PieEnvironment:
         self.threaded = threaded
         self.gem5_acc_threshold = gem5_acc_threshold
         self.port = port
+        self.host = host
+        # connect to a server that is already running, e.g. on another machine, instead of starting one
+        self.connect_only = connect_only
         self.cstd = cstd
         self.optimization_flag = optimization_flag
         self.cpu_type = cpu_type
@@ -448,13 +582,47 @@ class PieEnvironment:
         self.do_run_without_container = do_run_without_container
         self.child_process = None # for use with run_without_container
         self.exit_early_on_fail = exit_early_on_fail
+        self.compile_cache_max_mb = compile_cache_max_mb
+        self.hyperfine_compile_once = hyperfine_compile_once
+        self.use_gem5_result_store = use_gem5_result_store
+        self.parallelize_testcases = parallelize_testcases
+        self.early_exit_correctness = early_exit_correctness
+        self.longest_job_first = longest_job_first
+        self.gem5_slowdown_factor = gem5_slowdown_factor
+        self.preskip_gem5_timeouts = preskip_gem5_timeouts
+        self.scale_gem5_timeouts = scale_gem5_timeouts
+        self.gem5_timeout_margin = gem5_timeout_margin
+        self.min_scaled_gem5_timeout = min_scaled_gem5_timeout
+        self.correctness_workers = correctness_workers
+        self.correctness_max_memory_mb = correctness_max_memory_mb
+        # host directory of the caches that outlive the container (the gem5 result store), None to keep them in the container
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir)) if cache_dir is not None else None
+        if self.cache_dir is not None and not connect_only:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        assert wire_format in ["json", "msgpack"], f"wire_format must be json or msgpack, got {wire_format}"
+        if wire_format == "msgpack" and msgpack is None:
+            raise ImportError("wire_format='msgpack' requires the msgpack package")
+        self.wire_format = wire_format
+        # read_timeout is None by default since a batch of gem5 simulations can take hours
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = make_session(max_retries, retry_backoff_factor, pool_maxsize)
+        # the status routes are cheap and read-only, so they are also retried when the connection is reset
+        self.status_session = make_session(max_retries, retry_backoff_factor, pool_maxsize=1, retry_reads=True)
+        # wait_for_connection polls on its own, so the pings are not retried
+        self.ping_session = make_session(max_retries=0, pool_maxsize=1)
         ## TODO: allow a flag to short-circuit evaluation when we get a timeout 
         
         if api_key is None:
+            if connect_only:
+                raise ValueError("connect_only requires the api_key of the running server")
             api_key = generate_api_key()
         self.api_key = api_key
         
         
+        if self.connect_only:
+            if not self.wait_for_connection(timeout=30):
+                raise ConnectionError(f"Could not connect to the server at {self.base_url}")
+            return
         if self.do_run_without_container: 
             self.run_without_container()
         else: 
@@ -499,13 +667,14 @@ class PieEnvironment:
         print("Dockerfile removed")
         
         
+        volumes = {self.cache_dir: {"bind": CONTAINER_CACHE_DIR, "mode": "rw"}} if self.cache_dir is not None else None
         if self.cpuset_cpus is not None:
             container = self.client.containers.run(img.id, command=" ".join(command),
-                                                   detach=True, ports={ self.port: self.port}, cpuset_cpus=self.cpuset_cpus, publish_all_ports=True)
+                                                   detach=True, ports={ self.port: self.port}, cpuset_cpus=self.cpuset_cpus, publish_all_ports=True, volumes=volumes)
             # container = self.client.containers.run(img.id, detach=True, ports={4000: self.port}, cpuset_cpus=self.cpuset_cpus)
         else:
             container = self.client.containers.run(img.id, command=" ".join(command),
-                                                   detach=True, ports={ self.port: self.port}, publish_all_ports=True)
+                                                   detach=True, ports={ self.port: self.port}, publish_all_ports=True, volumes=volumes)
             # container = self.client.containers.run(img.id, detach=True, ports={4000: self.port})
         print(f"Attempted to run container with command {' '.join(command)}")
         print(f"Container with status {container.status} on port {self.port}, container name {container.name}")
@@ -542,13 +711,36 @@ class PieEnvironment:
                     f"--gem5_acc_threshold {self.gem5_acc_threshold}", f"--api_key {self.api_key}",
                     f"--optimization_flag='{self.optimization_flag}'", f"--cpu_type {self.cpu_type}",
                     f"--timeout_seconds_binary {self.timeout_seconds_binary}",
-                    f"--timeout_seconds_gem5 {self.timeout_seconds_gem5}"]
+                    f"--timeout_seconds_gem5 {self.timeout_seconds_gem5}",
+                    f"--compile_cache_max_mb {self.compile_cache_max_mb}", 
+                    f"--correctness_workers {self.correctness_workers}", 
+                    f"--correctness_max_memory_mb {self.correctness_max_memory_mb}", 
+                    f"--gem5_timeout_margin {self.gem5_timeout_margin}", 
+                    f"--min_scaled_gem5_timeout {self.min_scaled_gem5_timeout}"]
         if self.use_logical_cpus:
             command.append("--use_logical_cpus")
         if self.threaded:
             command.append("--threaded")
         if self.exit_early_on_fail:
             command.append("--exit_early_on_fail")
+        if self.hyperfine_compile_once:
+            command.append("--hyperfine_compile_once")
+        if not self.use_gem5_result_store:
+            command.append("--disable_gem5_result_store")
+        if self.parallelize_testcases:
+            command.append("--parallelize_testcases")
+        if self.early_exit_correctness:
+            command.append("--early_exit_correctness")
+        if self.longest_job_first:
+            command.append("--longest_job_first")
+        if self.gem5_slowdown_factor is not None:
+            command.append(f"--gem5_slowdown_factor {self.gem5_slowdown_factor}")
+        if self.preskip_gem5_timeouts:
+            command.append("--preskip_gem5_timeouts")
+        if self.scale_gem5_timeouts:
+            command.append("--scale_gem5_timeouts")
+        if self.cache_dir is not None:
+            command.append(f"--cache_dir {self.cache_dir if self.do_run_without_container else CONTAINER_CACHE_DIR}")
         return command
     
     def _find_open_port(self):
@@ -606,8 +798,14 @@ class PieEnvironment:
         # self.stream_thread = None
         
         
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+        
     def teardown(self, remove_container=True):
-        if self.do_run_without_container: 
+        if self.connect_only:
+            pass
+        elif self.do_run_without_container: 
             self.child_process.terminate()
             self.child_process.join()
             logging.info("Child process terminated")
@@ -616,86 +814,208 @@ class PieEnvironment:
             if remove_container:
                 self.container.remove()
             self.client.close()
+        self.session.close()
+        self.ping_session.close()
+        self.status_session.close()
+
+    def _request(self, method: str, path: str, retry_reads: bool = False, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.status_session if retry_reads else self.session
+        return session.request(method, f"{self.base_url}{path}", **kwargs)
+
+    def _results_headers(self):
+        if self.wire_format == "msgpack":
+            return {"Accept": MSGPACK_MIMETYPE}
+        return {"Accept": "application/json"}
 
     def submit_single_submission(self, 
                              code: str, 
                              testcases: List[str], 
                              problem_id: str, 
                              timing_env: str, 
-                             override_flags: str = None):
+                             override_flags: str = None, 
+                             stat_keys: Union[None, str, List[str]] = None):
         
         print(f"Submitting single submission to port {self.port}")
         
-        req = requests.get(f"http://localhost:{self.port}/gem5/single_submission", 
+        req = self._request("GET", "/gem5/single_submission", 
                         json={"code": code, 
                               "testcases": testcases, 
                               "problem_id": problem_id, 
                               "timing_env": timing_env, 
                               "override_flags": override_flags, 
-                              "api_key": self.api_key})
+                              "stat_keys": stat_keys, 
+                              "api_key": self.api_key}, 
+                        headers=self._results_headers())
         # return req.json()
-        return parse_submission_result(req.json())
+        return parse_submission_result(decode_results_response(req))
 
     def submit_single_submission_pair(self, code_v0: str, 
                                     code_v1: str, 
                                     testcases: List[str], 
                                     problem_id: str, 
                                     timing_env: str, 
-                                    override_flags: str = None):
+                                    override_flags: str = None, 
+                                    stat_keys: Union[None, str, List[str]] = None):
         
         print(f"Submitting single submission pair to port {self.port}")
         
-        req = requests.get(f"http://localhost:{self.port}/gem5/single_submission_pair", 
+        req = self._request("GET", "/gem5/single_submission_pair", 
                         json={"code_v0": code_v0, 
                             "code_v1": code_v1, 
                             "testcases": testcases, 
                             "problem_id": problem_id, 
                             "timing_env": timing_env, 
                             "override_flags": override_flags, 
-                            "api_key": self.api_key})
+                            "stat_keys": stat_keys, 
+                            "api_key": self.api_key}, 
+                        headers=self._results_headers())
         # return req.json()
-        return parse_submission_result(req.json())
+        return parse_submission_result(decode_results_response(req))
 
 
     def _get_multiple_single_submissions(self, submissions: List[Dict[str, str]], 
-                                        timing_env: str):
+                                        timing_env: str, 
+                                        stat_keys: Union[None, str, List[str]] = None):
         
         # self.start_stream_thread()
-        req = requests.get(f"http://localhost:{self.port}/gem5/multiple_single_submissions", 
+        req = self._request("GET", "/gem5/multiple_single_submissions", 
                             json={"submissions": submissions, 
                                 "timing_env": timing_env, 
-                                "api_key": self.api_key})
+                                "stat_keys": stat_keys, 
+                                "api_key": self.api_key}, 
+                            headers=self._results_headers())
 
         # self.stop_stream_thread()
-        return parse_submission_result(req.json())
+        return parse_submission_result(decode_results_response(req))
 
     def submit_multiple_single_submissions(self, code_list: List[str],
                                             testcases_list: List[List[str]],
                                             problem_id_list: List[str],
                                             timing_env: str,
-                                            override_flags_list: List[str] = None):
+                                            override_flags_list: List[str] = None, 
+                                            stat_keys: Union[None, str, List[str]] = None):
         print(f"Submitting multiple single submissions to port {self.port}")
-        if override_flags_list is None:
-            override_flags_list = [None] * len(code_list)
-        submissions = [{"code": code,
-                        "testcases": testcases,
-                        "problem_id": problem_id,
-                        "override_flags": override_flags} 
-                        for code, testcases, problem_id, override_flags 
-                        in zip(code_list, testcases_list, problem_id_list, override_flags_list)]
-        return self._get_multiple_single_submissions(submissions, timing_env)
+        submissions = make_submissions(code_list, testcases_list, problem_id_list, override_flags_list)
+        return self._get_multiple_single_submissions(submissions, timing_env, stat_keys)
+
+
+    def iter_multiple_single_submissions(self, code_list: List[str],
+                                         testcases_list: List[List[str]],
+                                         problem_id_list: List[str],
+                                         timing_env: str,
+                                         override_flags_list: List[str] = None, 
+                                         stat_keys: Union[None, str, List[str]] = None):
+        """
+        Streaming version of submit_multiple_single_submissions: yields (index, PieSingleResult) tuples 
+        as soon as each submission completes, where index is the position of the submission in code_list. 
+        """
+        print(f"Streaming multiple single submissions from port {self.port}")
+        submissions = make_submissions(code_list, testcases_list, problem_id_list, override_flags_list)
+        with self._request("GET", "/gem5/multiple_single_submissions_stream", 
+                          json={"submissions": submissions, 
+                                "timing_env": timing_env, 
+                                "stat_keys": stat_keys, 
+                                "api_key": self.api_key}, 
+                          headers=self._results_headers(), 
+                          stream=True) as req:
+            for submission_idx, result in iter_results_stream(req):
+                yield submission_idx, parse_submission_result(result)
+
+
+    def submit_job(self, code_list: List[str],
+                   testcases_list: List[List[str]],
+                   problem_id_list: List[str],
+                   timing_env: str,
+                   override_flags_list: List[str] = None, 
+                   stat_keys: Union[None, str, List[str]] = None) -> str:
+        """
+        Queues multiple single submissions as an asynchronous job on the server and returns its job id, 
+        the job keeps running if the client disconnects or restarts. 
+        """
+        print(f"Submitting job to port {self.port}")
+        submissions = make_submissions(code_list, testcases_list, problem_id_list, override_flags_list)
+        req = self._request("POST", "/gem5/jobs", 
+                            json={"submissions": submissions, 
+                                  "timing_env": timing_env, 
+                                  "stat_keys": stat_keys, 
+                                  "api_key": self.api_key})
+        response = req.json()
+        if "error" in response:
+            raise Exception(f"Could not submit job: {response['error']}")
+        return response["job_id"]
+    
+    def get_job(self, job_id: str, cursor: int = 0) -> Dict[str, Any]:
+        """
+        Returns the status of the job along with the results completed since cursor, 
+        parsed as a list of (index, PieSingleResult) in "results", and the cursor to use for the next call.
+        """
+        req = self._request("GET", f"/gem5/jobs/{job_id}", retry_reads=True, 
+                           json={"cursor": cursor, 
+                                 "api_key": self.api_key}, 
+                           headers=self._results_headers())
+        job = decode_results_response(req)
+        if "error" in job and "status" not in job:
+            raise Exception(f"Could not get job {job_id}: {job['error']}")
+        job["results"] = [(r["index"], parse_submission_result(r["result"])) for r in job["results"]]
+        return job
+    
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        req = self._request("GET", "/gem5/jobs", retry_reads=True, 
+                           json={"api_key": self.api_key})
+        return req.json()
+    
+    def cancel_job(self, job_id: str) -> bool:
+        req = self._request("DELETE", f"/gem5/jobs/{job_id}", 
+                              json={"api_key": self.api_key})
+        return req.json()["cancelled"]
+    
+    def _poll_job(self, job_id: str, poll_interval: float = 5.0):
+        cursor = 0
+        while True:
+            job = self.get_job(job_id, cursor=cursor)
+            cursor = job["cursor"]
+            yield job
+            if job["status"] == "failed":
+                raise Exception(f"Job {job_id} failed: {job['error']}")
+            if job["status"] in ("completed", "cancelled"):
+                return
+            time.sleep(poll_interval)
+    
+    def iter_job_results(self, job_id: str, poll_interval: float = 5.0):
+        """
+        Polls the job until it is finished, yielding (index, PieSingleResult) tuples as they complete. 
+        """
+        for job in self._poll_job(job_id, poll_interval):
+            for index, result in job["results"]:
+                yield index, result
+    
+    def wait_for_job(self, job_id: str, poll_interval: float = 5.0) -> List[PieSingleResult]:
+        """
+        Blocks until the job is finished and returns the results in the order of the submissions, 
+        with None for the submissions that did not complete because the job was cancelled.
+        """
+        index2result = {}
+        n_submissions = 0
+        for job in self._poll_job(job_id, poll_interval):
+            n_submissions = job["n_submissions"]
+            index2result.update(job["results"])
+        return [index2result.get(i) for i in range(n_submissions)]
 
 
     def _get_multiple_dual_submissions(self, submissions_v0: List[Dict[str, str]], 
                                         submissions_v1: List[Dict[str, str]], 
-                                        timing_env: str):
-        req = requests.get(f"http://localhost:{self.port}/gem5/multiple_submissions_pairs", 
+                                        timing_env: str, 
+                                        stat_keys: Union[None, str, List[str]] = None):
+        req = self._request("GET", "/gem5/multiple_submissions_pairs", 
                             json={"submissions_v0": submissions_v0, 
                                 "submissions_v1": submissions_v1, 
                                 "timing_env": timing_env, 
-                                "api_key": self.api_key})
+                                "stat_keys": stat_keys, 
+                                "api_key": self.api_key}, 
+                            headers=self._results_headers())
         # return req.json()
-        return parse_submission_result(req.json())
+        return parse_submission_result(decode_results_response(req))
 
     def submit_multiple_dual_submissions(self, code_list_v0: List[str],
                                             code_list_v1: List[str],
@@ -703,30 +1023,27 @@ class PieEnvironment:
                                             problem_id_list: List[str],
                                             timing_env: str,
                                             override_flags_list_v0: List[str] = None,
-                                            override_flags_list_v1: List[str] = None):
+                                            override_flags_list_v1: List[str] = None, 
+                                            stat_keys: Union[None, str, List[str]] = None):
         
         print(f"Submitting multiple dual submissions to port {self.port}")
-        if override_flags_list_v0 is None:
-            override_flags_list_v0 = [None] * len(code_list_v0)
-        if override_flags_list_v1 is None:
-            override_flags_list_v1 = [None] * len(code_list_v1)
-        submissions_v0 = [{"code": code,
-                        "testcases": testcases,
-                        "problem_id": problem_id,
-                        "override_flags": override_flags} 
-                        for code, testcases, problem_id, override_flags 
-                        in zip(code_list_v0, testcases_list, problem_id_list, override_flags_list_v0)]
-        submissions_v1 = [{"code": code,
-                        "testcases": testcases,
-                        "problem_id": problem_id,
-                        "override_flags": override_flags} 
-                        for code, testcases, problem_id, override_flags 
-                        in zip(code_list_v1, testcases_list, problem_id_list, override_flags_list_v1)]
-        return self._get_multiple_dual_submissions(submissions_v0, submissions_v1, timing_env)
+        submissions_v0 = make_submissions(code_list_v0, testcases_list, problem_id_list, override_flags_list_v0)
+        submissions_v1 = make_submissions(code_list_v1, testcases_list, problem_id_list, override_flags_list_v1)
+        return self._get_multiple_dual_submissions(submissions_v0, submissions_v1, timing_env, stat_keys)
+    
+    def get_cpu_status(self):
+        req = self._request("GET", "/gem5/cpus", retry_reads=True, 
+                            json={"api_key": self.api_key})
+        return req.json()
+    
+    def get_cache_stats(self):
+        req = self._request("GET", "/gem5/cache_stats", retry_reads=True, 
+                            json={"api_key": self.api_key})
+        return req.json()
     
     def test_connection(self):
         try: 
-            req = requests.get(f"http://localhost:{self.port}/gem5/ping", 
+            req = self.ping_session.get(f"{self.base_url}/gem5/ping", timeout=(self.timeout[0], PING_READ_TIMEOUT), 
                                 json={"api_key": self.api_key})
         
             if req.status_code == 200:
@@ -748,6 +1065,243 @@ class PieEnvironment:
         return False
         
         
+class AsyncPieEnvironment: 
+    """
+    asyncio client for the server of a running PieEnvironment, so that simulations can be awaited in the same event loop as 
+    the generation; at most max_concurrency requests are in flight at once. The PieEnvironment still owns the container and
+    has to be torn down separately. 
+    
+    env = simulator.make(...)
+    async with simulator.AsyncPieEnvironment(env, max_concurrency=8) as async_env:
+        results = await asyncio.gather(*[async_env.submit_single_submission(...) for ...])
+    """
+    def __init__(self, env: PieEnvironment, max_concurrency: int = 8, max_retries: int = 3):
+        if httpx is None:
+            raise ImportError("AsyncPieEnvironment requires the httpx package")
+        self.env = env
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        connect_timeout, read_timeout = env.timeout
+        # the transport only retries failed connections, like the retry policy of the PieEnvironment session
+        self.client = httpx.AsyncClient(base_url=env.base_url, 
+                                        timeout=httpx.Timeout(read_timeout, connect=connect_timeout), 
+                                        limits=httpx.Limits(max_connections=max_concurrency), 
+                                        transport=httpx.AsyncHTTPTransport(retries=max_retries))
+        
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
         
+    async def aclose(self):
+        await self.client.aclose()
+        
+    async def _get_results(self, path: str, payload: Dict[str, Any]):
+        async with self.semaphore:
+            req = await self.client.request("GET", path, json={**payload, "api_key": self.env.api_key}, headers=self.env._results_headers())
+        return parse_submission_result(decode_results_response(req))
+    
+    async def submit_single_submission(self, 
+                                       code: str, 
+                                       testcases: List[str], 
+                                       problem_id: str, 
+                                       timing_env: str, 
+                                       override_flags: str = None, 
+                                       stat_keys: Union[None, str, List[str]] = None):
+        return await self._get_results("/gem5/single_submission", 
+                                       {"code": code, 
+                                        "testcases": testcases, 
+                                        "problem_id": problem_id, 
+                                        "timing_env": timing_env, 
+                                        "override_flags": override_flags, 
+                                        "stat_keys": stat_keys})
+    
+    async def submit_single_submission_pair(self, code_v0: str, 
+                                            code_v1: str, 
+                                            testcases: List[str], 
+                                            problem_id: str, 
+                                            timing_env: str, 
+                                            override_flags: str = None, 
+                                            stat_keys: Union[None, str, List[str]] = None):
+        return await self._get_results("/gem5/single_submission_pair", 
+                                       {"code_v0": code_v0, 
+                                        "code_v1": code_v1, 
+                                        "testcases": testcases, 
+                                        "problem_id": problem_id, 
+                                        "timing_env": timing_env, 
+                                        "override_flags": override_flags, 
+                                        "stat_keys": stat_keys})
+        
+    async def submit_multiple_single_submissions(self, code_list: List[str],
+                                                 testcases_list: List[List[str]],
+                                                 problem_id_list: List[str],
+                                                 timing_env: str,
+                                                 override_flags_list: List[str] = None, 
+                                                 stat_keys: Union[None, str, List[str]] = None):
+        return await self._get_results("/gem5/multiple_single_submissions", 
+                                       {"submissions": make_submissions(code_list, testcases_list, problem_id_list, override_flags_list), 
+                                        "timing_env": timing_env, 
+                                        "stat_keys": stat_keys})
+        
+    async def submit_multiple_dual_submissions(self, code_list_v0: List[str],
+                                               code_list_v1: List[str],
+                                               testcases_list: List[List[str]],
+                                               problem_id_list: List[str],
+                                               timing_env: str,
+                                               override_flags_list_v0: List[str] = None,
+                                               override_flags_list_v1: List[str] = None, 
+                                               stat_keys: Union[None, str, List[str]] = None):
+        return await self._get_results("/gem5/multiple_submissions_pairs", 
+                                       {"submissions_v0": make_submissions(code_list_v0, testcases_list, problem_id_list, override_flags_list_v0), 
+                                        "submissions_v1": make_submissions(code_list_v1, testcases_list, problem_id_list, override_flags_list_v1), 
+                                        "timing_env": timing_env, 
+                                        "stat_keys": stat_keys})
+
+
+class PieCluster: 
+    """
+    shards batches of single submissions across several PieEnvironment backends, e.g. containers on disjoint cpus or servers on other machines. 
+    
+    The batch is split into chunks on a shared queue and every backend takes the next chunk as soon as it is done with its current one, 
+    so faster or larger backends get more of the work. If a backend fails, ends its stream early or takes longer than chunk_timeout 
+    seconds on a chunk, its unfinished submissions are put back on the queue for the other backends and it is not used anymore 
+    in that batch; failed backends are pinged at the start of every batch and used again once they respond. 
+    """
+    def __init__(self, envs: List[PieEnvironment], chunk_size: int = None, chunk_timeout: Optional[float] = None):
+        assert len(envs) > 0, "a PieCluster needs at least one backend"
+        self.envs = envs
+        self.chunk_size = chunk_size
+        # the streams of the backends have no read timeout by default, so a backend that hangs would otherwise be waited on forever
+        self.chunk_timeout = chunk_timeout
+        self.failed_envs = set()
+        self._lock = threading.Lock()
         
-        
\ No newline at end of file
+    def _get_chunk_size(self, n_submissions: int) -> int:
+        if self.chunk_size is not None:
+            return self.chunk_size
+        # a few chunks per backend, so that the work is balanced at the end of the batch
+        return max(1, -(-n_submissions // (4 * len(self.envs))))
+    
+    def _fail_backend(self, env_idx, chunk, chunks, in_progress):
+        """
+        marks the backend as failed and requeues the unfinished submissions of its chunk, unless the chunk was already given up on
+        """
+        with self._lock:
+            self.failed_envs.add(env_idx)
+            if env_idx not in in_progress or in_progress[env_idx][0] is not chunk:
+                return
+            _, done, _ = in_progress.pop(env_idx)
+            chunks.put([submission_idx for chunk_idx, submission_idx in enumerate(chunk) if chunk_idx not in done])
+    
+    def _run_backend(self, env_idx, chunks, code_list, testcases_list, problem_id_list, timing_env, override_flags_list, stat_keys, results_queue, stop_event, in_progress):
+        env = self.envs[env_idx]
+        while not stop_event.is_set():
+            try: 
+                chunk = chunks.get_nowait()
+            except queue.Empty:
+                return
+            done = set()
+            with self._lock:
+                in_progress[env_idx] = (chunk, done, time.monotonic())
+            try: 
+                for chunk_idx, result in env.iter_multiple_single_submissions([code_list[i] for i in chunk], 
+                                                                               [testcases_list[i] for i in chunk], 
+                                                                               [problem_id_list[i] for i in chunk], 
+                                                                               timing_env, 
+                                                                               [override_flags_list[i] for i in chunk], 
+                                                                               stat_keys=stat_keys):
+                    with self._lock:
+                        # the chunk was requeued after its deadline, so its late results would be duplicates
+                        if env_idx not in in_progress or in_progress[env_idx][0] is not chunk:
+                            return
+                        done.add(chunk_idx)
+                        results_queue.put((chunk[chunk_idx], result))
+            except Exception as e:
+                logging.exception(f"backend {env.base_url} failed, requeueing {len(chunk) - len(done)} submissions")
+                self._fail_backend(env_idx, chunk, chunks, in_progress)
+                return
+            if len(done) < len(chunk):
+                # the stream ended without an error but some results never came, so the backend is not trusted with them again
+                logging.warning(f"backend {env.base_url} returned {len(done)} of {len(chunk)} submissions, requeueing the rest")
+                self._fail_backend(env_idx, chunk, chunks, in_progress)
+                return
+            with self._lock:
+                in_progress.pop(env_idx, None)
+    
+    def _fail_late_backends(self, chunks, in_progress):
+        if self.chunk_timeout is None:
+            return
+        with self._lock:
+            late = [(env_idx, chunk) for env_idx, (chunk, _, started_at) in in_progress.items() if time.monotonic() - started_at > self.chunk_timeout]
+        for env_idx, chunk in late:
+            logging.warning(f"backend {self.envs[env_idx].base_url} did not finish its chunk of {len(chunk)} submissions in {self.chunk_timeout}s, requeueing it")
+            self._fail_backend(env_idx, chunk, chunks, in_progress)
+
+    def iter_multiple_single_submissions(self, code_list: List[str],
+                                         testcases_list: List[List[str]],
+                                         problem_id_list: List[str],
+                                         timing_env: str,
+                                         override_flags_list: List[str] = None, 
+                                         stat_keys: Union[None, str, List[str]] = None):
+        """
+        yields (index, PieSingleResult) as soon as each submission completes on any of the backends, like PieEnvironment.iter_multiple_single_submissions
+        """
+        if override_flags_list is None:
+            override_flags_list = [None] * len(code_list)
+        # a backend that failed in an earlier batch, e.g. while it was restarting, is used again if it is back
+        self.failed_envs = {env_idx for env_idx in self.failed_envs if not self.envs[env_idx].test_connection()}
+        chunk_size = self._get_chunk_size(len(code_list))
+        chunks = queue.Queue()
+        for start in range(0, len(code_list), chunk_size):
+            chunks.put(list(range(start, min(start + chunk_size, len(code_list)))))
+        results_queue = queue.Queue()
+        stop_event = threading.Event()
+        # env_idx -> (chunk, indices in the chunk that are done, start time) of the chunk each backend is running
+        in_progress = {}
+        n_done = 0
+        try: 
+            # a backend can fail after the others have found the queue empty, so its requeued chunk needs another round
+            while n_done < len(code_list):
+                live_envs = [env_idx for env_idx in range(len(self.envs)) if env_idx not in self.failed_envs]
+                if len(live_envs) == 0:
+                    raise RuntimeError(f"all the backends of the cluster failed with {len(code_list) - n_done} submissions left")
+                threads = {env_idx: threading.Thread(target=self._run_backend, 
+                                                     args=(env_idx, chunks, code_list, testcases_list, problem_id_list, timing_env, override_flags_list, stat_keys, 
+                                                           results_queue, stop_event, in_progress), 
+                                                     daemon=True) 
+                           for env_idx in live_envs}
+                for thread in threads.values():
+                    thread.start()
+                # the threads of the backends that missed their deadline are left behind, they drop their late results
+                while any(thread.is_alive() and env_idx not in self.failed_envs for env_idx, thread in threads.items()) or not results_queue.empty():
+                    self._fail_late_backends(chunks, in_progress)
+                    try: 
+                        submission_idx, result = results_queue.get(timeout=0.5)
+                    except queue.Empty:
+                        continue
+                    n_done += 1
+                    yield submission_idx, result
+        finally: 
+            # the backends stop after their current chunk if we exit early
+            stop_event.set()
+            
+    def submit_multiple_single_submissions(self, code_list: List[str],
+                                           testcases_list: List[List[str]],
+                                           problem_id_list: List[str],
+                                           timing_env: str,
+                                           override_flags_list: List[str] = None, 
+                                           stat_keys: Union[None, str, List[str]] = None):
+        """
+        runs the submissions across the backends and returns their results in the same order as code_list
+        """
+        results = [None] * len(code_list)
+        for submission_idx, result in self.iter_multiple_single_submissions(code_list, testcases_list, problem_id_list, timing_env, override_flags_list, stat_keys):
+            results[submission_idx] = result
+        return results
+    
+    def teardown(self, remove_container=True):
+        for env in self.envs:
+            try: 
+                env.teardown(remove_container=remove_container)
+            except Exception as e:
+                logging.warning(f"could not tear down the backend {env.base_url}: {e}")